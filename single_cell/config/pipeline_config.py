@@ -88,8 +88,12 @@ def get_align_params(reference_dir, reference):
     params = {
         'ref_genome': referencedata['ref_genome'],
         'memory': {'med': 6},
+        'max_cores': 1,
+        'bwa_index_mode': 'per_cell',
         'adapter': 'CTGTCTCTTATACACATCTCCGAGCCCACGAGAC',
         'adapter2': 'CTGTCTCTTATACACATCTGACGCTGCCGACGA',
+        'validate_markdups': False,
+        'qc_sampling_fraction': None,
         'picard_wgs_params': {
             "min_bqual": 20,
             "min_mqual": 20,
@@ -100,6 +104,7 @@ def get_align_params(reference_dir, reference):
         'fastq_screen_params': {
             'aligner': 'bwa',
             'filter_tags': None,
+            'batch_size': None,
             'genomes': [
                 {
                     'name': 'grch37',
@@ -178,7 +183,9 @@ def get_merge_bams_params(reference_dir, reference, cluster):
         'ref_genome': referencedata['ref_genome'],
         'split_size': 10000000,
         'chromosomes': referencedata['chromosomes'],
-        'one_split_job': one_split_job
+        'one_split_job': one_split_job,
+        'balance_regions': False,
+        'region_plan': None,
     }
     return {'merge_bams': params}
 
@@ -192,7 +199,9 @@ def get_split_bam_params(reference_dir, reference):
         'ref_genome': referencedata['ref_genome'],
         'split_size': 10000000,
         'chromosomes': referencedata['chromosomes'],
-        'one_split_job': True
+        'one_split_job': True,
+        'balance_regions': False,
+        'region_plan': None,
     }
 
     return {'split_bam': params}
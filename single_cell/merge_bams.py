@@ -25,22 +25,47 @@ def merge_bams_workflow(args):
     merge_out_template = args['output_prefix'] + '{region}.bam'
     meta_yaml = os.path.join(args['out_dir'], 'metadata.yaml')
     input_yaml_blob = os.path.join(args['out_dir'], 'input.yaml')
+    region_plan = os.path.join(args['out_dir'], 'region_plan.yaml')
 
     workflow.setobj(
         obj=mgd.OutputChunks('cell_id'),
         value=list(bam_files.keys()),
     )
 
-    workflow.transform(
-        name="get_regions",
-        func="single_cell.utils.pysamutils.get_regions_from_reference",
-        ret=pypeliner.managed.OutputChunks('region'),
-        args=(
-            config["ref_genome"],
-            config["split_size"],
-            config["chromosomes"],
+    if config.get('region_plan'):
+        # regions planned by an earlier run, shared between normal and tumour
+        workflow.transform(
+            name="get_regions",
+            func="single_cell.utils.regionutils.load_region_plan",
+            ret=pypeliner.managed.OutputChunks('region'),
+            args=(
+                mgd.InputFile(config['region_plan']),
+            )
+        )
+    elif config.get('balance_regions'):
+        workflow.transform(
+            name="get_regions",
+            func="single_cell.utils.regionutils.get_balanced_regions",
+            ret=pypeliner.managed.OutputChunks('region'),
+            args=(
+                mgd.InputFile('bam_markdups', 'cell_id', fnames=bam_files, extensions=['.bai'], axes_origin=[]),
+                config["ref_genome"],
+                config["split_size"],
+                config["chromosomes"],
+                mgd.OutputFile(region_plan),
+            )
+        )
+    else:
+        workflow.transform(
+            name="get_regions",
+            func="single_cell.utils.pysamutils.get_regions_from_reference",
+            ret=pypeliner.managed.OutputChunks('region'),
+            args=(
+                config["ref_genome"],
+                config["split_size"],
+                config["chromosomes"],
+            )
         )
-    )
 
     workflow.transform(
         name="remove_softclipped_reads",
@@ -22,20 +22,47 @@ def split_bam_workflow(args):
 
     meta_yaml = os.path.join(args["out_dir"], 'metadata.yaml')
     input_yaml_blob = os.path.join(args["out_dir"], 'input.yaml')
+    region_plan = os.path.join(args["out_dir"], 'region_plan.yaml')
 
     workflow = pypeliner.workflow.Workflow()
 
-    workflow.transform(
-        name="get_regions",
-        ctx={'mem': config['memory']['low'], 'ncpus': 1},
-        func="single_cell.utils.pysamutils.get_regions_from_reference",
-        ret=pypeliner.managed.OutputChunks('region'),
-        args=(
-            config["ref_genome"],
-            config["split_size"],
-            config["chromosomes"],
+    if config.get('region_plan'):
+        # regions planned by an earlier run, shared between normal and tumour
+        workflow.transform(
+            name="get_regions",
+            ctx={'mem': config['memory']['low'], 'ncpus': 1},
+            func="single_cell.utils.regionutils.load_region_plan",
+            ret=pypeliner.managed.OutputChunks('region'),
+            args=(
+                mgd.InputFile(config['region_plan']),
+            )
+        )
+    elif config.get('balance_regions'):
+        workflow.transform(
+            name="get_regions",
+            ctx={'mem': config['memory']['low'], 'ncpus': 1},
+            func="single_cell.utils.regionutils.get_balanced_regions",
+            ret=pypeliner.managed.OutputChunks('region'),
+            args=(
+                mgd.InputFile(bam_file, extensions=['.bai']),
+                config["ref_genome"],
+                config["split_size"],
+                config["chromosomes"],
+                mgd.OutputFile(region_plan),
+            )
+        )
+    else:
+        workflow.transform(
+            name="get_regions",
+            ctx={'mem': config['memory']['low'], 'ncpus': 1},
+            func="single_cell.utils.pysamutils.get_regions_from_reference",
+            ret=pypeliner.managed.OutputChunks('region'),
+            args=(
+                config["ref_genome"],
+                config["split_size"],
+                config["chromosomes"],
+            )
         )
-    )
 
     workflow.subworkflow(
         name="split_normal",
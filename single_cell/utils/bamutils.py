@@ -3,11 +3,15 @@ Created on Feb 19, 2018
 
 @author: dgrewal
 '''
+import fcntl
+import logging
 import os
 import shutil
+import subprocess
+import tempfile
 
 import pypeliner
-import pysam
+from single_cell.utils import bgzfutils
 from single_cell.utils import helpers
 
 from single_cell.utils.helpers import makedirs
@@ -63,6 +67,137 @@ def bwa_mem_paired_end(fastq1, fastq2, output,
             )
 
 
+def bwa_shm_indexes():
+    """
+    index prefixes currently held in shared memory by bwa shm
+    """
+    try:
+        listing = subprocess.check_output(['bwa', 'shm', '-l'], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        # bwa shm -l exits non zero when nothing is loaded
+        return set()
+
+    indexes = set()
+    for line in listing.decode().splitlines():
+        line = line.split('\t')
+        if len(line) == 2:
+            indexes.add(line[0])
+    return indexes
+
+
+def _bwa_shm_state_file():
+    return os.path.join(tempfile.gettempdir(), 'single_cell_bwa_shm.loaded')
+
+
+def _bwa_shm_key(reference):
+    """
+    identifies the index files of reference, bwa shm itself only
+    records the basename of the prefix
+    """
+    bwt = os.stat(reference + '.bwt')
+    return '{}\t{}\t{}'.format(os.path.abspath(reference), bwt.st_size, int(bwt.st_mtime))
+
+
+def bwa_shm_is_loaded(reference):
+    """
+    whether the index of this reference is in shared memory. bwa shm
+    registers an index under the basename of its prefix, the node level
+    record written by bwa_shm_load tells which reference it was loaded from
+    """
+    if os.path.basename(reference) not in bwa_shm_indexes():
+        return False
+
+    state_file = _bwa_shm_state_file()
+    if not os.path.exists(state_file):
+        return False
+
+    with open(state_file, 'rt') as reader:
+        return reader.read().strip() == _bwa_shm_key(reference)
+
+
+def bwa_shm_load(reference):
+    """
+    load the bwa index of reference into shared memory, once per node.
+    bwa mem picks up an index in shared memory when it is called with
+    a reference prefix of the same basename, so later alignments skip
+    reading the index from disk. concurrent jobs on a node wait on a
+    lock file while the first one loads the index. an index of another
+    reference with the same basename is dropped first, bwa mem would
+    align against it otherwise. returns True if this call loaded the index.
+
+    the index stays in shared memory after the workflow, outside the
+    memory request of any job, until bwa_shm_drop (bwa shm -d) is run
+    on the node or the node restarts.
+    """
+    lockfile = os.path.join(tempfile.gettempdir(), 'single_cell_bwa_shm.lock')
+
+    with open(lockfile, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if bwa_shm_is_loaded(reference):
+                return False
+            if os.path.basename(reference) in bwa_shm_indexes():
+                logging.getLogger("single_cell.bamutils").warning(
+                    "dropping a bwa index in shared memory that was not loaded from %s" % reference
+                )
+                bwa_shm_drop()
+            pypeliner.commandline.execute('bwa', 'shm', reference)
+            with open(_bwa_shm_state_file(), 'wt') as writer:
+                writer.write(_bwa_shm_key(reference) + '\n')
+            return True
+        except pypeliner.commandline.CommandLineException:
+            logging.getLogger("single_cell.bamutils").warning(
+                "could not load %s into shared memory, bwa will read the index from disk" % reference
+            )
+            return False
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def bwa_shm_drop():
+    """
+    drop every index bwa holds in shared memory on this node. running
+    bwa mem processes keep their mapping of the index.
+    """
+    pypeliner.commandline.execute('bwa', 'shm', '-d')
+
+    state_file = _bwa_shm_state_file()
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+
+def bwa_mem_paired_end_sorted(fastq1, fastq2, output, tempdir,
+                              reference, readgroup, threads=1, sort_mem='768M'
+                              ):
+    """
+    run bwa mem on both fastq files and stream the alignments
+    straight into samtools sort, then index the sorted bam.
+    nothing uncompressed is written to disk.
+    """
+    makedirs(tempdir)
+
+    sort_prefix = os.path.join(tempdir, 'bwamem_sort')
+
+    sort_cmd = [
+        'samtools', 'sort', '-@', threads, '-m', sort_mem,
+        '-T', sort_prefix, '-o', output, '-'
+    ]
+
+    try:
+        readgroup_literal = '"' + readgroup + '"'
+        pypeliner.commandline.execute(
+            'bwa', 'mem', '-t', threads, '-C', '-M', '-R', readgroup_literal,
+            reference, fastq1, fastq2, '|', *sort_cmd
+        )
+    except pypeliner.commandline.CommandLineException:
+        pypeliner.commandline.execute(
+            'bwa', 'mem', '-t', threads, '-C', '-M', '-R', readgroup,
+            reference, fastq1, fastq2, '|', *sort_cmd
+        )
+
+    bam_index(output, output + '.bai')
+
+
 def samtools_sam_to_bam(samfile, bamfile,
                         ):
     pypeliner.commandline.execute(
@@ -153,10 +288,13 @@ def bam_view(bam, output, region):
 
 
 def add_comment_bam_header(infile, outfile, comment):
-    with pysam.AlignmentFile(infile, mode='r', check_sq=False) as inbam:
-        header = inbam.header.to_dict()
-        header['CO'] = comment
+    """
+    add a @CO line to the bam header. only the header is rewritten,
+    the compressed alignment records are copied as they are.
+    """
+    def add_comment(text):
+        if text and not text.endswith('\n'):
+            text += '\n'
+        return text + '@CO\t' + comment + '\n'
 
-        with pysam.AlignmentFile(outfile, header=header, mode='wh') as outbam:
-            for read in inbam.fetch(until_eof=True):
-                outbam.write(read)
+    bgzfutils.reheader_bam(infile, outfile, add_comment)
@@ -0,0 +1,160 @@
+'''
+BGZF block level access to bam files, for edits that only touch the
+header. The compressed blocks of the alignment records are copied
+as they are, nothing past the header is decompressed.
+'''
+import struct
+import zlib
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+# the gzip header of a bgzf block up to and including XLEN
+BGZF_HEADER = struct.Struct('<4sIBBH')
+
+# uncompressed bytes per block, htslib leaves room for incompressible data
+BGZF_BLOCK_SIZE = 0xff00
+
+BAM_MAGIC = b'BAM\x01'
+
+
+class BgzfException(Exception):
+    pass
+
+
+def read_block(reader):
+    """
+    read one bgzf block, returns the raw block bytes and the
+    compressed data, or None at the end of the file
+    """
+    header = reader.read(BGZF_HEADER.size)
+    if not header:
+        return None
+
+    if len(header) < BGZF_HEADER.size:
+        raise BgzfException('truncated bgzf block header')
+
+    magic, _, _, _, xlen = BGZF_HEADER.unpack(header)
+    if magic != BGZF_MAGIC:
+        raise BgzfException('not a bgzf file')
+
+    extra = reader.read(xlen)
+
+    block_size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        subfield, length = struct.unpack('<2sH', extra[pos:pos + 4])
+        if subfield == b'BC' and length == 2:
+            block_size = struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + length
+
+    if block_size is None:
+        raise BgzfException('bgzf block without a BC subfield')
+
+    remainder = reader.read(block_size - BGZF_HEADER.size - xlen)
+    if len(remainder) != block_size - BGZF_HEADER.size - xlen:
+        raise BgzfException('truncated bgzf block')
+
+    # compressed data, then crc32 and uncompressed size
+    return header + extra + remainder, remainder[:-8]
+
+
+def decompress_block(cdata):
+    return zlib.decompress(cdata, -15)
+
+
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    block_size = BGZF_HEADER.size + 6 + len(cdata) + 8
+
+    block = [
+        BGZF_HEADER.pack(BGZF_MAGIC, 0, 0, 0xff, 6),
+        struct.pack('<2sHH', b'BC', 2, block_size - 1),
+        cdata,
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)),
+    ]
+    return b''.join(block)
+
+
+def write_blocks(writer, data, level=6):
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        writer.write(compress_block(data[start:start + BGZF_BLOCK_SIZE], level=level))
+
+
+def get_header_length(data):
+    """
+    length of the bam header at the start of data,
+    None if data does not hold the full header yet
+    """
+    if len(data) < 12:
+        return None
+
+    if data[:4] != BAM_MAGIC:
+        raise BgzfException('not a bam file')
+
+    l_text = struct.unpack('<i', data[4:8])[0]
+    pos = 8 + l_text
+
+    if len(data) < pos + 4:
+        return None
+    n_ref = struct.unpack('<i', data[pos:pos + 4])[0]
+    pos += 4
+
+    for _ in range(n_ref):
+        if len(data) < pos + 4:
+            return None
+        l_name = struct.unpack('<i', data[pos:pos + 4])[0]
+        pos += 4 + l_name + 4
+
+    if len(data) < pos:
+        return None
+
+    return pos
+
+
+def get_header_text(header):
+    l_text = struct.unpack('<i', header[4:8])[0]
+    return header[8:8 + l_text].rstrip(b'\0').decode()
+
+
+def pack_header(text, header):
+    """
+    bam header with the sam text replaced, the
+    reference list is kept from the original header
+    """
+    l_text = struct.unpack('<i', header[4:8])[0]
+    text = text.encode()
+    return BAM_MAGIC + struct.pack('<i', len(text)) + text + header[8 + l_text:]
+
+
+def reheader_bam(infile, outfile, update_text, level=6):
+    """
+    rewrite the sam text of the bam header with update_text, which
+    takes the current text and returns the new one. only the blocks
+    that hold the header are decompressed; the records that share
+    the last of them are recompressed into a new block and every
+    later block is copied byte for byte. the reference list must not
+    change. record offsets shift, so any existing index is stale.
+    """
+    with open(infile, 'rb') as reader, open(outfile, 'wb') as writer:
+        data = b''
+        header_length = None
+        while header_length is None:
+            block = read_block(reader)
+            if block is None:
+                raise BgzfException('bam file ends inside the header')
+            data += decompress_block(block[1])
+            header_length = get_header_length(data)
+
+        header = data[:header_length]
+        text = update_text(get_header_text(header))
+
+        write_blocks(writer, pack_header(text, header), level=level)
+        write_blocks(writer, data[header_length:], level=level)
+
+        while True:
+            chunk = reader.read(1 << 20)
+            if not chunk:
+                break
+            writer.write(chunk)
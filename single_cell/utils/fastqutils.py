@@ -1,38 +1,82 @@
-import re
 from collections import defaultdict
-from itertools import islice
+from itertools import repeat
 
 from single_cell.utils import helpers
 
+FASTQ_BLOCK_SIZE = 8 * 1024 * 1024
+
 
 class FastqReader(object):
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, block_size=FASTQ_BLOCK_SIZE):
         self.file_path = filepath
-
-    def get_read_iterator(self):
-        with helpers.getFileHandle(self.file_path) as fq_reader:
+        self.block_size = block_size
+
+    def _get_line_blocks(self):
+        """
+        read the decompressed fastq in large blocks and yield
+        the complete lines in each block as a list of str.
+        trailing partial lines are carried over to the next block
+        """
+        with helpers.getFileHandle(self.file_path, 'rb') as fq_reader:
+            remainder = b''
             while True:
-                fastq_read = list(islice(fq_reader, 4))
+                block = fq_reader.read(self.block_size)
 
-                fastq_read = [line for line in fastq_read]
-
-                if not fastq_read:
+                if not block:
                     break
 
-                assert len(fastq_read) == 4, 'fastq file format error'
+                last_newline = block.rfind(b'\n')
+                if last_newline == -1:
+                    remainder += block
+                    continue
+
+                lines = (remainder + block[:last_newline + 1]).decode()
+                remainder = block[last_newline + 1:]
+
+                yield lines.splitlines(True)
+
+            if remainder:
+                yield [remainder.decode()]
+
+    def get_read_block_iterator(self):
+        """
+        yield the reads in each decompressed block as a list of
+        reads, where each read is a list of its four lines
+        """
+        pending = []
+
+        for lines in self._get_line_blocks():
+            if pending:
+                lines = pending + lines
+
+            num_complete = len(lines) - len(lines) % 4
+            pending = lines[num_complete:]
+
+            if not num_complete:
+                continue
+
+            if not all(map(str.startswith, lines[0:num_complete:4], repeat('@'))):
+                raise ValueError('Expected @ as first character of read name')
+
+            if not all(map(str.startswith, lines[2:num_complete:4], repeat('+'))):
+                raise ValueError('Expected = as first character of read comment')
 
-                if not fastq_read[0].startswith('@'):
-                    raise ValueError('Expected @ as first character of read name')
+            lines_iter = iter(lines[:num_complete])
+            yield list(map(list, zip(lines_iter, lines_iter, lines_iter, lines_iter)))
 
-                if not fastq_read[2].startswith('+'):
-                    raise ValueError('Expected = as first character of read comment')
+        assert not pending, 'fastq file format error'
 
+    def get_read_iterator(self):
+        for reads in self.get_read_block_iterator():
+            for fastq_read in reads:
                 yield fastq_read
 
 
 def _get_read_name(fastq_line1):
-    return re.split('/| |\t|#FQST:', fastq_line1.split()[0])[0].rstrip()
+    read_name = fastq_line1.split(None, 1)[0]
+    read_name = read_name.split('/', 1)[0]
+    return read_name.split('#FQST:', 1)[0]
 
 
 class PairedFastqReader(object):
@@ -61,24 +105,41 @@ class TaggedFastqReader(FastqReader):
     def __init__(self, fastq_path):
         super(TaggedFastqReader, self).__init__(fastq_path)
         self.indices = None
+        self._tag_cache = {}
+        self._comment_cache = {}
 
-    def get_read_tag(self, fastq_read):
-
-        read_id = fastq_read[0]
-        fq_tag = read_id[read_id.index('FQST:'):]
-        fq_tag = fq_tag.strip().split(':')
+    def _parse_read_tag(self, fq_tag):
+        fq_tag = fq_tag.split(':')
 
         if not self.indices:
-            if len(fq_tag) > 2:
-                self.indices = {i: v for i, v in enumerate(fq_tag[1:-1])}
+            if len(fq_tag) > 1:
+                self.indices = {i: v for i, v in enumerate(fq_tag[:-1])}
             else:
                 raise Exception('First line in fastq file should have filter explanation')
 
         flag = map(int, list(fq_tag[-1]))
 
-        flag_map = {self.indices[i]: 0 if v == 0 else 1 for i, v in enumerate(flag)}
+        return {self.indices[i]: 0 if v == 0 else 1 for i, v in enumerate(flag)}
 
-        return flag_map
+    def get_read_tag(self, fastq_read):
+        """
+        parse the FQST tag into a dict of genome: flag.
+        there are only a handful of distinct tags in a file, so the
+        parsed dicts are cached on the tag string and shared between
+        reads. callers must not modify the returned dict.
+        """
+        return self.parse_raw_read_tag(self.get_raw_read_tag(fastq_read))
+
+    def _get_tag_comment(self, tag):
+        key = tuple(tag.items())
+
+        comment = self._comment_cache.get(key)
+        if comment is None:
+            comment = ['{}_{}'.format(k, v) for k, v in tag.items()]
+            comment = 'FS:Z:' + ','.join(comment)
+            self._comment_cache[key] = comment
+
+        return comment
 
     def add_tag_to_read_comment(self, read, tag=None):
         read_name = _get_read_name(read[0])
@@ -86,11 +147,7 @@ class TaggedFastqReader(FastqReader):
         if not tag:
             tag = self.get_read_tag(read)
 
-        tag = ['{}_{}'.format(k, v) for k, v in tag.items()]
-        tag = ','.join(tag)
-        tag = 'FS:Z:' + tag
-
-        comment = tag
+        comment = self._get_tag_comment(tag)
 
         read[0] = read_name + '\t' + comment + '\n'
 
@@ -102,36 +159,61 @@ class TaggedFastqReader(FastqReader):
         if tags in filter_tags:
             return True
 
+    @staticmethod
+    def get_raw_read_tag(fastq_read):
+        read_id = fastq_read[0]
+        return read_id[read_id.index('FQST:') + 5:].rstrip()
+
+    def parse_raw_read_tag(self, fq_tag):
+        flag_map = self._tag_cache.get(fq_tag)
+        if flag_map is None:
+            flag_map = self._parse_read_tag(fq_tag)
+            self._tag_cache[fq_tag] = flag_map
+        return flag_map
+
+    def _collapse_counts(self, raw_counts):
+        """
+        convert counts keyed on raw tag strings into counts keyed
+        on sorted (genome, flag) tuples
+        """
+        counts = defaultdict(int)
+        for fq_tag, count in raw_counts.items():
+            read_tags = self.parse_raw_read_tag(fq_tag)
+            flags = tuple((key, read_tags[key]) for key in sorted(read_tags))
+            counts[flags] += count
+        return counts
+
     def filter_read_iterator(self, genomes, filter_tags):
+        decisions = {}
+
         for read in self.get_read_iterator():
-            read_tags = self.get_read_tag(read)
+            fq_tag = self.get_raw_read_tag(read)
 
-            if self.__filter(genomes, filter_tags, read_tags):
+            skip = decisions.get(fq_tag)
+            if skip is None:
+                skip = bool(self.__filter(genomes, filter_tags, self.parse_raw_read_tag(fq_tag)))
+                decisions[fq_tag] = skip
+
+            if skip:
                 continue
 
             yield read
 
     def gather_counts(self):
-        key_order = None
-        counts = defaultdict(int)
+        raw_counts = defaultdict(int)
 
         for read in self.get_read_iterator():
+            raw_counts[self.get_raw_read_tag(read)] += 1
 
-            read_tags = self.get_read_tag(read)
-            if not key_order:
-                key_order = sorted(read_tags.keys())
-
-            flags = zip(key_order, [read_tags[key] for key in key_order])
-
-            counts[flags] += 1
-
-        return counts
+        return self._collapse_counts(raw_counts)
 
 
 class PairedTaggedFastqReader(PairedFastqReader, TaggedFastqReader):
     def __init__(self, fastq_r1, fastq_r2):
         super(PairedTaggedFastqReader, self).__init__(fastq_r1, fastq_r2)
         self.indices = None
+        self._tag_cache = {}
+        self._comment_cache = {}
 
     @staticmethod
     def __filter(genomes, filter_tags, tags_r1, tags_r2):
@@ -142,31 +224,31 @@ class PairedTaggedFastqReader(PairedFastqReader, TaggedFastqReader):
             return True
 
     def filter_read_iterator(self, genomes, filter_tags):
+        decisions = {}
+
         for read_1, read_2 in self.get_read_pair_iterator():
+            fq_tags = (self.get_raw_read_tag(read_1), self.get_raw_read_tag(read_2))
 
-            tags_r1 = self.get_read_tag(read_1)
-            tags_r2 = self.get_read_tag(read_2)
+            skip = decisions.get(fq_tags)
+            if skip is None:
+                tags_r1 = self.parse_raw_read_tag(fq_tags[0])
+                tags_r2 = self.parse_raw_read_tag(fq_tags[1])
+                skip = bool(self.__filter(genomes, filter_tags, tags_r1, tags_r2))
+                decisions[fq_tags] = skip
 
-            if self.__filter(genomes, filter_tags, tags_r1, tags_r2):
+            if skip:
                 continue
 
             yield read_1, read_2
 
     def gather_counts(self):
-        key_order = None
-        counts = {'R1': defaultdict(int), 'R2': defaultdict(int)}
+        raw_counts = {'R1': defaultdict(int), 'R2': defaultdict(int)}
 
         for read_1, read_2 in self.get_read_pair_iterator():
-            tags_r1 = self.get_read_tag(read_1)
-            tags_r2 = self.get_read_tag(read_2)
-
-            if not key_order:
-                key_order = sorted(tags_r1.keys())
-
-            r1_flags = tuple(zip(key_order, [tags_r1[key] for key in key_order]))
-            r2_flags = tuple(zip(key_order, [tags_r2[key] for key in key_order]))
+            raw_counts["R1"][self.get_raw_read_tag(read_1)] += 1
+            raw_counts["R2"][self.get_raw_read_tag(read_2)] += 1
 
-            counts["R1"][r1_flags] += 1
-            counts["R2"][r2_flags] += 1
-
-        return counts
+        return {
+            "R1": self._collapse_counts(raw_counts["R1"]),
+            "R2": self._collapse_counts(raw_counts["R2"]),
+        }
@@ -6,16 +6,15 @@ Created on Feb 19, 2018
 import errno
 import gzip
 import logging
-import multiprocessing
 import os
 import re
 import shutil
 import tarfile
 
 import pandas as pd
-import pypeliner
 import single_cell
 import yaml
+from single_cell.utils import processutils
 
 
 class InputException(Exception):
@@ -274,34 +273,14 @@ def get_incrementing_filename(path):
     return "{}.{}".format(path, i)
 
 
-def build_shell_script(command, tag, tempdir):
-    outfile = os.path.join(tempdir, "{}.sh".format(tag))
-    with open(outfile, 'w') as scriptfile:
-        scriptfile.write("#!/bin/bash\n")
-        if isinstance(command, list) or isinstance(command, tuple):
-            command = ' '.join(command) + '\n'
-        scriptfile.write(command)
-    return outfile
-
-
-def run_in_gnu_parallel(commands, tempdir, ncores=None):
-    makedirs(tempdir)
-
-    scriptfiles = []
-
-    for tag, command in enumerate(commands):
-        scriptfiles.append(build_shell_script(command, tag, tempdir))
-
-    parallel_outfile = os.path.join(tempdir, "commands.txt")
-    with open(parallel_outfile, 'w') as outfile:
-        for scriptfile in scriptfiles:
-            outfile.write("sh {}\n".format(scriptfile))
-
-    if not ncores:
-        ncores = multiprocessing.cpu_count()
-
-    gnu_parallel_cmd = ['parallel', '--jobs', ncores, '<', parallel_outfile]
-    pypeliner.commandline.execute(*gnu_parallel_cmd)
+def run_in_parallel(commands, tempdir, ncores=None, timeout=None, retries=0):
+    """
+    run shell commands with at most ncores at a time, see
+    processutils.run_commands. returns the per command results
+    """
+    return processutils.run_commands(
+        commands, tempdir, ncores=ncores, timeout=timeout, retries=retries
+    )
 
 
 def makedirs(directory, isfile=False):
@@ -0,0 +1,179 @@
+'''
+In-process executor for lists of shell commands, with bounded
+concurrency, per command timeouts and retries, logs streamed to a file
+per command and a resource report (wall, cpu, peak rss) per command.
+'''
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+CommandResult = namedtuple(
+    'CommandResult',
+    ['tag', 'command', 'returncode', 'attempts', 'timed_out',
+     'start_time', 'wall_time', 'cpu_time', 'max_rss', 'log']
+)
+
+REPORT_COLUMNS = [
+    'tag', 'returncode', 'attempts', 'timed_out',
+    'start_time', 'wall_time', 'cpu_time', 'max_rss_kb', 'command'
+]
+
+
+class CommandExecutionException(Exception):
+    pass
+
+
+def get_command_string(command):
+    if isinstance(command, (list, tuple)):
+        command = ' '.join(map(str, command))
+    return command
+
+
+def get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def tail(filepath, num_lines=20):
+    with open(filepath, 'rt', errors='replace') as reader:
+        return ''.join(reader.readlines()[-num_lines:])
+
+
+def run_command(tag, command, logfile, timeout=None):
+    """
+    run command through bash in its own process group, streaming its
+    output to logfile. the process group is killed after timeout
+    seconds. returns the exit code, whether it timed out, the wall
+    time and the rusage of the command and its children.
+    """
+    logger = logging.getLogger('single_cell.processutils')
+
+    start = time.time()
+
+    with open(logfile, 'ab') as log:
+        proc = subprocess.Popen(
+            ['bash', '-c', command], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, start_new_session=True
+        )
+
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            kill_process_group(proc)
+
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, on_timeout)
+            timer.start()
+
+        try:
+            for line in proc.stdout:
+                log.write(line)
+                log.flush()
+                logger.debug('[%s] %s', tag, line.decode(errors='replace').rstrip())
+            proc.stdout.close()
+
+            _, status, rusage = os.wait4(proc.pid, 0)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    # reaped through wait4, let Popen know
+    proc.returncode = get_exit_code(status)
+
+    return proc.returncode, timed_out.is_set(), time.time() - start, rusage
+
+
+def run_with_retries(tag, command, tempdir, timeout=None, retries=0):
+    logger = logging.getLogger('single_cell.processutils')
+
+    command = get_command_string(command)
+    logfile = os.path.join(tempdir, '{}.log'.format(tag))
+
+    start_time = time.time()
+    wall_time = cpu_time = 0
+    max_rss = 0
+
+    for attempt in range(1, retries + 2):
+        returncode, timed_out, wall, rusage = run_command(tag, command, logfile, timeout=timeout)
+
+        wall_time += wall
+        cpu_time += rusage.ru_utime + rusage.ru_stime
+        max_rss = max(max_rss, rusage.ru_maxrss)
+
+        if returncode == 0:
+            break
+
+        logger.warning(
+            'command %s failed with exit code %s%s (attempt %s of %s)',
+            tag, returncode, ', timed out' if timed_out else '', attempt, retries + 1
+        )
+
+    return CommandResult(
+        tag, command, returncode, attempt, timed_out,
+        start_time, wall_time, cpu_time, max_rss, logfile
+    )
+
+
+def write_report(results, output):
+    with open(output, 'wt') as writer:
+        writer.write('\t'.join(REPORT_COLUMNS) + '\n')
+        for result in results:
+            row = [
+                result.tag, result.returncode, result.attempts, result.timed_out,
+                '{:.3f}'.format(result.start_time), '{:.2f}'.format(result.wall_time), '{:.2f}'.format(result.cpu_time),
+                result.max_rss, result.command
+            ]
+            writer.write('\t'.join(map(str, row)) + '\n')
+
+
+def run_commands(commands, tempdir, ncores=None, timeout=None, retries=0):
+    """
+    run the shell commands with at most ncores at a time (default: all
+    cpus). each command is logged to <tempdir>/<index>.log, retried up
+    to retries times and killed after timeout seconds per attempt.
+    writes <tempdir>/resource_report.tsv and raises a
+    CommandExecutionException with the log tails of the failed commands
+    once all commands have finished.
+    """
+    if not os.path.exists(tempdir):
+        os.makedirs(tempdir)
+
+    if not ncores:
+        ncores = multiprocessing.cpu_count()
+
+    with ThreadPoolExecutor(max_workers=ncores) as executor:
+        futures = [
+            executor.submit(run_with_retries, tag, command, tempdir, timeout=timeout, retries=retries)
+            for tag, command in enumerate(commands)
+        ]
+        results = [future.result() for future in futures]
+
+    write_report(results, os.path.join(tempdir, 'resource_report.tsv'))
+
+    failed = [result for result in results if result.returncode != 0]
+    if failed:
+        message = ['{} of {} commands failed'.format(len(failed), len(results))]
+        for result in failed:
+            message.append('command {}: {}\nexit code {}{}, log tail:\n{}'.format(
+                result.tag, result.command, result.returncode,
+                ' (timed out)' if result.timed_out else '', tail(result.log)
+            ))
+        raise CommandExecutionException('\n'.join(message))
+
+    return results
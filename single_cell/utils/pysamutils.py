@@ -5,6 +5,7 @@ Created on Jun 1, 2018
 '''
 import shutil
 from collections import OrderedDict
+from collections import defaultdict
 
 import pysam
 from single_cell.utils.bamutils import bam_index
@@ -50,6 +51,81 @@ def get_regions(chromosome_lengths, split_size):
     return regions
 
 
+def parse_region(region):
+    """
+    chrom-start-end with 1 based inclusive coordinates,
+    returns the chrom and 0 based half open coordinates
+    """
+    chrom, start, end = region.rsplit('-', 2)
+    return chrom, int(start) - 1, int(end)
+
+
+def get_regions_by_chrom(regions):
+    regions_by_chrom = defaultdict(list)
+    for region in regions:
+        chrom, start, end = parse_region(region)
+        regions_by_chrom[chrom].append((start, end, region))
+    return regions_by_chrom
+
+
+def get_read_span(read):
+    # reads without an alignment span one base at their position, as in samtools view
+    end = read.reference_end
+    if end is None:
+        end = read.reference_start + 1
+    return read.reference_start, end
+
+
+def open_bam_writer(output, header, threads=1):
+    return pysam.AlignmentFile(output, 'wb', header=header, threads=threads)
+
+
+def close_bam_writer(writer, output):
+    writer.close()
+    pysam.index(output, output + '.bai')
+
+
+def write_empty_bam(output, header):
+    close_bam_writer(open_bam_writer(output, header), output)
+
+
+def write_reads_by_region(reads, regions, outputs, header, threads=1):
+    """
+    route coordinate sorted reads of one chromosome to the regions they
+    overlap, regions is a list of (start, end, region) and outputs maps
+    region to bam file. a region writer is opened when the first read
+    can reach it and closed and indexed once reads start past its end,
+    so only the regions around the current position are open.
+    """
+    regions = sorted(regions)
+
+    writers = []
+    next_region = 0
+
+    for read in reads:
+        read_start, read_end = get_read_span(read)
+
+        while next_region < len(regions) and regions[next_region][0] < read_end:
+            start, end, region = regions[next_region]
+            writers.append((start, end, region, open_bam_writer(outputs[region], header, threads)))
+            next_region += 1
+
+        for start, end, region, writer in writers:
+            if end <= read_start:
+                close_bam_writer(writer, outputs[region])
+        writers = [v for v in writers if v[1] > read_start]
+
+        for start, end, region, writer in writers:
+            if start < read_end:
+                writer.write(read)
+
+    for start, end, region, writer in writers:
+        close_bam_writer(writer, outputs[region])
+
+    for start, end, region in regions[next_region:]:
+        write_empty_bam(outputs[region], header)
+
+
 def _fraction_softclipped(x):
     total_softclipped = 0
     for a in x.cigar:
@@ -1,7 +1,28 @@
+'''
+Reference genome helpers. The chromosome sizes and the known (non N)
+bases of a reference are scanned once and cached, keyed by the checksum
+of the reference, so that runs do not scan the whole fasta again.
+'''
+import fcntl
+import hashlib
+import logging
+import os
+
+import numpy as np
 import pandas as pd
+import pysam
+from single_cell.utils import helpers
 
 default_chromosomes = [str(a) for a in range(1, 23)] + ['X', 'Y']
 
+UNKNOWN_BASES = np.frombuffer(b'Nn', dtype=np.uint8)
+
+SCAN_CHUNK_SIZE = 10000000
+
+SIZES_FILENAME = 'chromosome_sizes.tsv'
+
+CALLABLE_BED_FILENAME = 'callable_regions.bed'
+
 
 def read_chromosome_lengths(genome_fasta_index, chromosomes=default_chromosomes):
     fai = pd.read_csv(genome_fasta_index, sep='\t', header=None, names=['chrom', 'length', 'V3', 'V4', 'V5'])
@@ -30,3 +51,196 @@ def get_split_regions(split_size, refgenome, chromosomes=default_chromosomes):
             regions.append('{}-{}-{}'.format(chrom, beg, end))
 
     return regions
+
+
+def get_reference_key(reference):
+    """
+    checksum identifying the reference, from the md5 of the fasta index
+    and the size of the fasta. both change if a sequence is renamed,
+    resized or added, without reading the whole fasta.
+    """
+    md5 = hashlib.md5()
+    with open(reference + '.fai', 'rb') as reader:
+        md5.update(reader.read())
+    md5.update(str(os.path.getsize(reference)).encode())
+    return md5.hexdigest()
+
+
+def get_cache_dir(reference, cache_dir=None):
+    """
+    the metadata is cached next to the reference, or in the user cache
+    directory if the reference directory is not writable
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(reference))
+        if not os.access(cache_dir, os.W_OK):
+            cache_dir = os.path.join(
+                os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                'single_cell_pipeline'
+            )
+
+    name = os.path.basename(reference) + '.' + get_reference_key(reference)
+    return os.path.join(cache_dir, name)
+
+
+def scan_sequence(fasta, chrom, length, chunk_size=None):
+    """
+    reads a sequence in chunks, returns the number of known (non N) bases
+    and the 0-based half open intervals of known bases
+    """
+    if chunk_size is None:
+        chunk_size = SCAN_CHUNK_SIZE
+
+    known_size = 0
+    intervals = []
+    start = None
+
+    for offset in range(0, length, chunk_size):
+        sequence = fasta.fetch(chrom, offset, min(offset + chunk_size, length))
+        known = ~np.isin(np.frombuffer(sequence.encode(), dtype=np.uint8), UNKNOWN_BASES)
+        known_size += int(known.sum())
+
+        # positions where the sequence switches between known and unknown,
+        # carrying the state of the previous chunk
+        state = np.concatenate([[start is not None], known])
+        for change in np.flatnonzero(state[1:] != state[:-1]):
+            if start is None:
+                start = offset + int(change)
+            else:
+                intervals.append((start, offset + int(change)))
+                start = None
+
+    if start is not None:
+        intervals.append((start, length))
+
+    return known_size, intervals
+
+
+def build_reference_metadata(reference, cache_dir):
+    """
+    scans the reference once, writing the size and known size of each
+    chromosome and a bed of the known bases to cache_dir
+    """
+    logging.getLogger('single_cell.refgenome').info(
+        'building the metadata cache of %s in %s', reference, cache_dir
+    )
+
+    helpers.makedirs(cache_dir)
+
+    sizes_file = os.path.join(cache_dir, SIZES_FILENAME)
+    bed_file = os.path.join(cache_dir, CALLABLE_BED_FILENAME)
+
+    sizes = []
+    with pysam.FastaFile(reference) as fasta, open(bed_file + '.tmp', 'wt') as bed:
+        for chrom, length in zip(fasta.references, fasta.lengths):
+            known_size, intervals = scan_sequence(fasta, chrom, length)
+            sizes.append((chrom, length, known_size))
+
+            for start, end in intervals:
+                bed.write('{}\t{}\t{}\n'.format(chrom, start, end))
+
+    sizes = pd.DataFrame(sizes, columns=['chrom', 'size', 'known_size'])
+    sizes.to_csv(sizes_file + '.tmp', sep='\t', index=False)
+
+    # the sizes are written last, their presence marks a complete cache
+    os.rename(bed_file + '.tmp', bed_file)
+    os.rename(sizes_file + '.tmp', sizes_file)
+
+
+def _build_cache_file(cache_dir, filepath, build):
+    """
+    calls build unless filepath exists, concurrent jobs wait for the
+    one building it
+    """
+    helpers.makedirs(os.path.dirname(cache_dir))
+
+    with open(cache_dir + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(filepath):
+                build()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_reference_metadata(reference, cache_dir=None):
+    """
+    returns the cache directory of the reference metadata, building it on
+    first use
+    """
+    cache_dir = get_cache_dir(reference, cache_dir=cache_dir)
+    sizes_file = os.path.join(cache_dir, SIZES_FILENAME)
+
+    if not os.path.exists(sizes_file):
+        _build_cache_file(
+            cache_dir, sizes_file, lambda: build_reference_metadata(reference, cache_dir)
+        )
+
+    return cache_dir
+
+
+def get_cached_file(reference, filename, build, cache_dir=None):
+    """
+    path of filename in the metadata cache of the reference, written
+    by build(reference, filepath) on first use
+    """
+    cache_dir = get_cache_dir(reference, cache_dir=cache_dir)
+    filepath = os.path.join(cache_dir, filename)
+
+    def build_file():
+        helpers.makedirs(cache_dir)
+        build(reference, filepath + '.tmp')
+        os.rename(filepath + '.tmp', filepath)
+
+    if not os.path.exists(filepath):
+        _build_cache_file(cache_dir, filepath, build_file)
+
+    return filepath
+
+
+def read_chromosome_sizes(reference, chromosomes=default_chromosomes, cache_dir=None):
+    """
+    size and known (non N) size of the chromosomes, indexed by chromosome
+    """
+    cache_dir = get_reference_metadata(reference, cache_dir=cache_dir)
+
+    sizes = pd.read_csv(
+        os.path.join(cache_dir, SIZES_FILENAME), sep='\t', dtype={'chrom': str}
+    )
+    sizes = sizes.set_index('chrom')
+
+    return sizes[sizes.index.isin(chromosomes)]
+
+
+def get_known_chromosome_sizes(reference, chromosomes=default_chromosomes, cache_dir=None):
+    sizes = read_chromosome_sizes(reference, chromosomes=chromosomes, cache_dir=cache_dir)
+    return {chrom: int(size) for chrom, size in sizes['known_size'].items()}
+
+
+def get_callable_regions_bed(reference, cache_dir=None):
+    """
+    bed of the known (non N) bases of the reference
+    """
+    cache_dir = get_reference_metadata(reference, cache_dir=cache_dir)
+    return os.path.join(cache_dir, CALLABLE_BED_FILENAME)
+
+
+def get_uncallable_regions(reference, regions, cache_dir=None):
+    """
+    regions (chrom-start-end, 1-based inclusive) without any known bases
+    """
+    bed = pd.read_csv(
+        get_callable_regions_bed(reference, cache_dir=cache_dir), sep='\t',
+        header=None, names=['chrom', 'start', 'end'], dtype={'chrom': str}
+    )
+    bed = {chrom: (df['start'].values, df['end'].values) for chrom, df in bed.groupby('chrom')}
+
+    uncallable = []
+    for region in regions:
+        chrom, beg, end = region.rsplit('-', 2)
+        starts, ends = bed.get(chrom, (np.array([]), np.array([])))
+        # overlap of [beg - 1, end) with any interval
+        if not np.any((starts < int(end)) & (ends > int(beg) - 1)):
+            uncallable.append(region)
+
+    return uncallable
@@ -0,0 +1,349 @@
+'''
+Region planning from bam index statistics. The linear index of a bai
+file holds the file offset of the first read in every 16kb window, so
+the offset differences between consecutive windows give the bytes of
+reads in each window without reading the alignments themselves.
+'''
+from __future__ import division
+
+import collections
+import logging
+import math
+import struct
+
+import numpy as np
+import pysam
+import yaml
+from single_cell.utils import bgzfutils
+from single_cell.utils import pysamutils
+from single_cell.utils import refgenome
+
+# window size of the bai linear index
+LINEAR_INDEX_WINDOW = 2 ** 14
+
+# bin holding the per reference metadata in a bai file
+BAI_PSEUDO_BIN = 37450
+
+# runs of empty windows at least this long are left out of the regions
+MIN_GAP_WINDOWS = 64
+
+
+def read_bai_offsets(bai):
+    """
+    linear index of each reference in a bai file, as (offsets, end)
+    with the virtual file offset of the first read of each window
+    and the virtual offset of the end of the reference's reads
+    """
+    with open(bai, 'rb') as reader:
+        data = reader.read()
+
+    if data[:4] != b'BAI\x01':
+        raise ValueError('{} is not a bai file'.format(bai))
+
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    pos = 8
+
+    references = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+
+        ref_end = None
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            if bin_id == BAI_PSEUDO_BIN:
+                # offsets of the first and last read of the reference
+                ref_end = struct.unpack_from('<Q', data, pos + 8)[0]
+            pos += 16 * n_chunk
+
+        n_intv = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+        offsets = np.frombuffer(data, dtype='<u8', count=n_intv, offset=pos)
+        pos += 8 * n_intv
+
+        if ref_end is None:
+            ref_end = offsets[-1] if n_intv else 0
+
+        references.append((offsets, ref_end))
+
+    return references
+
+
+def get_compression_ratio(bam, virtual_offset):
+    """
+    compressed over uncompressed size of the bgzf block at virtual_offset
+    """
+    with open(bam, 'rb') as reader:
+        reader.seek(virtual_offset >> 16)
+        block = bgzfutils.read_block(reader)
+
+    if block is None:
+        return 1.0
+
+    raw, _ = block
+    uncompressed_size = struct.unpack('<I', raw[-4:])[0]
+    return len(raw) / max(uncompressed_size, 1)
+
+
+def get_covered_windows(offsets, ref_end):
+    """
+    windows of the linear index that hold reads, ie. where the offset of
+    the first read is below that of the next window
+    """
+    offsets = np.append(offsets, np.uint64(ref_end))
+    return offsets[1:] > offsets[:-1]
+
+
+def get_offset_mass(offsets, ref_end, compression_ratio):
+    """
+    approximate compressed bytes of reads in each window. a virtual
+    offset is the block start in the file and the position in the
+    uncompressed block, the latter is scaled by the compression ratio
+    so that windows within one block still get their share.
+    """
+    position = np.append(offsets, np.uint64(ref_end))
+    position = (position >> np.uint64(16)).astype(np.float64) + \
+        (position & np.uint64(0xffff)).astype(np.float64) * compression_ratio
+    mass = np.maximum(np.diff(position), 0)
+    # the scaled position can overshoot the start of the next block,
+    # windows with reads keep some mass so that they are not dropped
+    mass[(mass == 0) & get_covered_windows(offsets, ref_end)] = 1
+    return mass
+
+
+def get_window_mass(bams, chromosome_lengths, max_indexes=200):
+    """
+    read mass per window of each chromosome summed over the bam indexes.
+    with many bams (cell bams of a library) the mass is estimated from an
+    evenly spaced subset of max_indexes of them. the covered windows of all
+    bams keep some mass, so that no reads are left in the gaps of a plan.
+    """
+    bams = sorted(bams)
+    sampled = bams
+    if len(bams) > max_indexes:
+        step = len(bams) / max_indexes
+        sampled = [bams[int(i * step)] for i in range(max_indexes)]
+    sampled = set(sampled)
+
+    window_mass = {
+        chrom: np.zeros(int(math.ceil(length / LINEAR_INDEX_WINDOW)))
+        for chrom, length in chromosome_lengths.items()
+    }
+    covered = {chrom: np.zeros(len(mass), dtype=bool) for chrom, mass in window_mass.items()}
+
+    for bam in bams:
+        with pysam.AlignmentFile(bam, 'rb') as reader:
+            references = reader.references
+
+        bai_offsets = read_bai_offsets(bam + '.bai')
+
+        first_offsets = [offsets[0] for offsets, _ in bai_offsets if len(offsets)]
+        if not first_offsets:
+            continue
+
+        if bam in sampled:
+            compression_ratio = get_compression_ratio(bam, int(first_offsets[0]))
+
+        for chrom, (offsets, ref_end) in zip(references, bai_offsets):
+            if chrom not in window_mass or not len(offsets):
+                continue
+
+            if bam in sampled:
+                mass = get_offset_mass(offsets, ref_end, compression_ratio)
+                num_windows = min(len(mass), len(window_mass[chrom]))
+                window_mass[chrom][:num_windows] += mass[:num_windows]
+            else:
+                bam_covered = get_covered_windows(offsets, ref_end)
+                num_windows = min(len(bam_covered), len(covered[chrom]))
+                covered[chrom][:num_windows] |= bam_covered[:num_windows]
+
+    for chrom, mass in window_mass.items():
+        mass[(mass == 0) & covered[chrom]] = 1
+
+    return window_mass
+
+
+def get_covered_segments(mass, min_gap_windows=MIN_GAP_WINDOWS):
+    """
+    [start, end) window ranges with reads, split at runs of at least
+    min_gap_windows empty windows. segments are padded by one window
+    on each side so that reads reaching into an empty window are kept.
+    """
+    covered = np.flatnonzero(mass > 0)
+    if not len(covered):
+        return []
+
+    breaks = np.flatnonzero(np.diff(covered) > min_gap_windows)
+    starts = np.concatenate(([covered[0]], covered[breaks + 1]))
+    ends = np.concatenate((covered[breaks], [covered[-1]])) + 1
+
+    return [
+        (max(0, start - 1), min(len(mass), end + 1))
+        for start, end in zip(starts, ends)
+    ]
+
+
+def split_segment(mass, start, end, target_mass):
+    """
+    cut windows start to end into pieces of about target_mass each
+    """
+    segment_mass = mass[start:end]
+    num_pieces = max(1, int(round(segment_mass.sum() / target_mass)))
+
+    cumulative = np.cumsum(segment_mass)
+    cuts = [
+        start + int(np.searchsorted(cumulative, segment_mass.sum() * i / num_pieces)) + 1
+        for i in range(1, num_pieces)
+    ]
+
+    bounds = sorted(set([start] + [v for v in cuts if start < v < end] + [end]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def merge_empty_pieces(mass, pieces):
+    """
+    joins pieces without mass, the padding windows at the ends of a
+    segment, to the neighbouring piece
+    """
+    merged = []
+    for start, end in pieces:
+        if merged and (not mass[start:end].any() or not mass[merged[-1][0]:merged[-1][1]].any()):
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def plan_regions(window_mass, chromosome_lengths, num_regions, min_gap_windows=MIN_GAP_WINDOWS):
+    """
+    regions of about equal read mass, num_regions in total, that leave
+    out the long stretches without reads. returns (region, mass) pairs.
+    """
+    total_mass = sum(mass.sum() for mass in window_mass.values())
+    target_mass = total_mass / max(1, num_regions)
+
+    regions = []
+    for chrom, length in chromosome_lengths.items():
+        mass = window_mass[chrom]
+        for seg_start, seg_end in get_covered_segments(mass, min_gap_windows=min_gap_windows):
+            pieces = split_segment(mass, seg_start, seg_end, target_mass)
+            for start, end in merge_empty_pieces(mass, pieces):
+                region = '{}-{}-{}'.format(
+                    chrom, start * LINEAR_INDEX_WINDOW + 1, min(end * LINEAR_INDEX_WINDOW, length)
+                )
+                regions.append((region, int(mass[start:end].sum())))
+
+    return regions
+
+
+def write_region_plan(regions, output):
+    plan = [{'region': region, 'mass': mass} for region, mass in regions]
+    with open(output, 'wt') as writer:
+        yaml.dump({'regions': plan}, writer, default_flow_style=False)
+
+
+def load_region_plan(plan):
+    with open(plan, 'rt') as reader:
+        plan = yaml.safe_load(reader)
+    return [v['region'] for v in plan['regions']]
+
+
+def get_balanced_regions(bams, reference, split_size, chromosomes, plan_output):
+    """
+    plan regions with roughly equal read mass from the indexes of bams,
+    as many as fixed split_size windows would give (one per chromosome
+    without a split_size), and persist the plan to plan_output so that
+    other workflows can reuse the same regions. falls back to fixed
+    windows when the indexes hold no reads.
+    """
+    if isinstance(bams, str):
+        bams = [bams]
+    elif isinstance(bams, dict):
+        bams = list(bams.values())
+
+    chromosome_lengths = pysamutils.load_chromosome_lengths(reference, chromosomes=chromosomes)
+
+    if split_size is None:
+        split_size = max(chromosome_lengths.values())
+    num_regions = len(pysamutils.get_regions(chromosome_lengths, split_size))
+
+    window_mass = get_window_mass(bams, chromosome_lengths)
+
+    if any(mass.any() for mass in window_mass.values()):
+        regions = plan_regions(window_mass, chromosome_lengths, num_regions)
+    else:
+        regions = [(region, 0) for region in pysamutils.get_regions(chromosome_lengths, split_size)]
+
+    write_region_plan(regions, plan_output)
+
+    return [region for region, _ in regions]
+
+
+def get_region_coverage(bam, regions):
+    """
+    whether the bam has reads in each region, from the linear index of the
+    bam. the window before the region is included for reads that start
+    before it, so a region next to reads can be reported as covered.
+    """
+    with pysam.AlignmentFile(bam, 'rb') as reader:
+        references = reader.references
+
+    bai_offsets = dict(zip(references, read_bai_offsets(bam + '.bai')))
+
+    coverage = {}
+    for region in regions:
+        chrom, start, end = pysamutils.parse_region(region)
+
+        if chrom not in bai_offsets or not len(bai_offsets[chrom][0]):
+            coverage[region] = False
+            continue
+
+        covered = get_covered_windows(*bai_offsets[chrom])
+
+        first_window = max(0, start // LINEAR_INDEX_WINDOW - 1)
+        last_window = (end - 1) // LINEAR_INDEX_WINDOW
+        coverage[region] = bool(covered[first_window:last_window + 1].any())
+
+    return coverage
+
+
+def get_empty_regions(normal_bams, tumour_bams=None, regions=None, reference=None):
+    """
+    regions in which the normal or the tumour bam have no reads, from the
+    bam indexes. bams are a single bam or dicts of region to bam, as given
+    by a split. without tumour_bams only the normal is checked. regions
+    default to the keys of the dicts. with a reference, regions without
+    known (non N) bases in its cached metadata are empty too.
+    """
+    logger = logging.getLogger('single_cell.regionutils')
+
+    bam_sets = [bams for bams in (normal_bams, tumour_bams) if bams is not None]
+
+    if regions is None:
+        regions = list(next(bams for bams in bam_sets if isinstance(bams, dict)).keys())
+
+    empty_regions = set()
+    for bams in bam_sets:
+        if not isinstance(bams, dict):
+            bams = {region: bams for region in regions}
+
+        regions_by_bam = collections.defaultdict(list)
+        for region in regions:
+            regions_by_bam[bams[region]].append(region)
+
+        for bam, bam_regions in regions_by_bam.items():
+            coverage = get_region_coverage(bam, bam_regions)
+            empty_regions.update(region for region, covered in coverage.items() if not covered)
+
+    if reference is not None:
+        empty_regions.update(refgenome.get_uncallable_regions(reference, regions))
+
+    logger.info(
+        'skipping {} of {} regions without reads in the {}'.format(
+            len(empty_regions), len(regions),
+            'normal or tumour' if tumour_bams is not None else 'normal'
+        )
+    )
+
+    return sorted(empty_regions)
@@ -0,0 +1,114 @@
+'''
+Simulated bams for the tests of the bam processing steps.
+'''
+import random
+
+import pysam
+
+READ_LENGTH = 100
+
+
+def make_read(
+        header, query_name, reference_id, reference_start, flag=0,
+        cigarstring='100M', mapping_quality=60, query_sequence=None,
+        query_qualities=None
+):
+    read = pysam.AlignedSegment(header)
+    read.query_name = query_name
+    read.flag = flag
+    read.reference_id = reference_id
+    read.reference_start = reference_start
+    if not flag & 4:
+        read.mapping_quality = mapping_quality
+        read.cigarstring = cigarstring
+    read.query_sequence = query_sequence or 'A' * READ_LENGTH
+    read.query_qualities = query_qualities or [30] * READ_LENGTH
+    return read
+
+
+def simulate_bam(
+        filepath, lengths, num_pairs=2000, seed=0, positions=None,
+        reference_ids=None, start_margin=0, paired=True,
+        inserts=(120, 600), flag_rates=(), cigars=('100M',), mapping_qualities=(60,),
+        random_sequence=False, random_qualities=False, set_mates=False,
+        extra_reads=(), comments=None, index=True
+):
+    """
+    writes a coordinate sorted bam of simulated reads and returns the reads.
+
+    lengths is a list of (chrom, length). the reads start at positions, a list
+    of (reference_id, start), or at num_pairs random positions on reference_ids
+    (default all), at least start_margin and 1000 bases from the ends. paired reads
+    have a mate (flags 99 and 147) at an insert size drawn from inserts, set_mates
+    fills in the mate fields and the MC tag.
+    flag_rates is a list of (flag, rate), each flag is added to a pair with
+    probability rate. extra_reads are keyword arguments of make_read.
+    """
+    rand = random.Random(seed)
+
+    header = {
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': chrom, 'LN': length} for chrom, length in lengths],
+    }
+    if comments:
+        header['CO'] = list(comments)
+    header = pysam.AlignmentHeader.from_dict(header)
+
+    if reference_ids is None:
+        reference_ids = range(len(lengths))
+
+    if positions is None:
+        positions = []
+        for _ in range(num_pairs):
+            tid = rand.choice(reference_ids)
+            positions.append((tid, rand.randint(start_margin, lengths[tid][1] - 1000)))
+
+    def simulate_read(name, tid, pos, flag):
+        return make_read(
+            header, name, tid, pos, flag=flag,
+            cigarstring=rand.choice(cigars),
+            mapping_quality=rand.choice(mapping_qualities),
+            query_sequence=''.join(rand.choice('ACGT') for _ in range(READ_LENGTH)) if random_sequence else None,
+            query_qualities=[rand.randint(2, 40) for _ in range(READ_LENGTH)] if random_qualities else None,
+        )
+
+    reads = []
+    for i, (tid, pos) in enumerate(positions):
+        name = 'read{}'.format(i)
+        extra = 0
+        for flag, rate in flag_rates:
+            if rand.random() < rate:
+                extra |= flag
+
+        if not paired:
+            reads.append(simulate_read(name, tid, pos, extra))
+            continue
+
+        insert = rand.randint(*inserts)
+        mate_pos = pos + insert - READ_LENGTH
+        pair = [
+            simulate_read(name, tid, start, flag | extra)
+            for start, flag in ((pos, 99), (mate_pos, 147))
+        ]
+        if set_mates:
+            for read, mate, tlen in ((pair[0], pair[1], insert), (pair[1], pair[0], -insert)):
+                read.next_reference_id = tid
+                read.next_reference_start = mate.reference_start
+                read.template_length = tlen
+                read.set_tag('MC', mate.cigarstring)
+        reads.extend(pair)
+
+    for kwargs in extra_reads:
+        reads.append(make_read(header, **kwargs))
+
+    # unplaced unmapped reads go last
+    reads.sort(key=lambda r: (r.reference_id < 0, r.reference_id, r.reference_start))
+
+    with pysam.AlignmentFile(filepath, 'wb', header=header) as writer:
+        for read in reads:
+            writer.write(read)
+
+    if index:
+        pysam.index(filepath)
+
+    return reads
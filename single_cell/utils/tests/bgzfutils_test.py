@@ -0,0 +1,93 @@
+import hashlib
+import io
+import os
+
+import pysam
+import pytest
+from single_cell.utils import bamutils
+from single_cell.utils import bgzfutils
+from single_cell.utils.tests import bam_helpers
+
+
+LENGTHS = [(str(i), 1000000) for i in range(1, 23)]
+
+
+# unpaired reads on the first chromosome, and a header comment
+SIMULATION = dict(
+    reference_ids=[0], paired=False, random_sequence=True, random_qualities=True,
+    comments=['existing comment'], index=False,
+)
+
+
+def get_blocks(filepath):
+    blocks = []
+    with open(filepath, 'rb') as reader:
+        while True:
+            block = bgzfutils.read_block(reader)
+            if block is None:
+                break
+            blocks.append(block)
+    return blocks
+
+
+def record_blocks_md5(filepath):
+    # the blocks after the header, compressed bytes as they are on disk
+    blocks = get_blocks(filepath)
+
+    data = b''
+    for i, (_, cdata) in enumerate(blocks):
+        data += bgzfutils.decompress_block(cdata)
+        if bgzfutils.get_header_length(data) is not None:
+            break
+
+    md5 = hashlib.md5()
+    for raw, _ in blocks[i + 1:]:
+        md5.update(raw)
+    return md5.hexdigest()
+
+
+def read_records(filepath):
+    with pysam.AlignmentFile(filepath, 'rb', check_sq=False) as reader:
+        return [read.to_string() for read in reader.fetch(until_eof=True)]
+
+
+def test_add_comment_bam_header(tmpdir):
+    infile = os.path.join(str(tmpdir), 'in.bam')
+    outfile = os.path.join(str(tmpdir), 'out.bam')
+    bam_helpers.simulate_bam(infile, LENGTHS, num_pairs=5000, **SIMULATION)
+
+    bamutils.add_comment_bam_header(infile, outfile, 'new comment')
+
+    assert record_blocks_md5(infile) == record_blocks_md5(outfile)
+
+    with pysam.AlignmentFile(outfile, 'rb') as reader:
+        header = reader.header.to_dict()
+    assert header['CO'] == ['existing comment', 'new comment']
+    assert len(header['SQ']) == 22
+
+    assert read_records(infile) == read_records(outfile)
+
+
+def test_header_shares_block_with_records(tmpdir):
+    infile = os.path.join(str(tmpdir), 'in.bam')
+    packed = os.path.join(str(tmpdir), 'packed.bam')
+    outfile = os.path.join(str(tmpdir), 'out.bam')
+    bam_helpers.simulate_bam(infile, LENGTHS, num_pairs=200, **SIMULATION)
+
+    # recompress the whole bam into full blocks, so that the
+    # header and the first records end up in the same block
+    data = b''.join(bgzfutils.decompress_block(cdata) for _, cdata in get_blocks(infile))
+    with open(packed, 'wb') as writer:
+        bgzfutils.write_blocks(writer, data)
+        writer.write(bgzfutils.compress_block(b''))
+
+    bamutils.add_comment_bam_header(packed, outfile, 'new comment')
+
+    assert read_records(infile) == read_records(outfile)
+    with pysam.AlignmentFile(outfile, 'rb') as reader:
+        assert reader.header.to_dict()['CO'][-1] == 'new comment'
+
+
+def test_not_bgzf():
+    with pytest.raises(bgzfutils.BgzfException):
+        bgzfutils.read_block(io.BytesIO(b'@HD\tVN:1.6\n' * 10))
@@ -0,0 +1,64 @@
+'''
+benchmark of per cell bwa index loading against an index held in shared
+memory. aligns the same read pairs once per simulated cell, the way the
+alignment workflow runs one bwa mem per cell and lane.
+
+usage: python -m single_cell.utils.tests.bwa_benchmark reference fastq1 fastq2 [num_cells]
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from single_cell.utils import bamutils
+
+READGROUP = r'@RG\tID:benchmark\tSM:benchmark'
+
+
+def align_cells(reference, fastq1, fastq2, tempdir, num_cells):
+    for i in range(num_cells):
+        output = os.path.join(tempdir, 'cell{}.bam'.format(i))
+        bamutils.bwa_mem_paired_end_sorted(
+            fastq1, fastq2, output, os.path.join(tempdir, 'sort{}'.format(i)),
+            reference, READGROUP
+        )
+        os.remove(output)
+        os.remove(output + '.bai')
+
+
+def timeit(label, num_cells, func):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print('{:<40} {:>8.2f}s {:>8.2f}s/cell'.format(label, elapsed, elapsed / num_cells))
+
+
+def main(reference, fastq1, fastq2, num_cells):
+    tempdir = tempfile.mkdtemp()
+
+    loaded = False
+
+    try:
+        # an index already in shared memory is used by every bwa mem with
+        # the same prefix, and dropping it would drop every index on the node
+        if bamutils.bwa_shm_is_loaded(reference):
+            print('{} is already in shared memory, skipping the per cell index load'.format(reference))
+        else:
+            timeit('per cell index load', num_cells,
+                   lambda: align_cells(reference, fastq1, fastq2, tempdir, num_cells))
+
+            start = time.time()
+            loaded = bamutils.bwa_shm_load(reference)
+            print('{:<40} {:>8.2f}s'.format('bwa shm load', time.time() - start))
+
+        timeit('shared memory index', num_cells,
+               lambda: align_cells(reference, fastq1, fastq2, tempdir, num_cells))
+    finally:
+        if loaded:
+            bamutils.bwa_shm_drop()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 10)
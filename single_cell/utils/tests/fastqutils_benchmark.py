@@ -0,0 +1,70 @@
+'''
+throughput benchmark for the fastqutils readers on synthetic paired fastqs.
+
+usage: python -m single_cell.utils.tests.fastqutils_benchmark [num_reads]
+'''
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from itertools import islice
+
+from single_cell.utils import fastqutils
+
+
+def simulate_paired_fastqs(r1, r2, num_reads, genomes=('grch37', 'mm10', 'salmon')):
+    rand = random.Random(0)
+    seq = ''.join(rand.choice('ACGT') for _ in range(150))
+    qual = 'I' * 150
+    with gzip.open(r1, 'wt', compresslevel=1) as r1_out, gzip.open(r2, 'wt', compresslevel=1) as r2_out:
+        for i in range(num_reads):
+            flags = ''.join(str(rand.randint(0, 1)) for _ in genomes)
+            tag = ':'.join(genomes) + ':' + flags if i == 0 else flags
+            for read_end, writer in ((1, r1_out), (2, r2_out)):
+                writer.write('@HISEQ101_144:5:1101:{}:43220/{}#FQST:{}\n'.format(i, read_end, tag))
+                writer.write(seq + '\n+\n' + qual + '\n')
+
+
+def islice_read_iterator(filepath):
+    # the line based reader used before the block parser, kept as a reference point
+    with gzip.open(filepath, 'rt') as reader:
+        while True:
+            fastq_read = list(islice(reader, 4))
+            if not fastq_read:
+                break
+            yield fastq_read
+
+
+def timeit(label, num_reads, func):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print('{:<40} {:>8.2f}s {:>12.0f} reads/s'.format(label, elapsed, num_reads / elapsed))
+
+
+def main(num_reads):
+    tempdir = tempfile.mkdtemp()
+    try:
+        r1 = os.path.join(tempdir, 'R1.fastq.gz')
+        r2 = os.path.join(tempdir, 'R2.fastq.gz')
+        simulate_paired_fastqs(r1, r2, num_reads)
+
+        timeit('islice reader (R1)', num_reads, lambda: sum(1 for _ in islice_read_iterator(r1)))
+        timeit('FastqReader (R1)', num_reads,
+               lambda: sum(1 for _ in fastqutils.FastqReader(r1).get_read_iterator()))
+        timeit('PairedFastqReader', num_reads,
+               lambda: sum(1 for _ in fastqutils.PairedFastqReader(r1, r2).get_read_pair_iterator()))
+        timeit('PairedTaggedFastqReader.gather_counts', num_reads,
+               lambda: fastqutils.PairedTaggedFastqReader(r1, r2).gather_counts())
+        timeit('PairedTaggedFastqReader.filter', num_reads,
+               lambda: sum(1 for _ in fastqutils.PairedTaggedFastqReader(r1, r2).filter_read_iterator(
+                   ['grch37', 'mm10', 'salmon'], {'011'})))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
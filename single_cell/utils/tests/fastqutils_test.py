@@ -0,0 +1,122 @@
+import gzip
+import os
+import random
+
+import pytest
+from single_cell.utils import fastqutils
+
+
+def simulate_tagged_fastq(filepath, genomes, num_reads, read_end, seed=0):
+    rand = random.Random(seed)
+    with gzip.open(filepath, 'wt') as writer:
+        for i in range(num_reads):
+            flags = ''.join(str(rand.randint(0, 1)) for _ in genomes)
+            if i == 0:
+                tag = ':'.join(genomes) + ':' + flags
+            else:
+                tag = flags
+            length = rand.randint(20, 150)
+            seq = ''.join(rand.choice('ACGT') for _ in range(length))
+            writer.write('@READ{}/{}#FQST:{}\n'.format(i, read_end, tag))
+            writer.write(seq + '\n')
+            writer.write('+\n')
+            writer.write('I' * length + '\n')
+
+
+def naive_read_iterator(filepath):
+    with gzip.open(filepath, 'rt') as reader:
+        lines = reader.readlines()
+    for i in range(0, len(lines), 4):
+        yield lines[i:i + 4]
+
+
+@pytest.fixture
+def genomes():
+    return ['grch37', 'mm10', 'salmon']
+
+
+@pytest.fixture
+def paired_fastqs(tmpdir, genomes):
+    r1 = os.path.join(str(tmpdir), 'R1.fastq.gz')
+    r2 = os.path.join(str(tmpdir), 'R2.fastq.gz')
+    simulate_tagged_fastq(r1, genomes, 500, 1, seed=1)
+    simulate_tagged_fastq(r2, genomes, 500, 2, seed=2)
+    return r1, r2
+
+
+class TestFastqReader(object):
+
+    @pytest.mark.parametrize("block_size", [1, 7, 100, 4096, fastqutils.FASTQ_BLOCK_SIZE])
+    def test_block_sizes(self, paired_fastqs, block_size):
+        r1, _ = paired_fastqs
+        reader = fastqutils.FastqReader(r1, block_size=block_size)
+
+        assert list(reader.get_read_iterator()) == list(naive_read_iterator(r1))
+
+    def test_truncated_fastq(self, tmpdir):
+        fastq = os.path.join(str(tmpdir), 'truncated.fastq.gz')
+        with gzip.open(fastq, 'wt') as writer:
+            writer.write('@READ1\nACGT\n+\nIIII\n@READ2\nACGT\n')
+
+        reader = fastqutils.FastqReader(fastq, block_size=5)
+        with pytest.raises(AssertionError):
+            list(reader.get_read_iterator())
+
+    def test_bad_read_name(self, tmpdir):
+        fastq = os.path.join(str(tmpdir), 'bad.fastq.gz')
+        with gzip.open(fastq, 'wt') as writer:
+            writer.write('READ1\nACGT\n+\nIIII\n')
+
+        reader = fastqutils.FastqReader(fastq)
+        with pytest.raises(ValueError):
+            list(reader.get_read_iterator())
+
+    def test_read_name(self):
+        assert fastqutils._get_read_name('@READ1/1#FQST:a:b:10\n') == '@READ1'
+        assert fastqutils._get_read_name('@READ1#FQST:a:b:10\n') == '@READ1'
+        assert fastqutils._get_read_name('@READ1 1:N:0\n') == '@READ1'
+        assert fastqutils._get_read_name('@READ1\tFS:Z:a_1\n') == '@READ1'
+
+
+class TestTaggedFastqReader(object):
+
+    def test_gather_counts(self, paired_fastqs, genomes):
+        r1, r2 = paired_fastqs
+        reader = fastqutils.PairedTaggedFastqReader(r1, r2)
+        counts = reader.gather_counts()
+
+        for read_end, filepath in (('R1', r1), ('R2', r2)):
+            expected = {}
+            for read in naive_read_iterator(filepath):
+                flags = read[0].strip().split(':')[-1]
+                key = tuple(sorted(zip(genomes, [int(v) for v in flags])))
+                expected[key] = expected.get(key, 0) + 1
+
+            assert dict(counts[read_end]) == expected
+
+    def test_filter_read_iterator(self, paired_fastqs, genomes):
+        r1, r2 = paired_fastqs
+        filter_tags = {'001', '011'}
+
+        reader = fastqutils.PairedTaggedFastqReader(r1, r2)
+        filtered = list(reader.filter_read_iterator(genomes, filter_tags))
+
+        expected = []
+        for read_1, read_2 in zip(naive_read_iterator(r1), naive_read_iterator(r2)):
+            flags_1 = read_1[0].strip().split(':')[-1]
+            flags_2 = read_2[0].strip().split(':')[-1]
+            if flags_1 in filter_tags or flags_2 in filter_tags:
+                continue
+            expected.append((read_1, read_2))
+
+        assert filtered == expected
+
+    def test_add_tag_to_read_comment(self, paired_fastqs):
+        r1, _ = paired_fastqs
+        reader = fastqutils.TaggedFastqReader(r1)
+
+        read = next(reader.get_read_iterator())
+        flags = read[0].strip().split(':')[-1]
+        read = reader.add_tag_to_read_comment(read)
+
+        assert read[0] == '@READ0\tFS:Z:grch37_{},mm10_{},salmon_{}\n'.format(*flags)
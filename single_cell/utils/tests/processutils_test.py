@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+from single_cell.utils import helpers
+from single_cell.utils import processutils
+
+
+def read_report(tempdir):
+    with open(os.path.join(tempdir, 'resource_report.tsv')) as reader:
+        header = reader.readline().rstrip('\n').split('\t')
+        return [dict(zip(header, line.rstrip('\n').split('\t'))) for line in reader]
+
+
+def test_run_in_parallel(tmpdir):
+    tempdir = str(tmpdir)
+    outputs = [os.path.join(tempdir, 'out{}.txt'.format(i)) for i in range(6)]
+    commands = [['echo', i, '>', output] for i, output in enumerate(outputs)]
+
+    results = helpers.run_in_parallel(commands, os.path.join(tempdir, 'run'), ncores=3)
+
+    for i, output in enumerate(outputs):
+        with open(output) as reader:
+            assert reader.read() == '{}\n'.format(i)
+
+    assert [result.returncode for result in results] == [0] * 6
+    assert len(read_report(os.path.join(tempdir, 'run'))) == 6
+
+
+def test_bounded_concurrency(tmpdir):
+    tempdir = str(tmpdir)
+    helpers.run_in_parallel(['sleep 0.5'] * 4, tempdir, ncores=2)
+
+    intervals = [
+        (float(row['start_time']), float(row['start_time']) + float(row['wall_time']))
+        for row in read_report(tempdir)
+    ]
+
+    # the number of commands running when each one starts, wall
+    # times in the report are rounded to 10ms
+    running = [
+        sum(1 for other_start, other_end in intervals if other_start <= start < other_end - 0.01)
+        for start, _ in intervals
+    ]
+    assert max(running) == 2
+
+
+def test_resource_report(tmpdir):
+    tempdir = str(tmpdir)
+    # allocate about 100MB and burn some cpu
+    command = 'python -c "x = bytearray(100 * 1024 * 1024); sum(range(3000000))"'
+    result, = processutils.run_commands([command], tempdir)
+
+    assert result.max_rss > 90 * 1024
+    assert result.cpu_time > 0
+    assert result.wall_time >= result.cpu_time * 0.5
+
+    row, = read_report(tempdir)
+    assert int(row['max_rss_kb']) == result.max_rss
+
+
+def test_streamed_log(tmpdir):
+    tempdir = str(tmpdir)
+    result, = processutils.run_commands(['echo out; echo err >&2'], tempdir)
+    with open(result.log) as reader:
+        assert sorted(reader.read().split()) == ['err', 'out']
+
+
+def test_retries(tmpdir):
+    tempdir = str(tmpdir)
+    marker = os.path.join(tempdir, 'marker')
+    # fails on the first attempt only
+    command = 'if [ -e {0} ]; then exit 0; else touch {0}; exit 3; fi'.format(marker)
+
+    result, = processutils.run_commands([command], os.path.join(tempdir, 'run'), retries=1)
+    assert result.returncode == 0
+    assert result.attempts == 2
+
+
+def test_timeout_and_failure(tmpdir):
+    tempdir = str(tmpdir)
+    start = time.time()
+    with pytest.raises(processutils.CommandExecutionException) as excinfo:
+        processutils.run_commands(
+            ['sleep 30', 'echo failing; exit 2', 'true'], tempdir, timeout=1
+        )
+    assert time.time() - start < 10
+
+    message = str(excinfo.value)
+    assert '2 of 3 commands failed' in message
+    assert 'timed out' in message
+    assert 'failing' in message
+
+    rows = read_report(tempdir)
+    assert [row['returncode'] for row in rows] == ['-9', '2', '0']
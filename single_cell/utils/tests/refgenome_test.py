@@ -0,0 +1,97 @@
+import os
+import random
+
+import pysam
+import pytest
+from single_cell.utils import refgenome
+
+
+def simulate_sequence(rand, length):
+    # runs of N at the ends and in the middle, and lowercase bases
+    sequence = []
+    while len(sequence) < length:
+        base = rand.choice('ACGTacgtNN')
+        sequence.extend(base * rand.randint(1, 40))
+    sequence = ['N'] * 25 + sequence[:length - 50] + ['n'] * 25
+    return ''.join(sequence)
+
+
+def write_reference(filepath, sequences):
+    with open(filepath, 'wt') as writer:
+        for chrom, sequence in sequences.items():
+            writer.write('>{}\n'.format(chrom))
+            for i in range(0, len(sequence), 60):
+                writer.write(sequence[i:i + 60] + '\n')
+    pysam.faidx(filepath)
+    return filepath
+
+
+def naive_intervals(chrom, sequence):
+    intervals = []
+    for i, base in enumerate(sequence):
+        if base in 'Nn':
+            continue
+        if intervals and intervals[-1][2] == i:
+            intervals[-1] = (chrom, intervals[-1][1], i + 1)
+        else:
+            intervals.append((chrom, i, i + 1))
+    return intervals
+
+
+@pytest.fixture
+def reference(tmpdir):
+    rand = random.Random(0)
+    sequences = {
+        '1': simulate_sequence(rand, 5000),
+        '2': simulate_sequence(rand, 3001),
+        'X': 'N' * 1000,
+    }
+    refdir = os.path.join(str(tmpdir), 'ref')
+    os.makedirs(refdir)
+    return write_reference(os.path.join(refdir, 'genome.fa'), sequences), sequences
+
+
+def test_reference_metadata(reference, monkeypatch):
+    reference, sequences = reference
+    # small chunks, so that runs of bases span chunks
+    monkeypatch.setattr(refgenome, 'SCAN_CHUNK_SIZE', 97)
+
+    sizes = refgenome.read_chromosome_sizes(reference, chromosomes=['1', '2', 'X', 'Y'])
+
+    assert list(sizes.index) == ['1', '2', 'X']
+    for chrom, sequence in sequences.items():
+        assert sizes.loc[chrom, 'size'] == len(sequence)
+        assert sizes.loc[chrom, 'known_size'] == sum(v not in 'Nn' for v in sequence)
+
+    with open(refgenome.get_callable_regions_bed(reference)) as reader:
+        bed = [tuple(line.split()) for line in reader]
+
+    expected = []
+    for chrom, sequence in sequences.items():
+        expected.extend(naive_intervals(chrom, sequence))
+    assert bed == [tuple(map(str, v)) for v in expected]
+
+
+def test_reference_metadata_cached(reference, monkeypatch):
+    reference, sequences = reference
+
+    sizes = refgenome.get_known_chromosome_sizes(reference, chromosomes=['1', '2'])
+
+    def fail_build(*args, **kwargs):
+        raise AssertionError('cached metadata was built again')
+
+    monkeypatch.setattr(refgenome, 'build_reference_metadata', fail_build)
+    assert refgenome.get_known_chromosome_sizes(reference, chromosomes=['1', '2']) == sizes
+
+    # a changed reference has a different key
+    monkeypatch.undo()
+    sequences['2'] = sequences['2'] + 'ACGT'
+    write_reference(reference, sequences)
+    assert refgenome.get_known_chromosome_sizes(reference, chromosomes=['2'])['2'] == sizes['2'] + 4
+
+
+def test_get_uncallable_regions(reference):
+    reference, _ = reference
+
+    regions = ['1-1-25', '1-1-26', '1-4976-5000', '1-2000-3000', 'X-1-1000', '2-1-3001', 'Y-1-100']
+    assert refgenome.get_uncallable_regions(reference, regions) == ['1-1-25', '1-4976-5000', 'X-1-1000', 'Y-1-100']
@@ -0,0 +1,204 @@
+import os
+import random
+
+import numpy as np
+import pysam
+from single_cell.utils import pysamutils
+from single_cell.utils import regionutils
+from single_cell.utils.tests import bam_helpers
+
+WINDOW = regionutils.LINEAR_INDEX_WINDOW
+
+
+def write_reference(filepath, lengths):
+    with open(filepath, 'wt') as writer:
+        for chrom, length in lengths:
+            writer.write('>{}\n{}\n'.format(chrom, 'A' * length))
+    pysam.faidx(filepath)
+
+
+def get_positions(lengths, density, seed=0):
+    """
+    read starts of a density, which maps chrom to a list of
+    (start, end, reads per window)
+    """
+    rand = random.Random(seed)
+
+    positions = []
+    for tid, (chrom, length) in enumerate(lengths):
+        for start, end, per_window in density.get(chrom, []):
+            for _ in range(int((end - start) / WINDOW * per_window)):
+                positions.append((tid, rand.randint(start, min(end, length) - 100)))
+
+    return positions
+
+
+def simulate_density_bam(filepath, lengths, density, seed=0):
+    return bam_helpers.simulate_bam(
+        filepath, lengths, positions=get_positions(lengths, density, seed=seed),
+        paired=False, random_sequence=True
+    )
+
+
+def test_get_balanced_regions(tmpdir):
+    tmpdir = str(tmpdir)
+    lengths = [('1', 300 * WINDOW), ('2', 200 * WINDOW), ('3', 50 * WINDOW)]
+    reference = os.path.join(tmpdir, 'ref.fa')
+    write_reference(reference, lengths)
+
+    # dense start of chromosome 1, a long gap, sparse ends and nothing on chromosome 3
+    density = {
+        '1': [(0, 60 * WINDOW, 200), (200 * WINDOW, 300 * WINDOW, 20)],
+        '2': [(0, 200 * WINDOW, 20)],
+    }
+    bamfile = os.path.join(tmpdir, 'input.bam')
+    reads = simulate_density_bam(bamfile, lengths, density)
+
+    plan = os.path.join(tmpdir, 'plan.yaml')
+    regions = regionutils.get_balanced_regions(
+        [bamfile], reference, 50 * WINDOW, ['1', '2', '3'], plan
+    )
+
+    assert regionutils.load_region_plan(plan) == regions
+
+    parsed = [pysamutils.parse_region(region) for region in regions]
+
+    # nothing planned on the empty chromosome or in the gap
+    assert not [v for v in parsed if v[0] == '3']
+    assert not [v for v in parsed if v[0] == '1' and v[1] < 150 * WINDOW < v[2]]
+
+    # every read is in a region
+    for read in reads:
+        assert any(
+            chrom == read.reference_name and start <= read.reference_start < end
+            for chrom, start, end in parsed
+        )
+
+    # the read counts of the regions are much closer than fixed windows would give
+    counts = [
+        sum(1 for read in reads if read.reference_name == chrom and start <= read.reference_start < end)
+        for chrom, start, end in parsed
+    ]
+    fixed_counts = [
+        sum(1 for read in reads if read.reference_name == chrom and start <= read.reference_start < end)
+        for chrom, start, end in (
+            pysamutils.parse_region(region) for region in
+            pysamutils.get_regions(pysamutils.load_chromosome_lengths(reference), 50 * WINDOW)
+        )
+    ]
+    assert np.std(counts) < np.std(fixed_counts) / 2
+
+
+def test_get_window_mass_unsampled_gap(tmpdir):
+    tmpdir = str(tmpdir)
+    lengths = [('1', 200 * WINDOW)]
+
+    bams = []
+    for i in range(4):
+        bams.append(os.path.join(tmpdir, 'cell{}.bam'.format(i)))
+        simulate_density_bam(bams[-1], lengths, {'1': [(0, 50 * WINDOW, 20)]}, seed=i)
+
+    # only cell0 and cell2 are sampled, cell3 has reads in the gap of the others
+    reads = simulate_density_bam(
+        bams[3], lengths, {'1': [(0, 50 * WINDOW, 20), (120 * WINDOW, 125 * WINDOW, 5)]}, seed=3
+    )
+
+    window_mass = regionutils.get_window_mass(bams, dict(lengths), max_indexes=2)
+    assert window_mass['1'][120:125].all()
+
+    regions = regionutils.plan_regions(window_mass, dict(lengths), 4)
+    parsed = [pysamutils.parse_region(region) for region, _ in regions]
+    for read in reads:
+        assert any(start <= read.reference_start < end for _, start, end in parsed)
+
+
+def test_split_segment():
+    mass = np.array([10, 0, 0, 10, 10, 10, 0, 10])
+    pieces = regionutils.split_segment(mass, 0, len(mass), 20)
+    # cut at the window that brings the first piece to half the mass
+    assert pieces == [(0, 5), (5, 8)]
+    assert [mass[start:end].sum() for start, end in pieces] == [30, 20]
+
+
+def test_plan_regions_without_empty_pieces():
+    # the padding window after the reads would be a piece of its own
+    window_mass = {'1': np.array([0, 30, 0, 0, 0]), '2': np.array([0, 0, 0, 10, 10])}
+    lengths = {'1': 5 * WINDOW, '2': 5 * WINDOW - 100}
+
+    assert regionutils.split_segment(window_mass['1'], 0, 3, 10) == [(0, 2), (2, 3)]
+
+    regions = regionutils.plan_regions(window_mass, lengths, 5)
+    assert regions == [
+        ('1-1-{}'.format(3 * WINDOW), 30),
+        ('2-{}-{}'.format(2 * WINDOW + 1, 4 * WINDOW), 10),
+        ('2-{}-{}'.format(4 * WINDOW + 1, 5 * WINDOW - 100), 10),
+    ]
+
+
+def test_get_offset_mass():
+    # the within block offset of the first window, scaled by the
+    # compression ratio, overshoots the start of the next block
+    offsets = np.array([0xf000, 1000 << 16, 1000 << 16], dtype=np.uint64)
+    mass = regionutils.get_offset_mass(offsets, 3000 << 16, 1.0)
+
+    assert list(mass) == [1, 0, 2000]
+
+
+def test_get_empty_regions(tmpdir):
+    tmpdir = str(tmpdir)
+    lengths = [('1', 300 * WINDOW), ('2', 100 * WINDOW), ('3', 50 * WINDOW)]
+
+    normal = os.path.join(tmpdir, 'normal.bam')
+    simulate_density_bam(normal, lengths, {'1': [(0, 300 * WINDOW, 2)], '2': [(0, 100 * WINDOW, 2)]})
+
+    # sparse tumour, with a chromosome holding a single read
+    tumour = os.path.join(tmpdir, 'tumour.bam')
+    simulate_density_bam(tumour, lengths, {
+        '1': [(0, 60 * WINDOW, 3), (200 * WINDOW, 300 * WINDOW, 1)],
+        '2': [(10 * WINDOW, 11 * WINDOW, 1)],
+    }, seed=1)
+
+    rand = random.Random(2)
+    regions = []
+    for _ in range(1000):
+        chrom, length = rand.choice(lengths)
+        start = rand.randint(0, length - 2)
+        end = min(length, start + rand.choice([100, WINDOW, 10 * WINDOW]))
+        regions.append('{}-{}-{}'.format(chrom, start + 1, end))
+
+    empty = set(regionutils.get_empty_regions(normal, tumour, regions=regions))
+    empty_normal = set(regionutils.get_empty_regions(normal, regions=regions))
+
+    with pysam.AlignmentFile(normal) as normal_reader, pysam.AlignmentFile(tumour) as tumour_reader:
+        def has_reads(reader, region):
+            return reader.count(*pysamutils.parse_region(region)) > 0
+
+        truly_empty = set(
+            region for region in regions
+            if not has_reads(normal_reader, region) or not has_reads(tumour_reader, region)
+        )
+        normal_empty = set(region for region in regions if not has_reads(normal_reader, region))
+
+    # never skips a region with reads in both, and finds most of those without
+    assert empty <= truly_empty
+    assert len(empty) > 0.8 * len(truly_empty)
+    # the normal alone skips fewer regions, never one with normal reads
+    assert empty_normal <= normal_empty
+    assert empty_normal < empty
+    # nothing on chromosome 3 in either bam
+    assert all(v in empty for v in regions if v.startswith('3-'))
+
+
+def test_get_empty_regions_split_bams(tmpdir):
+    tmpdir = str(tmpdir)
+    lengths = [('1', 100 * WINDOW)]
+    regions = ['1-1-{}'.format(50 * WINDOW), '1-{}-{}'.format(50 * WINDOW + 1, 100 * WINDOW)]
+
+    bams = {}
+    for i, region in enumerate(regions):
+        _, start, end = pysamutils.parse_region(region)
+        density = {'1': [(start, end, 2)]} if i == 0 else {}
+        bams[region] = os.path.join(tmpdir, 'region{}.bam'.format(i))
+        simulate_density_bam(bams[region], lengths, density)
+
+    assert regionutils.get_empty_regions(bams, bams) == [regions[1]]
@@ -0,0 +1,92 @@
+'''
+benchmark for MultiVcfReader on many region vcfs, against the previous
+merge that scanned every open input for the minimum position at each step.
+
+usage: python -m single_cell.utils.tests.vcfmergeutils_benchmark [num_regions] [records_per_region]
+'''
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pysam
+from single_cell.utils import vcfmergeutils
+
+CHROMS = [str(v) for v in range(1, 23)] + ['X', 'Y']
+
+REGION_SIZE = 10000000
+
+
+def simulate_region_vcfs(tempdir, num_regions, records_per_region, seed=0):
+    rand = random.Random(seed)
+    vcf_files = []
+    for i in range(num_regions):
+        chrom = CHROMS[i * len(CHROMS) // num_regions]
+        start = (i % max(1, num_regions // len(CHROMS))) * REGION_SIZE
+        positions = sorted(rand.sample(range(start + 1, start + REGION_SIZE), records_per_region))
+
+        filepath = os.path.join(tempdir, 'region{}.vcf'.format(i))
+        with open(filepath, 'wt') as writer:
+            writer.write('##fileformat=VCFv4.1\n')
+            writer.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            for pos in positions:
+                writer.write('{}\t{}\t.\tA\tC,G\t.\tPASS\t.\n'.format(chrom, pos))
+        vcf_files.append(pysam.tabix_index(filepath, preset='vcf', force=True))
+    return vcf_files
+
+
+def min_scan_merge(vcf_files):
+    # the merge MultiVcfReader used before the heap, kept as a reference point
+    readers = [pysam.TabixFile(v, parser=pysam.asVCF()) for v in vcf_files]
+    chroms = sorted(set(c for r in readers for c in r.contigs), key=vcfmergeutils.get_chrom_order)
+
+    for chrom in chroms:
+        iters = [vcfmergeutils.iter_chrom_records(r.fetch(chrom)) for r in readers if chrom in r.contigs]
+        heads = [next(it, None) for it in iters]
+
+        while any(head is not None for head in heads):
+            min_coord = min(head[0] for head in heads if head is not None)
+            pos_buffer = set()
+            for i, it in enumerate(iters):
+                while heads[i] is not None and heads[i][0] == min_coord:
+                    pos_buffer.add(heads[i][1])
+                    heads[i] = next(it, None)
+            for record in sorted(pos_buffer, key=lambda x: (x.ref, x.alt)):
+                yield record
+
+    for reader in readers:
+        reader.close()
+
+
+def timeit(label, func):
+    start = time.time()
+    count = func()
+    elapsed = time.time() - start
+    print('{:<40} {:>8.2f}s {:>12.0f} records/s'.format(label, elapsed, count / elapsed))
+
+
+def main(num_regions, records_per_region):
+    tempdir = tempfile.mkdtemp()
+    try:
+        vcf_files = simulate_region_vcfs(tempdir, num_regions, records_per_region)
+
+        timeit('min scan merge', lambda: sum(1 for _ in min_scan_merge(vcf_files)))
+
+        def heap_merge():
+            reader = vcfmergeutils.MultiVcfReader(vcf_files)
+            count = sum(1 for _ in reader)
+            reader.close()
+            return count
+
+        timeit('MultiVcfReader (heap)', heap_merge)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 300,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+    )
@@ -0,0 +1,96 @@
+import os
+import random
+
+import pysam
+from single_cell.utils import vcfmergeutils
+
+CHROMS = ['1', '2', '10', 'X', 'MT', 'GL000192.1']
+
+
+def write_vcf(filepath, records):
+    """
+    records are (chrom, pos, ref, alt), written in the chromosome
+    order of CHROMS. returns the path of the bgzipped, indexed vcf
+    """
+    records = sorted(records, key=lambda x: (CHROMS.index(x[0]), x[1]))
+    with open(filepath, 'wt') as writer:
+        writer.write('##fileformat=VCFv4.1\n')
+        for chrom in CHROMS:
+            writer.write('##contig=<ID={}>\n'.format(chrom))
+        writer.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, pos, ref, alt in records:
+            writer.write('{}\t{}\t.\t{}\t{}\t.\tPASS\t.\n'.format(chrom, pos, ref, alt))
+    return pysam.tabix_index(filepath, preset='vcf', force=True)
+
+
+def simulate_vcfs(tmpdir, num_files, num_records, seed=0):
+    rand = random.Random(seed)
+    # a small set of positions, so that files share positions and records
+    positions = [(rand.choice(CHROMS), rand.randint(1, 2000)) for _ in range(num_records)]
+
+    all_records = []
+    vcf_files = []
+    for i in range(num_files):
+        records = []
+        for chrom, pos in rand.sample(positions, num_records // 2):
+            ref = rand.choice('ACGT')
+            alt = ','.join(rand.sample([v for v in 'ACGT' if v != ref], rand.randint(1, 2)))
+            records.append((chrom, pos, ref, alt))
+        all_records.extend(records)
+        vcf_files.append(write_vcf(os.path.join(tmpdir, 'input{}.vcf'.format(i)), records))
+
+    return vcf_files, all_records
+
+
+def naive_merge(records):
+    merged = set()
+    for chrom, pos, ref, alt in records:
+        for allele in alt.split(','):
+            merged.add(vcfmergeutils.LightVCFRecord(chrom, pos, ref, allele))
+    return sorted(merged, key=lambda x: (vcfmergeutils.get_chrom_order(x.chrom), x.coord, x.ref, x.alt))
+
+
+def test_multi_vcf_reader(tmpdir):
+    vcf_files, records = simulate_vcfs(str(tmpdir), 10, 300)
+
+    reader = vcfmergeutils.MultiVcfReader(vcf_files)
+    merged = list(reader)
+    reader.close()
+
+    assert merged == naive_merge(records)
+
+
+def test_iter_positions(tmpdir):
+    vcf_files, records = simulate_vcfs(str(tmpdir), 5, 100, seed=1)
+
+    reader = vcfmergeutils.MultiVcfReader(vcf_files)
+    positions = list(reader.iter_positions())
+    reader.close()
+
+    keys = [(vcfmergeutils.get_chrom_order(chrom), coord) for chrom, coord, _ in positions]
+    assert keys == sorted(set(keys))
+
+    for chrom, coord, position_records in positions:
+        assert position_records
+        assert all(v.chrom == chrom and v.coord == coord for v in position_records)
+
+
+def test_merge_vcfs(tmpdir):
+    tmpdir = str(tmpdir)
+    vcf_files, records = simulate_vcfs(tmpdir, 3, 50, seed=2)
+    # an input without records
+    vcf_files.append(write_vcf(os.path.join(tmpdir, 'empty.vcf'), []))
+
+    output = os.path.join(tmpdir, 'merged.vcf')
+    vcfmergeutils.merge_vcfs(vcf_files, output)
+
+    with open(output) as reader:
+        lines = [line.rstrip('\n').split('\t') for line in reader if not line.startswith('#')]
+
+    expected = naive_merge(records)
+    assert [(v[0], int(v[1]), v[3], v[4]) for v in lines] == [tuple(v) for v in expected]
+
+
+def test_get_chrom_order():
+    chroms = ['GL000192.1', 'chrX', 'MT', '10', 'chr2', '1', 'Y']
+    assert sorted(chroms, key=vcfmergeutils.get_chrom_order) == ['1', 'chr2', '10', 'chrX', 'Y', 'MT', 'GL000192.1']
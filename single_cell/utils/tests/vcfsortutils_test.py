@@ -0,0 +1,185 @@
+import gzip
+import os
+import random
+
+import pysam
+import pytest
+from single_cell.utils import vcfsortutils
+
+CHROMS = ['1', '2', '10', 'X']
+
+HEADER = ['##fileformat=VCFv4.1'] + ['##contig=<ID={}>'.format(v) for v in CHROMS] + \
+         ['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+
+
+def simulate_records(rand, num_records, chroms=CHROMS):
+    records = []
+    for _ in range(num_records):
+        chrom = rand.choice(chroms)
+        records.append((chrom, rand.randint(1, 100000), rand.choice('ACGT')))
+    return records
+
+
+def format_record(record):
+    chrom, pos, ref = record
+    return '{}\t{}\t.\t{}\tN\t.\tPASS\t.'.format(chrom, pos, ref)
+
+
+def write_vcf(filepath, records, header=HEADER):
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'wt') as writer:
+        for line in header:
+            writer.write(line + '\n')
+        for record in records:
+            writer.write(format_record(record) + '\n')
+    return filepath
+
+
+def read_vcf(filepath):
+    with gzip.open(filepath, 'rt') as reader:
+        lines = [line.rstrip('\n') for line in reader]
+    return [v for v in lines if v.startswith('#')], [v for v in lines if not v.startswith('#')]
+
+
+def sort_records(records):
+    # stable, so records at the same position keep their input order
+    return sorted(records, key=lambda v: (CHROMS.index(v[0]), v[1]))
+
+
+def check_indexes(filepath, records):
+    assert os.path.exists(filepath + '.tbi')
+    assert os.path.exists(filepath + '.csi')
+
+    tabix = pysam.TabixFile(filepath)
+    for chrom in CHROMS:
+        fetched = list(tabix.fetch(chrom, 20000, 60000))
+        expected = [
+            format_record(v) for v in records
+            if v[0] == chrom and 20000 < v[1] <= 60000
+        ]
+        assert fetched == expected
+    tabix.close()
+
+
+@pytest.mark.parametrize('sort_buffer_size', [None, 100])
+def test_finalise_unsorted(tmpdir, sort_buffer_size):
+    tmpdir = str(tmpdir)
+    records = simulate_records(random.Random(0), 2000)
+    in_file = write_vcf(os.path.join(tmpdir, 'in.vcf'), records)
+
+    out_file = os.path.join(tmpdir, 'out.vcf.gz')
+    vcfsortutils.finalise_vcf(
+        in_file, out_file, tempdir=os.path.join(tmpdir, 'temp'), sort_buffer_size=sort_buffer_size
+    )
+
+    header, lines = read_vcf(out_file)
+    assert header == HEADER
+    assert lines == [format_record(v) for v in sort_records(records)]
+    check_indexes(out_file, sort_records(records))
+
+
+def test_finalise_sorted_skips_sort(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    # chromosomes only need to be contiguous, not in header order
+    records = sorted(simulate_records(random.Random(1), 2000), key=lambda v: (v[0] == '1', v[0], v[1]))
+    in_file = write_vcf(os.path.join(tmpdir, 'in.vcf.gz'), records)
+
+    def fail_sort(*args, **kwargs):
+        raise AssertionError('sorted input was sorted again')
+
+    monkeypatch.setattr(vcfsortutils, 'sort_records', fail_sort)
+
+    out_file = os.path.join(tmpdir, 'out.vcf.gz')
+    vcfsortutils.finalise_vcf(in_file, out_file)
+
+    _, lines = read_vcf(out_file)
+    assert lines == [format_record(v) for v in records]
+    assert sorted(os.listdir(tmpdir)) == ['in.vcf.gz', 'out.vcf.gz', 'out.vcf.gz.csi', 'out.vcf.gz.tbi']
+
+
+def test_unsorted_after_write_buffer(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    monkeypatch.setattr(vcfsortutils, 'WRITE_BUFFER_RECORDS', 7)
+
+    records = sort_records(simulate_records(random.Random(2), 1000))
+    # a single record out of place, after some records have been written
+    records.insert(500, records.pop(20))
+    in_file = write_vcf(os.path.join(tmpdir, 'in.vcf'), records)
+
+    out_file = os.path.join(tmpdir, 'out.vcf.gz')
+    vcfsortutils.finalise_vcf(in_file, out_file)
+
+    _, lines = read_vcf(out_file)
+    assert lines == [format_record(v) for v in sort_records(records)]
+
+
+def test_concatenate_regions(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    rand = random.Random(3)
+
+    # region keys that sort lexicographically out of genomic order
+    in_files = {}
+    all_records = []
+    for chrom in CHROMS:
+        for start in (1, 20001, 100001):
+            key = '{}-{}-{}'.format(chrom, start, start + 19999)
+            records = sorted(
+                (chrom, rand.randint(start, start + 19999), rand.choice('ACGT')) for _ in range(50)
+            )
+            all_records.extend(records)
+            in_files[key] = write_vcf(os.path.join(tmpdir, key + '.vcf'), records)
+
+    # header only and empty inputs
+    in_files['X-200001-220000'] = write_vcf(os.path.join(tmpdir, 'header_only.vcf'), [])
+    in_files['X-220001-240000'] = os.path.join(tmpdir, 'empty.vcf')
+    open(in_files['X-220001-240000'], 'w').close()
+
+    def fail_sort(*args, **kwargs):
+        raise AssertionError('regions in order were sorted')
+
+    monkeypatch.setattr(vcfsortutils, 'sort_records', fail_sort)
+
+    out_file = os.path.join(tmpdir, 'merged.vcf.gz')
+    vcfsortutils.concatenate_vcf(in_files, out_file)
+
+    header, lines = read_vcf(out_file)
+    assert header == HEADER
+    assert lines == [format_record(v) for v in sort_records(all_records)]
+    check_indexes(out_file, sort_records(all_records))
+
+
+def test_concatenate_overlapping(tmpdir):
+    tmpdir = str(tmpdir)
+    rand = random.Random(4)
+
+    in_files = []
+    all_records = []
+    for i in range(4):
+        records = sort_records(simulate_records(rand, 300))
+        all_records.extend(records)
+        in_files.append(write_vcf(os.path.join(tmpdir, 'in{}.vcf.gz'.format(i)), records))
+
+    out_file = os.path.join(tmpdir, 'merged.vcf.gz')
+    vcfsortutils.concatenate_vcf(in_files, out_file, sort_buffer_size=250)
+
+    _, lines = read_vcf(out_file)
+    assert sorted(lines) == sorted(format_record(v) for v in all_records)
+    assert [tuple(v.split('\t')[:2]) for v in lines] == \
+           [(v[0], str(v[1])) for v in sort_records(all_records)]
+
+
+def test_concatenate_skipped_regions(tmpdir):
+    tmpdir = str(tmpdir)
+    records = sort_records(simulate_records(random.Random(5), 100, chroms=['2']))
+
+    # the skipped region sorts first, its bare header is not used
+    in_files = {'1-1-100000': os.path.join(tmpdir, 'skipped.vcf')}
+    vcfsortutils.write_empty_vcf(in_files['1-1-100000'])
+    in_files['2-1-100000'] = write_vcf(os.path.join(tmpdir, 'called.vcf'), records)
+
+    out_file = os.path.join(tmpdir, 'merged.vcf.gz')
+    vcfsortutils.concatenate_vcf(in_files, out_file)
+
+    header, lines = read_vcf(out_file)
+    assert header == HEADER
+    assert lines == [format_record(v) for v in records]
@@ -0,0 +1,100 @@
+import os
+import random
+
+import pandas as pd
+from single_cell.utils import csvutils
+from single_cell.utils import vcftableutils
+
+HEADER = [
+    '##fileformat=VCFv4.1',
+    '##INFO=<ID=QSS,Number=1,Type=Integer,Description="Quality score">',
+    '##contig=<ID=1>',
+    '##contig=<ID=2>',
+    '##contig=<ID=X>',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO',
+]
+
+
+def write_vcf(filepath, num_records, seed=0):
+    """
+    returns the expected (chrom, coord, ref, alt, qss) rows
+    """
+    rand = random.Random(seed)
+    rows = []
+    with open(filepath, 'wt') as writer:
+        writer.write('\n'.join(HEADER) + '\n')
+        for chrom in ['1', '2', 'X']:
+            for pos in sorted(rand.sample(range(1, 100000), num_records // 3)):
+                ref = rand.choice(['A', 'C', 'G', 'T', 'AT'])
+                alts = rand.sample(['A', 'C', 'G', 'T', 'GTC'], rand.randint(1, 2))
+                alts = [v for v in alts if v != ref] or ['N']
+                qss = rand.randint(0, 60)
+                writer.write('{}\t{}\t.\t{}\t{}\t{}\tPASS\tQSS={}\n'.format(
+                    chrom, pos, ref, ','.join(alts), qss * 2, qss
+                ))
+                rows.extend((chrom, pos, ref, alt, qss) for alt in alts)
+    return rows
+
+
+def qss_callback(record):
+    return record.info['QSS']
+
+
+def test_decoded_chunks(tmpdir):
+    tmpdir = str(tmpdir)
+    vcf_file = os.path.join(tmpdir, 'input.vcf')
+    rows = write_vcf(vcf_file, 3000)
+
+    chunk_files, encoders = vcftableutils.encode_chunks(
+        vcf_file, os.path.join(tmpdir, 'chunks'), chunk_size=250
+    )
+    assert len(chunk_files) > 1
+
+    chunks = list(vcftableutils.iter_decoded_chunks(chunk_files, encoders))
+    df = pd.concat(chunks)
+
+    assert list(df.index) == list(range(len(rows)))
+    assert list(df.columns) == vcftableutils.TABLE_COLUMNS
+
+    # the categories of every chunk are those of the whole file, as the
+    # previous two pass conversion collected them
+    for column, values in (('chrom', [v[0] for v in rows]), ('ref', [v[2] for v in rows]),
+                           ('alt', [v[3] for v in rows])):
+        for chunk in chunks:
+            assert list(chunk[column].cat.categories) == sorted(set(values))
+        assert list(df[column].astype(str)) == values
+
+    assert list(df['coord']) == [v[1] for v in rows]
+    # QUAL is the default score
+    assert list(df['score']) == [v[4] * 2 for v in rows]
+
+
+def test_convert_vcf_to_csv(tmpdir):
+    tmpdir = str(tmpdir)
+    vcf_file = os.path.join(tmpdir, 'input.vcf')
+    rows = write_vcf(vcf_file, 900, seed=1)
+
+    dtypes = {'chrom': 'str', 'coord': 'int', 'ref': 'str', 'alt': 'str', 'score': 'int'}
+    out_file = os.path.join(tmpdir, 'output.csv.gz')
+    vcftableutils.convert_vcf_to_csv(
+        vcf_file, out_file, dtypes, score_callback=qss_callback, chunk_size=100
+    )
+
+    df = csvutils.CsvInput(out_file).read_csv()
+
+    assert list(df.columns) == vcftableutils.TABLE_COLUMNS
+    assert [tuple(v) for v in df.itertuples(index=False)] == rows
+
+
+def test_convert_empty_vcf_to_csv(tmpdir):
+    tmpdir = str(tmpdir)
+    vcf_file = os.path.join(tmpdir, 'input.vcf')
+    write_vcf(vcf_file, 0)
+
+    dtypes = {'chrom': 'str', 'coord': 'int', 'ref': 'str', 'alt': 'str', 'score': 'float'}
+    out_file = os.path.join(tmpdir, 'output.csv.gz')
+    vcftableutils.convert_vcf_to_csv(vcf_file, out_file, dtypes)
+
+    df = csvutils.CsvInput(out_file).read_csv()
+    assert list(df.columns) == vcftableutils.TABLE_COLUMNS
+    assert len(df) == 0
@@ -0,0 +1,140 @@
+'''
+Created on Nov 20, 2015
+
+@author: Andrew Roth
+'''
+import csv
+import heapq
+import itertools
+from collections import namedtuple
+
+import pysam
+
+chrom_map = {'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
+
+
+def merge_vcfs(in_files, out_file):
+    if isinstance(in_files, dict):
+        in_files = [in_files[key] for key in sorted(in_files)]
+
+    with open(out_file, 'w') as out_fh:
+        write_header(out_fh)
+
+        writer = csv.DictWriter(out_fh, ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO'], delimiter='\t')
+
+        reader = MultiVcfReader(in_files)
+
+        for row in reader:
+            writer.writerow({'CHROM': row.chrom,
+                             'POS': row.coord,
+                             'ID': '.',
+                             'REF': row.ref,
+                             'ALT': row.alt,
+                             'QUAL': '.',
+                             'FILTER': '.',
+                             'INFO': '.'})
+
+        reader.close()
+
+
+def get_chrom_order(chrom):
+    '''
+    Convert chromosome names so they will sort 1, 2, 3, ..., X, Y, MT, etc..
+    followed by all other contigs by name.
+    '''
+    chrom = chrom.replace('chr', '')
+
+    chrom = chrom.replace('Chr', '')
+
+    try:
+        return 0, int(chrom), ''
+
+    except ValueError:
+        if chrom in chrom_map:
+            return 0, chrom_map[chrom], ''
+
+        return 1, 0, chrom
+
+
+def write_header(fh):
+    fh.write('##fileformat=VCFv4.1\n')
+
+    header = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+
+    header = '\t'.join(header)
+
+    fh.write('#{0}\n'.format(header))
+
+LightVCFRecord = namedtuple('LightVCFRecord', ['chrom', 'coord', 'ref', 'alt'])
+
+
+class MultiVcfReader(object):
+    '''
+    Streaming merge of tabix indexed VCFs. The records of each chromosome
+    are k-way merged on position with a heap, so every record is pushed
+    and popped once whatever the number of inputs.
+    '''
+
+    def __init__(self, vcf_files):
+        self._readers = []
+
+        for file_name in vcf_files:
+            self._readers.append(pysam.TabixFile(file_name, parser=pysam.asVCF()))
+
+    def __iter__(self):
+        for _, _, records in self.iter_positions():
+            for record in records:
+                yield record
+
+    def iter_positions(self):
+        '''
+        Yield (chrom, coord, records) for every position with a record in
+        any input, in chromosome order. The records of a position are split
+        on alt allele, deduplicated and sorted on ref and alt.
+        '''
+        for chrom in self.chroms:
+            merged = heapq.merge(*self._load_iters(chrom))
+
+            for coord, records in itertools.groupby(merged, key=lambda x: x[0]):
+                records = sorted(set(record for _, record in records), key=lambda x: (x.ref, x.alt))
+
+                yield chrom, coord, records
+
+    def close(self):
+        for reader in self._readers:
+            reader.close()
+
+    @property
+    def chroms(self):
+        '''
+        Get a union set of chromosomes present in VCF readers.
+        '''
+        chroms = set()
+
+        for reader in self._readers:
+            chroms.update(set(reader.contigs))
+
+        return sorted(chroms, key=lambda x: get_chrom_order(x))
+
+    def _load_iters(self, chrom):
+        iters = []
+
+        for reader in self._readers:
+            if chrom not in reader.contigs:
+                continue
+
+            iters.append(iter_chrom_records(reader.fetch(chrom)))
+
+        return iters
+
+
+def iter_chrom_records(chrom_iter):
+    '''
+    (coord, record) for each alt allele of the records of one chromosome
+    '''
+    for record in chrom_iter:
+        coord = record.pos + 1
+
+        # Handles multiple alt alleles.
+        for alt in record.alt.split(','):
+            yield coord, LightVCFRecord(record.contig, coord, record.ref, alt)
@@ -0,0 +1,301 @@
+'''
+In process finalisation of vcf files: records are streamed into a
+bgzipped output while checking their order, the sort (in memory or
+external, through sorted chunk files) only happens for input that is
+not already sorted. the output is indexed with tabix and csi indexes.
+'''
+import gzip
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+
+import pysam
+from single_cell.utils import vcfmergeutils
+
+SORT_BUFFER_RECORDS = 1000000
+
+WRITE_BUFFER_RECORDS = 10000
+
+
+class UnsortedInput(Exception):
+    pass
+
+
+def open_vcf(filepath):
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rt')
+    return open(filepath, 'rt')
+
+
+def read_vcf(reader):
+    """
+    splits the lines of an open vcf into the header and an iterator
+    over the records
+    """
+    header = []
+    for line in reader:
+        if not line.startswith('#'):
+            return header, itertools.chain([line], reader)
+        header.append(line)
+    return header, iter([])
+
+
+def get_contig_order(header):
+    contigs = {}
+    for line in header:
+        if line.startswith('##contig=<ID='):
+            contig = line[len('##contig=<ID='):].split(',')[0].rstrip('>\n')
+            contigs[contig] = len(contigs)
+    return contigs
+
+
+def get_sort_key_function(header):
+    """
+    records are sorted by the contig order of the header, contigs
+    missing from the header go after them in chromosome order
+    """
+    contigs = get_contig_order(header)
+    chrom_keys = {}
+
+    def get_key(line):
+        chrom, pos, _ = line.split('\t', 2)
+        if chrom not in chrom_keys:
+            if chrom in contigs:
+                chrom_keys[chrom] = (0, contigs[chrom])
+            else:
+                chrom_keys[chrom] = (1,) + vcfmergeutils.get_chrom_order(chrom)
+        return chrom_keys[chrom], int(pos)
+
+    return get_key
+
+
+def check_sorted(records):
+    """
+    passes records through, raises UnsortedInput with the offending
+    record if a chromosome is not contiguous or its positions decrease.
+    this is the order tabix requires, regardless of chromosome order
+    """
+    seen_chroms = set()
+    current_chrom = None
+    last_pos = 0
+
+    for line in records:
+        chrom, pos, _ = line.split('\t', 2)
+        pos = int(pos)
+
+        if chrom != current_chrom:
+            if chrom in seen_chroms:
+                raise UnsortedInput(line)
+            seen_chroms.add(chrom)
+            current_chrom = chrom
+        elif pos < last_pos:
+            raise UnsortedInput(line)
+
+        last_pos = pos
+        yield line
+
+
+def write_records(writer, records):
+    """
+    writes in batches, the records read before an exception are
+    written before it propagates
+    """
+    batch = []
+    try:
+        for line in records:
+            batch.append(line)
+            if len(batch) == WRITE_BUFFER_RECORDS:
+                writer.write(''.join(batch).encode())
+                batch = []
+    finally:
+        if batch:
+            writer.write(''.join(batch).encode())
+
+
+def write_chunk(records, tempdir):
+    fd, chunk = tempfile.mkstemp(dir=tempdir, suffix='.vcf.gz')
+    os.close(fd)
+    with gzip.open(chunk, 'wt', compresslevel=1) as writer:
+        writer.writelines(records)
+    return chunk
+
+
+def iter_chunk(chunk):
+    with gzip.open(chunk, 'rt') as reader:
+        for line in reader:
+            yield line
+
+
+def sort_records(records, key, tempdir, buffer_size=None):
+    """
+    sorts in memory when the records fit in buffer_size, otherwise
+    merges sorted chunk files of buffer_size records from tempdir
+    """
+    if buffer_size is None:
+        buffer_size = SORT_BUFFER_RECORDS
+
+    chunks = []
+    while True:
+        batch = list(itertools.islice(records, buffer_size))
+        if not batch:
+            break
+        batch.sort(key=key)
+
+        if not chunks and len(batch) < buffer_size:
+            for line in batch:
+                yield line
+            return
+
+        chunks.append(write_chunk(batch, tempdir))
+
+    for line in heapq.merge(*[iter_chunk(chunk) for chunk in chunks], key=key):
+        yield line
+
+
+def ensure_newline(records):
+    for line in records:
+        yield line if line.endswith('\n') else line + '\n'
+
+
+def index_vcf(vcf_file, index_types=('tbi', 'csi')):
+    for index_type in index_types:
+        pysam.tabix_index(
+            vcf_file, preset='vcf', force=True, keep_original=True, csi=index_type == 'csi'
+        )
+
+
+def write_bgzipped_vcf(header, records, out_file, tempdir, sort_buffer_size=None):
+    """
+    writes the records to out_file in a single pass if they are in order,
+    otherwise the partial output is read back and sorted with the
+    remaining records
+    """
+    records = ensure_newline(records)
+
+    with pysam.BGZFile(out_file, 'wb') as writer:
+        writer.write(''.join(header).encode())
+
+        try:
+            write_records(writer, check_sorted(records))
+            return False
+        except UnsortedInput as exc:
+            unsorted_record = exc.args[0]
+
+    logging.getLogger('single_cell.vcfsortutils').info(
+        'records of %s are not sorted, sorting', out_file
+    )
+
+    partial = os.path.join(tempdir, 'partial.vcf.gz')
+    shutil.move(out_file, partial)
+
+    with gzip.open(partial, 'rt') as reader:
+        _, written = read_vcf(reader)
+        records = itertools.chain(written, [unsorted_record], records)
+
+        with pysam.BGZFile(out_file, 'wb') as writer:
+            writer.write(''.join(header).encode())
+            sorted_records = sort_records(
+                records, get_sort_key_function(header), tempdir, buffer_size=sort_buffer_size
+            )
+            write_records(writer, sorted_records)
+
+    os.remove(partial)
+
+    return True
+
+
+def write_empty_vcf(out_file, bam=None, samples=()):
+    """
+    writes a vcf without records, with the contigs of the bam header
+    """
+    header = ['##fileformat=VCFv4.1']
+
+    if bam is not None:
+        with pysam.AlignmentFile(bam, 'rb') as reader:
+            for chrom, length in zip(reader.references, reader.lengths):
+                header.append('##contig=<ID={},length={}>'.format(chrom, length))
+
+    header.append('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']))
+    if samples:
+        header[-1] += '\t' + '\t'.join(['FORMAT'] + list(samples))
+
+    with open(out_file, 'wt') as writer:
+        writer.write('\n'.join(header) + '\n')
+
+
+def finalise_vcf(in_file, out_file, tempdir=None, sort_buffer_size=None):
+    """
+    sorts (if needed), bgzips and indexes in_file, which can be plain or
+    gzipped, into out_file with .tbi and .csi indexes
+    """
+    concatenate_vcf([in_file], out_file, tempdir=tempdir, sort_buffer_size=sort_buffer_size)
+
+
+def iter_records(vcf_files):
+    for vcf_file in vcf_files:
+        with open_vcf(vcf_file) as reader:
+            _, records = read_vcf(reader)
+            for line in records:
+                yield line
+
+
+def _get_header_and_first_record(vcf_file):
+    with open_vcf(vcf_file) as reader:
+        header, records = read_vcf(reader)
+        return header, next(records, None)
+
+
+def concatenate_vcf(in_files, out_file, tempdir=None, sort_buffer_size=None):
+    """
+    concatenates the vcfs into a bgzipped and indexed out_file. the header
+    is taken from the first input with records. inputs are ordered by their first record,
+    so region vcfs that do not overlap are written without sorting.
+    """
+    logger = logging.getLogger('single_cell.vcfsortutils')
+
+    if isinstance(in_files, dict):
+        in_files = [in_files[key] for key in sorted(in_files)]
+
+    headers = {}
+    first_records = {}
+    for in_file in in_files:
+        if os.path.getsize(in_file) == 0:
+            logger.warning('input file {} is empty'.format(in_file))
+            continue
+
+        headers[in_file], first_records[in_file] = _get_header_and_first_record(in_file)
+
+    in_files = [v for v in in_files if v in first_records]
+
+    # header only inputs (regions that were not called) do not set the header
+    with_records = [v for v in in_files if first_records[v] is not None]
+    header = headers[(with_records or in_files)[0]] if in_files else []
+
+    if any(headers[v] != header for v in with_records):
+        logger.warning('merging vcf files with mismatching headers')
+
+    key = get_sort_key_function(header)
+    # header only files go first, they have nothing to order
+    in_files = sorted(
+        in_files,
+        key=lambda v: (0,) if first_records[v] is None else (1, key(first_records[v]))
+    )
+
+    tempdir_created = tempdir is None
+    if tempdir is None:
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+    elif not os.path.exists(tempdir):
+        os.makedirs(tempdir)
+
+    try:
+        write_bgzipped_vcf(
+            header, iter_records(in_files), out_file, tempdir, sort_buffer_size=sort_buffer_size
+        )
+    finally:
+        if tempdir_created:
+            shutil.rmtree(tempdir)
+
+    index_vcf(out_file)
@@ -0,0 +1,200 @@
+'''
+Single pass conversion of vcf files to tables, one row per alt allele
+with the chrom, coord, ref, alt and score columns. the vcf is read once
+in chunks of rows; for hdf5 output the string columns are dictionary
+encoded as the chunks are read and the chunks spilled to disk, so that
+the categories of the table are known without a second pass over the vcf.
+'''
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pysam
+from pandas.api.types import CategoricalDtype
+from single_cell.utils import csvutils
+from single_cell.utils import helpers
+
+TABLE_COLUMNS = ['chrom', 'coord', 'ref', 'alt', 'score']
+
+CATEGORICAL_COLUMNS = ['chrom', 'ref', 'alt']
+
+CHUNK_SIZE = 100000
+
+
+class CategoryEncoder(object):
+    """
+    dictionary encoder that grows its categories as values are seen
+    """
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, values):
+        codes = self.codes
+        return np.array(
+            [codes.setdefault(value, len(codes)) for value in values],
+            dtype=np.int32
+        )
+
+    @property
+    def categories(self):
+        return sorted(self.codes)
+
+    def get_recoder(self):
+        """
+        array mapping the codes in order of appearance to codes
+        of the sorted categories
+        """
+        recoder = np.zeros(len(self.codes), dtype=np.int32)
+        for i, value in enumerate(self.categories):
+            recoder[self.codes[value]] = i
+        return recoder
+
+
+def iter_rows(in_file, score_callback=None):
+    """
+    yields (chrom, coord, ref, alt, score) for each alt allele of each
+    record. score_callback is called with the pysam VariantRecord,
+    the default score is QUAL
+    """
+    reader = pysam.VariantFile(in_file)
+
+    for record in reader:
+        if score_callback is not None:
+            score = score_callback(record)
+        else:
+            score = record.qual
+
+        for alt in record.alts or ('.',):
+            yield record.chrom, record.pos, record.ref, alt, score
+
+    reader.close()
+
+
+def iter_chunks(rows, chunk_size=None):
+    """
+    yields the rows as lists of columns of at most chunk_size rows
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield list(zip(*chunk))
+            chunk = []
+
+    if chunk:
+        yield list(zip(*chunk))
+
+
+def get_dataframe(columns, start=0):
+    df = pd.DataFrame(
+        dict(zip(TABLE_COLUMNS, columns)), columns=TABLE_COLUMNS,
+        index=range(start, start + len(columns[0]))
+    )
+    df['score'] = df['score'].astype(float)
+    return df
+
+
+def encode_chunks(in_file, tempdir, score_callback=None, chunk_size=None):
+    """
+    reads the vcf once, writing each chunk to tempdir with the string
+    columns dictionary encoded. returns the chunk files and the encoders
+    """
+    helpers.makedirs(tempdir)
+
+    encoders = {column: CategoryEncoder() for column in CATEGORICAL_COLUMNS}
+
+    chunk_files = []
+    for i, columns in enumerate(iter_chunks(iter_rows(in_file, score_callback), chunk_size)):
+        columns = dict(zip(TABLE_COLUMNS, columns))
+
+        arrays = {
+            column: encoders[column].encode(columns[column]) for column in CATEGORICAL_COLUMNS
+        }
+        arrays['coord'] = np.array(columns['coord'], dtype=np.int64)
+        arrays['score'] = np.array(
+            [np.nan if v is None else v for v in columns['score']], dtype=float
+        )
+
+        chunk_file = os.path.join(tempdir, 'chunk{}.npz'.format(i))
+        np.savez(chunk_file, **arrays)
+        chunk_files.append(chunk_file)
+
+    return chunk_files, encoders
+
+
+def iter_decoded_chunks(chunk_files, encoders):
+    """
+    yields the chunks as dataframes, with categoricals of the sorted
+    categories of the whole vcf and a running row index
+    """
+    recoders = {column: encoders[column].get_recoder() for column in CATEGORICAL_COLUMNS}
+    dtypes = {
+        column: CategoricalDtype(categories=encoders[column].categories)
+        for column in CATEGORICAL_COLUMNS
+    }
+
+    start = 0
+    for chunk_file in chunk_files:
+        with np.load(chunk_file) as arrays:
+            num_rows = len(arrays['coord'])
+            df = pd.DataFrame(index=range(start, start + num_rows))
+
+            for column in TABLE_COLUMNS:
+                if column in CATEGORICAL_COLUMNS:
+                    df[column] = pd.Categorical.from_codes(
+                        recoders[column][arrays[column]], dtype=dtypes[column]
+                    )
+                else:
+                    df[column] = arrays[column]
+
+        start += num_rows
+        yield df
+
+
+def convert_vcf_to_hdf5(in_file, out_file, table_name, tempdir=None, score_callback=None, chunk_size=None):
+    """
+    writes the rows of the vcf to table_name of out_file, with the
+    string columns as categoricals of their sorted values
+    """
+    tempdir_created = tempdir is None
+    if tempdir is None:
+        tempdir = out_file + '.chunks'
+
+    chunk_files, encoders = encode_chunks(
+        in_file, tempdir, score_callback=score_callback, chunk_size=chunk_size
+    )
+
+    with pd.HDFStore(out_file, 'w', complevel=9, complib='blosc') as hdf_store:
+        for df in iter_decoded_chunks(chunk_files, encoders):
+            hdf_store.append(table_name, df)
+
+    for chunk_file in chunk_files:
+        os.remove(chunk_file)
+
+    if tempdir_created:
+        shutil.rmtree(tempdir)
+
+
+def convert_vcf_to_csv(in_file, out_file, dtypes, score_callback=None, write_header=True, chunk_size=None):
+    """
+    writes the rows of the vcf to a csvutils table (csv.gz and yaml)
+    in chunks, as the vcf is read
+    """
+
+    def dataframes():
+        start = 0
+        for columns in iter_chunks(iter_rows(in_file, score_callback), chunk_size):
+            df = get_dataframe(columns, start=start)
+            start += len(df)
+            yield df
+
+        if start == 0:
+            yield pd.DataFrame(columns=TABLE_COLUMNS)
+
+    csvoutput = csvutils.CsvOutput(out_file, dtypes, header=write_header, columns=TABLE_COLUMNS)
+    csvoutput.write_df(dataframes(), chunks=True)
@@ -7,9 +7,10 @@ import itertools
 import logging
 import os
 
-import biowrappers.components.io.vcf.tasks as vcf_tasks
 import vcf
 from single_cell.utils import helpers
+from single_cell.utils import vcfmergeutils
+from single_cell.utils import vcfsortutils
 
 
 def _get_header(infile):
@@ -87,9 +88,9 @@ def merge_vcf(infiles, outfile, tempdir):
     helpers.makedirs(tempdir)
     temp_output = os.path.join(tempdir, 'merged.vcf')
 
-    vcf_tasks.merge_vcfs(vcf_files, temp_output)
+    vcfmergeutils.merge_vcfs(vcf_files, temp_output)
 
-    vcf_tasks.finalise_vcf(temp_output, outfile)
+    vcfsortutils.finalise_vcf(temp_output, outfile, tempdir=tempdir)
 
 
 def split_vcf(in_file, out_files, lines_per_file):
@@ -4,9 +4,13 @@ Created on Jul 6, 2017
 @author: dgrewal
 '''
 
+from collections import Counter
+
 import pypeliner
 import pypeliner.managed as mgd
+from single_cell.workflows.align.align_tasks import get_lane_parallelism
 from single_cell.workflows.align.dtypes import dtypes
+from single_cell.workflows.align.fastqscreen import get_screen_batches
 
 
 def bam_metrics_workflow(
@@ -18,8 +22,6 @@ def bam_metrics_workflow(
         flagstat_metrics_percell,
         wgs_metrics_percell,
         gc_metrics_percell,
-        gc_metrics_summary_percell,
-        gc_metrics_pdf_percell,
         insert_metrics_percell,
         insert_metrics_pdf_percell,
         ref_genome,
@@ -39,18 +41,15 @@ def bam_metrics_workflow(
     gc_metrics_percell = dict([(cellid, gc_metrics_percell[cellid])
                                for cellid in cell_ids])
 
-    gc_metrics_summary_percell = dict([(cellid, gc_metrics_summary_percell[cellid])
-                                       for cellid in cell_ids])
-
-    gc_metrics_pdf_percell = dict([(cellid, gc_metrics_pdf_percell[cellid])
-                                   for cellid in cell_ids])
-
     insert_metrics_percell = dict([(cellid, insert_metrics_percell[cellid])
                                    for cellid in cell_ids])
 
     insert_metrics_pdf_percell = dict([(cellid, insert_metrics_pdf_percell[cellid])
                                        for cellid in cell_ids])
 
+    # approximate qc from a subsample of read pairs, None uses every read
+    sampling_fraction = config.get('qc_sampling_fraction')
+
     workflow = pypeliner.workflow.Workflow()
 
     workflow.setobj(
@@ -58,37 +57,52 @@ def bam_metrics_workflow(
         value=cell_ids,
     )
 
+    if config.get('validate_markdups'):
+        workflow.transform(
+            name='validate_duplication_metrics',
+            axes=('cell_id',),
+            func="single_cell.workflows.align.tasks.validate_duplication_metrics",
+            args=(
+                mgd.InputFile('sorted_markdups', 'cell_id', fnames=bam_filename),
+                mgd.InputFile('markdups_metrics', 'cell_id', fnames=markdups_metrics_percell),
+                mgd.TempOutputFile('markdups_metrics_validated.txt', 'cell_id'),
+                mgd.TempSpace('tempdir_markdups', 'cell_id'),
+            ),
+        )
+        markdups_metrics = mgd.TempInputFile(
+            'markdups_metrics_validated.txt', 'cell_id', axes_origin=[]
+        )
+    else:
+        markdups_metrics = mgd.InputFile(
+            'markdups_metrics', 'cell_id', axes_origin=[], fnames=markdups_metrics_percell
+        )
+
     workflow.transform(
-        name='get_duplication_wgs_flagstat_metrics',
-        axes=('cell_id',),
-        func="single_cell.workflows.align.tasks.picard_wgs_dup",
+        name='get_genome_territory',
+        ctx={'mem': config['memory']['med'], 'ncpus': 1},
+        func="single_cell.workflows.align.bam_qc.get_genome_territory",
         args=(
-            mgd.InputFile('sorted_markdups', 'cell_id', fnames=bam_filename),
-            mgd.TempOutputFile("temp_markdup_bam.bam", 'cell_id'),
-            mgd.OutputFile('markdups_metrics', 'cell_id', fnames=markdups_metrics_percell),
-            mgd.TempSpace('tempdir_markdups', 'cell_id'),
             ref_genome,
-            mgd.OutputFile('wgs_metrics_percell', 'cell_id', fnames=wgs_metrics_percell),
-            config['picard_wgs_params'],
+            mgd.TempOutputFile('genome_territory.yaml'),
         ),
     )
 
     workflow.transform(
-        name='bam_collect_gc_insert_metrics',
+        name='bam_collect_qc_metrics',
         ctx={'mem': config['memory']['med'], 'ncpus': 1},
-        func="single_cell.workflows.align.tasks.picard_insert_gc_flagstat",
+        func="single_cell.workflows.align.bam_qc.collect_bam_qc",
         axes=('cell_id',),
         args=(
             mgd.InputFile('sorted_markdups', 'cell_id', fnames=bam_filename),
-            ref_genome,
-            mgd.OutputFile('gc_metrics_percell', 'cell_id', fnames=gc_metrics_percell),
-            mgd.OutputFile('gc_metrics_summary_percell', 'cell_id', fnames=gc_metrics_summary_percell),
-            mgd.OutputFile('gc_metrics_pdf_percell', 'cell_id', fnames=gc_metrics_pdf_percell),
-            mgd.TempSpace('gc_tempdir', 'cell_id'),
+            mgd.TempInputFile('genome_territory.yaml'),
             mgd.OutputFile('flagstat_metrics_percell', 'cell_id', fnames=flagstat_metrics_percell),
             mgd.OutputFile('insert_metrics_percell', 'cell_id', fnames=insert_metrics_percell),
             mgd.OutputFile('insert_metrics_pdf_percell', 'cell_id', fnames=insert_metrics_pdf_percell),
+            mgd.OutputFile('wgs_metrics_percell', 'cell_id', fnames=wgs_metrics_percell),
+            mgd.TempOutputFile('gc_read_starts.npz', 'cell_id'),
+            config['picard_wgs_params'],
         ),
+        kwargs={'sampling_fraction': sampling_fraction},
     )
 
     workflow.transform(
@@ -101,16 +115,18 @@ def bam_metrics_workflow(
             mgd.TempOutputFile('coverage_metrics.yaml', 'cell_id'),
             mgd.InputInstance('cell_id')
         ),
+        kwargs={'sampling_fraction': sampling_fraction},
     )
 
     workflow.transform(
         name="collect_gc_metrics",
-        func="single_cell.workflows.align.tasks.collect_gc",
+        func="single_cell.workflows.align.gc_bias.get_gcbias_matrix",
         ctx={'mem': config['memory']['med'], 'ncpus': 1},
         args=(
-            mgd.InputFile('gc_metrics_percell', 'cell_id', fnames=gc_metrics_percell),
+            ref_genome,
+            mgd.TempInputFile('gc_read_starts.npz', 'cell_id', axes_origin=[]),
             mgd.OutputFile(gc_metrics, extensions=['.yaml']),
-            mgd.TempSpace("temp_gc")
+            mgd.OutputFile('gc_metrics_percell', 'cell_id', axes_origin=[], fnames=gc_metrics_percell),
         ),
     )
 
@@ -120,12 +136,13 @@ def bam_metrics_workflow(
         func="single_cell.workflows.align.tasks.collect_metrics",
         args=(
             mgd.InputFile('flagstat_metrics', 'cell_id', axes_origin=[], fnames=flagstat_metrics_percell),
-            mgd.InputFile('markdups_metrics', 'cell_id', axes_origin=[], fnames=markdups_metrics_percell),
+            markdups_metrics,
             mgd.InputFile('insert_metrics_percell', 'cell_id', axes_origin=[], fnames=insert_metrics_percell),
             mgd.InputFile('wgs_metrics_percell', 'cell_id', axes_origin=[], fnames=wgs_metrics_percell),
             mgd.TempSpace("tempdir_collect_metrics"),
             mgd.TempOutputFile("alignment_metrics.csv.gz", extensions=['.yaml']),
         ),
+        kwargs={'sampling_fraction': sampling_fraction},
     )
 
     workflow.transform(
@@ -213,15 +230,81 @@ def create_alignment_workflow(
         value=list(fastq_1_filename.keys()),
     )
 
+    screen_batch_size = config['fastq_screen_params'].get('batch_size')
+
+    if screen_batch_size:
+        # one fastq_screen run per batch of cells, the batches run as
+        # separate jobs and are split back into cells and lanes after
+        screen_batches = get_screen_batches(fastq_1_filename.keys(), screen_batch_size)
+
+        workflow.setobj(
+            obj=mgd.OutputChunks('batch'),
+            value=list(screen_batches.keys()),
+        )
+
+        workflow.transform(
+            name='organism_filter_batch',
+            axes=('batch',),
+            ctx={'ncpus': config['max_cores']},
+            func="single_cell.workflows.align.fastqscreen.organism_filter_batch",
+            args=(
+                mgd.InputFile('fastq_1', 'cell_id', 'lane', fnames=fastq_1_filename, axes_origin=[]),
+                mgd.InputFile('fastq_2', 'cell_id', 'lane', fnames=fastq_2_filename, axes_origin=[]),
+                mgd.TempOutputFile('screened_batch.tar', 'batch'),
+                mgd.TempSpace('fastq_screen_batch_temp', 'batch'),
+                mgd.InputInstance('batch'),
+                screen_batches,
+                config['fastq_screen_params'],
+            ),
+            kwargs={'threads': config['max_cores']},
+        )
+
+        workflow.transform(
+            name='demultiplex_screened_batch',
+            axes=('cell_id',),
+            func="single_cell.workflows.align.fastqscreen.demultiplex_screened_batch",
+            args=(
+                mgd.TempInputFile('screened_batch.tar', 'batch', axes_origin=[]),
+                mgd.TempOutputFile('screened_fastq_1.fastq.gz', 'cell_id', 'lane'),
+                mgd.TempOutputFile('screened_fastq_2.fastq.gz', 'cell_id', 'lane'),
+                mgd.TempOutputFile('organism_detailed_count_per_cell.csv.gz', 'cell_id'),
+                mgd.TempOutputFile('organism_summary_count_per_cell.csv.gz', 'cell_id'),
+                mgd.InputInstance('cell_id'),
+                screen_batches,
+            ),
+        )
+
+        align_fastq_1 = mgd.TempInputFile('screened_fastq_1.fastq.gz', 'cell_id', 'lane', axes_origin=[])
+        align_fastq_2 = mgd.TempInputFile('screened_fastq_2.fastq.gz', 'cell_id', 'lane', axes_origin=[])
+        screen_detailed_counts = None
+        screen_summary_counts = None
+    else:
+        align_fastq_1 = mgd.InputFile('fastq_1', 'cell_id', 'lane', fnames=fastq_1_filename, axes_origin=[])
+        align_fastq_2 = mgd.InputFile('fastq_2', 'cell_id', 'lane', fnames=fastq_2_filename, axes_origin=[])
+        screen_detailed_counts = mgd.TempOutputFile('organism_detailed_count_per_cell.csv.gz', 'cell_id')
+        screen_summary_counts = mgd.TempOutputFile('organism_summary_count_per_cell.csv.gz', 'cell_id')
+
+    bwa_index_mode = config.get('bwa_index_mode', 'per_cell')
+
+    # lanes aligned concurrently each load their own bwa index,
+    # unless it is shared, so the memory request has to cover all of them
+    align_mem = ctx['mem']
+    if bwa_index_mode == 'per_cell':
+        num_lanes = max(Counter(cell for cell, _ in fastq_1_filename).values(), default=1)
+        num_parallel, _ = get_lane_parallelism(num_lanes, config['max_cores'])
+        align_mem *= num_parallel
+
     workflow.transform(
         name='align_reads',
         axes=('cell_id',),
+        ctx={'mem': align_mem, 'ncpus': config['max_cores']},
         func="single_cell.workflows.align.align_tasks.align_lanes",
         args=(
-            mgd.InputFile('fastq_1', 'cell_id', 'lane', fnames=fastq_1_filename, axes_origin=[]),
-            mgd.InputFile('fastq_2', 'cell_id', 'lane', fnames=fastq_2_filename, axes_origin=[]),
+            align_fastq_1,
+            align_fastq_2,
             mgd.OutputFile('sorted_markdups', 'cell_id', fnames=bam_filename, extensions=['.bai']),
             mgd.OutputFile('sorted_markdups_mt', 'cell_id', fnames=mt_bam_filename, extensions=['.bai']),
+            mgd.TempOutputFile('markdups_metrics.txt', 'cell_id'),
             mgd.TempOutputFile('fastqc_reports.tar.gz', 'cell_id'),
             mgd.TempSpace('alignment_temp', 'cell_id'),
             ref_genome,
@@ -230,12 +313,16 @@ def create_alignment_workflow(
             library_id,
             config['adapter'],
             config['adapter2'],
-            mgd.TempOutputFile('organism_detailed_count_per_cell.csv.gz', 'cell_id'),
-            mgd.TempOutputFile('organism_summary_count_per_cell.csv.gz', 'cell_id'),
+            screen_detailed_counts,
+            screen_summary_counts,
             config['fastq_screen_params'],
             trim,
             center
         ),
+        kwargs={
+            'ncores': config['max_cores'],
+            'bwa_index_mode': bwa_index_mode,
+        }
     )
 
     workflow.transform(
@@ -258,12 +345,10 @@ def create_alignment_workflow(
             mgd.TempInputFile('organism_summary_count_per_cell.csv.gz', extensions=['.yaml']),
             mgd.OutputFile(alignment_metrics, extensions=['.yaml']),
             mgd.OutputFile(gc_metrics, extensions=['.yaml']),
-            mgd.TempOutputFile('markdups_metrics.txt', 'cell_id', axes_origin=[]),
+            mgd.TempInputFile('markdups_metrics.txt', 'cell_id', axes_origin=[]),
             mgd.TempOutputFile('flagstat_metrics.txt', 'cell_id', axes_origin=[]),
             mgd.TempOutputFile('wgs_metrics.txt', 'cell_id', axes_origin=[]),
             mgd.TempOutputFile('gc_metrics.txt', 'cell_id', axes_origin=[]),
-            mgd.TempOutputFile('gc_metrics_summary.txt', 'cell_id', axes_origin=[]),
-            mgd.TempOutputFile('gc_metrics.pdf', 'cell_id', axes_origin=[]),
             mgd.TempOutputFile('insert_metrics.txt', 'cell_id', axes_origin=[]),
             mgd.TempOutputFile('insert_metrics.pdf', 'cell_id', axes_origin=[]),
             ref_genome,
@@ -297,8 +382,6 @@ def create_alignment_workflow(
                 mgd.TempInputFile('flagstat_metrics.txt', 'cell_id'),
                 mgd.TempInputFile('wgs_metrics.txt', 'cell_id'),
                 mgd.TempInputFile('gc_metrics.txt', 'cell_id'),
-                mgd.TempInputFile('gc_metrics_summary.txt', 'cell_id'),
-                mgd.TempInputFile('gc_metrics.pdf', 'cell_id'),
                 mgd.TempInputFile('insert_metrics.txt', 'cell_id'),
                 mgd.TempInputFile('insert_metrics.pdf', 'cell_id'),
             ],
@@ -1,29 +1,20 @@
 import logging
+import multiprocessing
 import os
 
 import pypeliner
 import single_cell.workflows.align.fastqscreen as fastqscreen
+import single_cell.workflows.align.markdups as markdups
 from single_cell.utils import bamutils
 from single_cell.utils import helpers
-from single_cell.utils import picardutils
 
 from .scripts import RunTrimGalore
 
 
-def merge_postprocess_bams(inputs, output, tempdir):
-    helpers.makedirs(tempdir)
-    merged_out = os.path.join(tempdir, 'merged_lanes.bam')
-
-    picardutils.merge_bams(inputs, merged_out)
-    bamutils.bam_index(merged_out, merged_out + '.bai')
-
-    sorted_bam = os.path.join(tempdir, 'sorted.bam')
-    picardutils.bam_sort(merged_out, sorted_bam, tempdir)
-
-    markdups_metrics = os.path.join(tempdir, 'markdups_metrics.txt')
-    picardutils.bam_markdups(sorted_bam, output, markdups_metrics, tempdir)
-
-    bamutils.bam_index(output, output + '.bai')
+def merge_postprocess_bams(inputs, output, markdups_metrics, threads=1):
+    markdups.merge_and_mark_duplicates(
+        inputs, output, markdups_metrics, threads=threads
+    )
 
 
 def run_fastqc(fastq1, fastq2, reports_dir, tempdir):
@@ -115,32 +106,35 @@ def trim_fastqs(fastq1, fastq2, cell_id, tempdir, adapter, adapter2):
 
 
 def align_pe_with_bwa(
-        fastq1, fastq2, output, reference, readgroup, tempdir
+        fastq1, fastq2, output, reference, readgroup, tempdir, threads=1
 ):
-    samfile = os.path.join(tempdir, "bwamem.sam")
-
-    bamutils.bwa_mem_paired_end(fastq1, fastq2, samfile, reference, readgroup)
-
-    bamutils.samtools_sam_to_bam(samfile, output)
+    bamutils.bwa_mem_paired_end_sorted(
+        fastq1, fastq2, output, os.path.join(tempdir, 'bwa_sort'),
+        reference, readgroup, threads=threads
+    )
 
 
 def align_pe(
         fastq1, fastq2, output, reports_dir, tempdir, reference,
         trim, center, sample_info, cell_id, lane_id, library_id,
         adapter, adapter2, fastqscreen_detailed_metrics,
-        fastqscreen_summary_metrics, fastqscreen_params,
+        fastqscreen_summary_metrics, fastqscreen_params, threads=1
 ):
-    fastqscreen_tempdir = os.path.join(tempdir, 'fastq_screen')
-    helpers.makedirs(fastqscreen_tempdir)
+    if fastqscreen_detailed_metrics is None:
+        # already screened by fastqscreen.organism_filter_batch
+        filtered_fastq_r1, filtered_fastq_r2 = fastq1, fastq2
+    else:
+        fastqscreen_tempdir = os.path.join(tempdir, 'fastq_screen')
+        helpers.makedirs(fastqscreen_tempdir)
 
-    filtered_fastq_r1 = os.path.join(fastqscreen_tempdir, "fastq_r1.fastq.gz")
-    filtered_fastq_r2 = os.path.join(fastqscreen_tempdir, "fastq_r2.fastq.gz")
+        filtered_fastq_r1 = os.path.join(fastqscreen_tempdir, "fastq_r1.fastq.gz")
+        filtered_fastq_r2 = os.path.join(fastqscreen_tempdir, "fastq_r2.fastq.gz")
 
-    fastqscreen.organism_filter(
-        fastq1, fastq2, filtered_fastq_r1, filtered_fastq_r2,
-        fastqscreen_detailed_metrics, fastqscreen_summary_metrics,
-        fastqscreen_tempdir, cell_id, fastqscreen_params
-    )
+        fastqscreen.organism_filter(
+            fastq1, fastq2, filtered_fastq_r1, filtered_fastq_r2,
+            fastqscreen_detailed_metrics, fastqscreen_summary_metrics,
+            fastqscreen_tempdir, cell_id, fastqscreen_params
+        )
 
     readgroup = get_readgroup(
         lane_id, cell_id, library_id, center, sample_info
@@ -148,8 +142,6 @@ def align_pe(
 
     # run_fastqc(filtered_fastq_r1, filtered_fastq_r2, reports_dir, tempdir)
 
-    aln_temp = os.path.join(tempdir, "temp_alignments.bam")
-
     if trim:
         filtered_fastq_r1, filtered_fastq_r2 = trim_fastqs(
             filtered_fastq_r1, filtered_fastq_r2, cell_id, tempdir,
@@ -157,12 +149,10 @@ def align_pe(
         )
 
     align_pe_with_bwa(
-        filtered_fastq_r1, filtered_fastq_r2, aln_temp, reference, readgroup,
-        tempdir
+        filtered_fastq_r1, filtered_fastq_r2, output, reference, readgroup,
+        tempdir, threads=threads
     )
 
-    picardutils.bam_sort(aln_temp, output, tempdir)
-
     metrics = os.path.join(reports_dir, 'flagstat_metrics.txt')
     bamutils.bam_flagstat(output, metrics)
 
@@ -175,17 +165,42 @@ def extract_mt_chromosome(input_bam, mt_bam, mt_chrom_name='MT'):
     pypeliner.commandline.execute(*cmd)
 
 
+BWA_INDEX_MODES = ('per_cell', 'shared_memory')
+
+
+def get_lane_parallelism(num_lanes, ncores):
+    """
+    split the core budget between lanes aligned concurrently
+    and the bwa threads within each lane
+    """
+    ncores = max(1, ncores or 1)
+    num_parallel = max(1, min(num_lanes, ncores))
+    return num_parallel, max(1, ncores // num_parallel)
+
+
 def align_lanes(
-        fastq1, fastq2, output, output_mt, reports, tempdir, reference,
+        fastq1, fastq2, output, output_mt, markdups_metrics, reports, tempdir, reference,
         sample_info, cell_id, library_id, adapter,
         adapter2, fastqscreen_detailed_metrics,
-        fastqscreen_summary_metrics, fastqscreen_params, trim, center, mt_chrom_name='MT'
+        fastqscreen_summary_metrics, fastqscreen_params, trim, center,
+        mt_chrom_name='MT', ncores=1, bwa_index_mode='per_cell'
 ):
+    if bwa_index_mode not in BWA_INDEX_MODES:
+        raise ValueError(
+            'unknown bwa_index_mode {}, expected one of {}'.format(bwa_index_mode, BWA_INDEX_MODES)
+        )
+
+    if bwa_index_mode == 'shared_memory':
+        # no-op when an earlier cell on this node already loaded the index
+        bamutils.bwa_shm_load(reference)
+
     lane_bams = []
     detailed_counts = []
     summary_counts = []
+    lane_args = []
 
-    for lane_id in fastq1:
+    # sorted lanes keep the merge order and outputs independent of scheduling
+    for lane_id in sorted(fastq1):
         reports_dir = os.path.join(tempdir, 'reports_per_lane', lane_id)
 
         helpers.makedirs(reports_dir)
@@ -195,27 +210,47 @@ def align_lanes(
 
         lane_bams.append(lane_bam)
 
-        screen_detailed = os.path.join(reports_dir, 'detailed.txt')
-        screen_summary = os.path.join(reports_dir, 'summary.txt')
+        if fastqscreen_detailed_metrics is None:
+            screen_detailed = screen_summary = None
+        else:
+            screen_detailed = os.path.join(reports_dir, 'detailed.txt')
+            screen_summary = os.path.join(reports_dir, 'summary.txt')
 
-        detailed_counts.append(screen_detailed)
-        summary_counts.append(screen_summary)
+            detailed_counts.append(screen_detailed)
+            summary_counts.append(screen_summary)
 
-        align_pe(
+        lane_args.append((
             fastq1[lane_id], fastq2[lane_id], lane_bam, reports_dir,
             lane_tempdir, reference, trim, center, sample_info, cell_id, lane_id,
             library_id, adapter, adapter2,
             screen_detailed, screen_summary, fastqscreen_params,
-        )
+        ))
 
-    helpers.make_tarfile(reports, os.path.join(tempdir, 'reports_per_lane'))
+    num_parallel, bwa_threads = get_lane_parallelism(len(lane_args), ncores)
 
-    merge_postprocess_bams(lane_bams, output, os.path.join(tempdir, 'merge_bams'))
+    if num_parallel == 1:
+        for args in lane_args:
+            align_pe(*args, threads=bwa_threads)
+    else:
+        with multiprocessing.Pool(processes=num_parallel) as pool:
+            results = [
+                pool.apply_async(align_pe, args, {'threads': bwa_threads})
+                for args in lane_args
+            ]
+            for result in results:
+                result.get()
 
-    fastqscreen.merge_fastq_screen_counts(
-        detailed_counts, summary_counts,
-        fastqscreen_detailed_metrics, fastqscreen_summary_metrics,
-        fastqscreen_params
+    helpers.make_tarfile(reports, os.path.join(tempdir, 'reports_per_lane'))
+
+    merge_postprocess_bams(
+        lane_bams, output, markdups_metrics, threads=max(1, ncores or 1)
     )
 
+    if fastqscreen_detailed_metrics is not None:
+        fastqscreen.merge_fastq_screen_counts(
+            detailed_counts, summary_counts,
+            fastqscreen_detailed_metrics, fastqscreen_summary_metrics,
+            fastqscreen_params
+        )
+
     extract_mt_chromosome(output, output_mt, mt_chrom_name=mt_chrom_name)
@@ -0,0 +1,557 @@
+'''
+Single pass bam qc. Computes the samtools flagstat counts, the picard
+CollectInsertSizeMetrics histogram and the picard CollectWgsMetrics
+depth statistics from one scan of the bam, and writes them in the
+formats that CollectMetrics parses.
+'''
+from __future__ import division
+
+import math
+from collections import OrderedDict
+from collections import defaultdict
+
+import numpy as np
+import pysam
+import yaml
+from single_cell.workflows.align import sampling
+from single_cell.workflows.align.coverage_metrics import CoverageMetrics
+from single_cell.workflows.align.gc_bias import GcReadStarts
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_DUPLICATE = 0x400
+FLAG_SUPPLEMENTARY = 0x800
+
+PAIR_ORIENTATIONS = ['FR', 'RF', 'TANDEM']
+
+INSERT_METRICS_COLUMNS = [
+    'MEDIAN_INSERT_SIZE', 'MODE_INSERT_SIZE', 'MEDIAN_ABSOLUTE_DEVIATION',
+    'MIN_INSERT_SIZE', 'MAX_INSERT_SIZE', 'MEAN_INSERT_SIZE',
+    'STANDARD_DEVIATION', 'READ_PAIRS', 'PAIR_ORIENTATION',
+    'WIDTH_OF_10_PERCENT', 'WIDTH_OF_20_PERCENT', 'WIDTH_OF_30_PERCENT',
+    'WIDTH_OF_40_PERCENT', 'WIDTH_OF_50_PERCENT', 'WIDTH_OF_60_PERCENT',
+    'WIDTH_OF_70_PERCENT', 'WIDTH_OF_80_PERCENT', 'WIDTH_OF_90_PERCENT',
+    'WIDTH_OF_95_PERCENT', 'WIDTH_OF_99_PERCENT',
+    'SAMPLE', 'LIBRARY', 'READ_GROUP'
+]
+
+INSERT_WIDTH_PERCENTS = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]
+
+WGS_COVERAGE_LEVELS = [1, 5, 10, 15, 20, 25, 30, 40, 50, 60, 70, 80, 90, 100]
+
+
+def format_metric(value):
+    """
+    format a value the way picard metrics files do,
+    undefined values are written as '?'
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return '?'
+        value = '{:.6f}'.format(value).rstrip('0').rstrip('.')
+    return str(value)
+
+
+class FlagstatCounter(object):
+    """
+    samtools flagstat counts, split into qc passed and qc failed reads
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(lambda: [0, 0])
+
+    def add_read(self, read):
+        flag = read.flag
+        counts = self.counts
+        qcfail = 1 if flag & FLAG_QCFAIL else 0
+
+        counts['total'][qcfail] += 1
+
+        if flag & FLAG_SECONDARY:
+            counts['secondary'][qcfail] += 1
+        elif flag & FLAG_SUPPLEMENTARY:
+            counts['supplementary'][qcfail] += 1
+        elif flag & FLAG_PAIRED:
+            counts['paired'][qcfail] += 1
+            if flag & FLAG_PROPER_PAIR and not flag & FLAG_UNMAPPED:
+                counts['proper'][qcfail] += 1
+            if flag & FLAG_READ1:
+                counts['read1'][qcfail] += 1
+            if flag & FLAG_READ2:
+                counts['read2'][qcfail] += 1
+            if flag & FLAG_MATE_UNMAPPED and not flag & FLAG_UNMAPPED:
+                counts['singleton'][qcfail] += 1
+            if not flag & FLAG_UNMAPPED and not flag & FLAG_MATE_UNMAPPED:
+                counts['pair_mapped'][qcfail] += 1
+                if read.next_reference_id != read.reference_id:
+                    counts['diffchr'][qcfail] += 1
+                    if read.mapping_quality >= 5:
+                        counts['diffchr_mapq5'][qcfail] += 1
+
+        if not flag & FLAG_UNMAPPED:
+            counts['mapped'][qcfail] += 1
+        if flag & FLAG_DUPLICATE:
+            counts['duplicates'][qcfail] += 1
+
+    def _percent(self, key, total_key):
+        values = []
+        for numerator, denominator in zip(self.counts[key], self.counts[total_key]):
+            if denominator:
+                values.append('{:.2f}%'.format(100 * numerator / denominator))
+            else:
+                values.append('N/A')
+        return '({} : {})'.format(*values)
+
+    def write(self, output):
+        lines = [
+            ('total', 'in total (QC-passed reads + QC-failed reads)'),
+            ('secondary', 'secondary'),
+            ('supplementary', 'supplementary'),
+            ('duplicates', 'duplicates'),
+            ('mapped', 'mapped ' + self._percent('mapped', 'total')),
+            ('paired', 'paired in sequencing'),
+            ('read1', 'read1'),
+            ('read2', 'read2'),
+            ('proper', 'properly paired ' + self._percent('proper', 'paired')),
+            ('pair_mapped', 'with itself and mate mapped'),
+            ('singleton', 'singletons ' + self._percent('singleton', 'paired')),
+            ('diffchr', 'with mate mapped to a different chr'),
+            ('diffchr_mapq5', 'with mate mapped to a different chr (mapQ>=5)'),
+        ]
+
+        with open(output, 'wt') as writer:
+            for key, label in lines:
+                passed, failed = self.counts[key]
+                writer.write('{} + {} {}\n'.format(passed, failed, label))
+
+    @property
+    def properly_paired(self):
+        return sum(self.counts['proper'])
+
+
+def get_pair_orientation(read):
+    """
+    picard SamPairUtil.getPairOrientation, in 1-based coordinates
+    """
+    if read.is_reverse == read.mate_is_reverse:
+        return 'TANDEM'
+
+    if read.is_reverse:
+        positive_five_prime = read.next_reference_start + 1
+        negative_five_prime = read.reference_end
+    else:
+        positive_five_prime = read.reference_start + 1
+        negative_five_prime = read.reference_start + 1 + read.template_length
+
+    return 'FR' if positive_five_prime < negative_five_prime else 'RF'
+
+
+class Histogram(object):
+    """
+    integer keyed histogram with the htsjdk Histogram statistics
+    """
+
+    def __init__(self, keys, values):
+        self.keys = np.asarray(keys)
+        self.values = np.asarray(values, dtype=np.float64)
+
+    @classmethod
+    def from_counts(cls, counts):
+        keys = sorted(counts)
+        return cls(keys, [counts[k] for k in keys])
+
+    @property
+    def count(self):
+        return self.values.sum()
+
+    def get_median(self):
+        count = self.count
+        if count == 0:
+            return 0.0
+
+        if count % 2 == 0:
+            mid_low = count // 2
+            mid_high = mid_low + 1
+        else:
+            mid_low = mid_high = math.ceil(count / 2)
+
+        cumulative = np.cumsum(self.values)
+        low = self.keys[np.searchsorted(cumulative, mid_low)]
+        high = self.keys[np.searchsorted(cumulative, mid_high)]
+        return (low + high) / 2
+
+    def get_median_absolute_deviation(self):
+        median = self.get_median()
+        deviations = defaultdict(float)
+        for key, value in zip(self.keys, self.values):
+            deviations[abs(key - median)] += value
+        return Histogram.from_counts(deviations).get_median()
+
+    def get_mode(self):
+        return int(self.keys[np.argmax(self.values)])
+
+    def get_mean(self):
+        return float((self.keys * self.values).sum() / self.count)
+
+    def get_standard_deviation(self):
+        count = self.count
+        if count < 2:
+            return float('nan')
+        mean = self.get_mean()
+        return math.sqrt(((self.keys - mean) ** 2 * self.values).sum() / (count - 1))
+
+    def trim_by_width(self, width):
+        keep = self.keys <= width
+        self.keys = self.keys[keep]
+        self.values = self.values[keep]
+
+
+class InsertSizeCollector(object):
+    """
+    picard CollectInsertSizeMetrics: one insert size per pair, taken
+    from the second read of pairs with both mates mapped
+    """
+
+    def __init__(self, include_duplicates=False, minimum_pct=0.05, deviations=10):
+        self.include_duplicates = include_duplicates
+        self.minimum_pct = minimum_pct
+        self.deviations = deviations
+        self.histograms = {v: defaultdict(int) for v in PAIR_ORIENTATIONS}
+
+    def add_read(self, read):
+        flag = read.flag
+
+        if not flag & FLAG_PAIRED:
+            return
+        if flag & (FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | FLAG_READ1 | FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+            return
+        if flag & FLAG_DUPLICATE and not self.include_duplicates:
+            return
+
+        insert_size = abs(read.template_length)
+        if insert_size == 0:
+            return
+
+        self.histograms[get_pair_orientation(read)][insert_size] += 1
+
+    def get_metrics(self):
+        total = sum(sum(v.values()) for v in self.histograms.values())
+
+        metrics = []
+        for orientation in PAIR_ORIENTATIONS:
+            counts = self.histograms[orientation]
+            pairs = sum(counts.values())
+            if not pairs or pairs / total < self.minimum_pct:
+                continue
+
+            histogram = Histogram.from_counts(counts)
+
+            median = histogram.get_median()
+            mad = histogram.get_median_absolute_deviation()
+
+            values = OrderedDict((col, '') for col in INSERT_METRICS_COLUMNS)
+            values['MEDIAN_INSERT_SIZE'] = median
+            values['MODE_INSERT_SIZE'] = histogram.get_mode()
+            values['MEDIAN_ABSOLUTE_DEVIATION'] = mad
+            values['MIN_INSERT_SIZE'] = int(histogram.keys[0])
+            values['MAX_INSERT_SIZE'] = int(histogram.keys[-1])
+            values['READ_PAIRS'] = pairs
+            values['PAIR_ORIENTATION'] = orientation
+            values.update(self._get_widths(histogram, median, pairs))
+
+            histogram.trim_by_width(int(median + self.deviations * mad))
+            values['MEAN_INSERT_SIZE'] = histogram.get_mean()
+            values['STANDARD_DEVIATION'] = histogram.get_standard_deviation()
+
+            metrics.append(values)
+
+        return metrics
+
+    @staticmethod
+    def _get_widths(histogram, median, pairs):
+        """
+        widths of the windows centred on the median that
+        contain each percentage of the read pairs
+        """
+        lookup = dict(zip(histogram.keys, histogram.values))
+        widths = OrderedDict(('WIDTH_OF_{}_PERCENT'.format(v), 0) for v in INSERT_WIDTH_PERCENTS)
+
+        low = high = median
+        covered = 0
+        while low >= histogram.keys[0] or high <= histogram.keys[-1]:
+            covered += lookup.get(int(low), 0)
+            if low != high:
+                covered += lookup.get(int(high), 0)
+
+            distance = int(high - low) + 1
+            for percent in INSERT_WIDTH_PERCENTS:
+                key = 'WIDTH_OF_{}_PERCENT'.format(percent)
+                if covered / pairs >= percent / 100 and widths[key] == 0:
+                    widths[key] = distance
+
+            low -= 1
+            high += 1
+
+        return widths
+
+    def write(self, output, histogram_pdf):
+        metrics = self.get_metrics()
+
+        with open(output, 'wt') as writer:
+            writer.write('## htsjdk.samtools.metrics.StringHeader\n')
+            writer.write('# single_cell in-process CollectInsertSizeMetrics\n')
+            writer.write('\n')
+            writer.write('## METRICS CLASS\tpicard.analysis.InsertSizeMetrics\n')
+            writer.write('\t'.join(INSERT_METRICS_COLUMNS) + '\n')
+            for values in metrics:
+                writer.write('\t'.join(format_metric(v) for v in values.values()) + '\n')
+            writer.write('\n')
+
+            orientations = [v['PAIR_ORIENTATION'] for v in metrics]
+            if orientations:
+                self._write_histogram(writer, orientations)
+
+        self.plot(orientations, histogram_pdf)
+
+    def _write_histogram(self, writer, orientations):
+        writer.write('## HISTOGRAM\tjava.lang.Integer\n')
+        columns = ['All_Reads.{}_count'.format(v.lower()) for v in orientations]
+        writer.write('\t'.join(['insert_size'] + columns) + '\n')
+
+        sizes = sorted(set().union(*[self.histograms[v] for v in orientations]))
+        for size in sizes:
+            row = [size] + [self.histograms[v].get(size, 0) for v in orientations]
+            writer.write('\t'.join(map(str, row)) + '\n')
+        writer.write('\n')
+
+    def plot(self, orientations, histogram_pdf):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots()
+        for orientation in orientations:
+            counts = self.histograms[orientation]
+            sizes = sorted(counts)
+            ax.plot(sizes, [counts[v] for v in sizes], label=orientation)
+        ax.set_xlabel('Insert Size')
+        ax.set_ylabel('Count')
+        ax.set_title('Insert Size Histogram')
+        ax.legend()
+        fig.savefig(histogram_pdf, format='pdf')
+        plt.close(fig)
+
+
+class WgsCoverage(CoverageMetrics):
+    """
+    picard CollectWgsMetrics depth histogram. bases of overlapping
+    mates are counted once, depth is capped at coverage_cap
+    """
+
+    def __init__(
+            self, bamfile, min_mapping_qual=20, min_base_qual=20,
+            count_unpaired=False, coverage_cap=500
+    ):
+        self.coverage_cap = coverage_cap
+        super(WgsCoverage, self).__init__(
+            bamfile,
+            filter_unpaired=not count_unpaired,
+            filter_duplicates=True,
+            filter_supplementary=True,
+            filter_secondary=True,
+            min_mapping_qual=min_mapping_qual,
+            min_base_qual=min_base_qual,
+        )
+
+    def _reset_sweep(self):
+        super(WgsCoverage, self)._reset_sweep()
+        self._starts = []
+        self._ends = []
+        self.histogram = np.zeros(self.coverage_cap + 1, dtype=np.int64)
+
+    def _get_read_intervals(self, read):
+        """
+        aligned blocks of the read, split at bases below min_base_qual
+        """
+        quals = read.query_qualities
+        if not self.min_base_qual or quals is None:
+            return read.get_blocks()
+
+        passed = np.asarray(quals) >= self.min_base_qual
+
+        intervals = []
+        query_pos = 0
+        ref_pos = read.reference_start
+        for op, length in read.cigartuples:
+            if op in (pysam.CMATCH, pysam.CEQUAL, pysam.CDIFF):
+                block = np.concatenate(([False], passed[query_pos:query_pos + length], [False]))
+                edges = np.flatnonzero(block[1:] != block[:-1])
+                intervals.extend(zip(ref_pos + edges[0::2], ref_pos + edges[1::2]))
+                query_pos += length
+                ref_pos += length
+            elif op in (pysam.CINS, pysam.CSOFT_CLIP):
+                query_pos += length
+            elif op in (pysam.CDEL, pysam.CREF_SKIP):
+                ref_pos += length
+
+        return intervals
+
+    def _add_covered_intervals(self, intervals):
+        for start, end in intervals:
+            self._starts.append(start)
+            self._ends.append(end)
+
+    def _flush_all(self):
+        super(WgsCoverage, self)._flush_all()
+        self._update_histogram()
+
+    def _update_histogram(self):
+        """
+        depth of every segment between interval boundaries
+        of the chromosome that was just swept
+        """
+        if not self._starts:
+            return
+
+        starts = np.sort(np.array(self._starts, dtype=np.int64))
+        ends = np.sort(np.array(self._ends, dtype=np.int64))
+        self._starts = []
+        self._ends = []
+
+        bounds = np.unique(np.concatenate((starts, ends)))
+        depth = (np.searchsorted(starts, bounds[:-1], 'right') -
+                 np.searchsorted(ends, bounds[:-1], 'right'))
+        lengths = np.diff(bounds)
+
+        depth = np.minimum(depth, self.coverage_cap)
+        self.histogram += np.bincount(
+            depth, weights=lengths, minlength=self.coverage_cap + 1
+        ).astype(np.int64)
+
+    def get_histogram(self, genome_territory):
+        """
+        depth histogram over the genome territory, the positions
+        no read covers are counted at depth 0
+        """
+        self._flush_all()
+
+        histogram = self.histogram.copy()
+        histogram[0] = max(genome_territory - histogram[1:].sum(), 0)
+        return histogram
+
+    def write(self, output, genome_territory):
+        histogram = self.get_histogram(genome_territory)
+        depths = np.arange(len(histogram))
+
+        metrics = OrderedDict()
+        metrics['GENOME_TERRITORY'] = genome_territory
+        if genome_territory:
+            hist = Histogram(depths, histogram)
+            metrics['MEAN_COVERAGE'] = hist.get_mean()
+            metrics['SD_COVERAGE'] = hist.get_standard_deviation()
+            metrics['MEDIAN_COVERAGE'] = hist.get_median()
+            metrics['MAD_COVERAGE'] = hist.get_median_absolute_deviation()
+        else:
+            metrics['MEAN_COVERAGE'] = 0.0
+            metrics['SD_COVERAGE'] = float('nan')
+            metrics['MEDIAN_COVERAGE'] = 0.0
+            metrics['MAD_COVERAGE'] = 0.0
+        for level in WGS_COVERAGE_LEVELS:
+            covered = histogram[level:].sum()
+            metrics['PCT_{}X'.format(level)] = covered / genome_territory if genome_territory else 0.0
+
+        with open(output, 'wt') as writer:
+            writer.write('## htsjdk.samtools.metrics.StringHeader\n')
+            writer.write('# single_cell in-process CollectWgsMetrics\n')
+            writer.write('\n')
+            writer.write('## METRICS CLASS\tpicard.analysis.WgsMetrics\n')
+            writer.write('\t'.join(metrics.keys()) + '\n')
+            writer.write('\t'.join(format_metric(v) for v in metrics.values()) + '\n')
+            writer.write('\n')
+            writer.write('## HISTOGRAM\tjava.lang.Integer\n')
+            writer.write('coverage\thigh_quality_coverage_count\n')
+            for depth, count in zip(depths, histogram):
+                writer.write('{}\t{}\n'.format(depth, count))
+            writer.write('\n')
+
+
+def get_genome_territory(ref_genome, output, chunk_size=10000000):
+    """
+    count the non-N bases of each reference sequence, the territory
+    picard CollectWgsMetrics reports coverage over. only depends on
+    the reference, so it runs once and is shared by all cells.
+    """
+    territory = {}
+
+    with pysam.FastaFile(ref_genome) as reference:
+        for chrom, length in zip(reference.references, reference.lengths):
+            n_count = 0
+            for start in range(0, length, chunk_size):
+                seq = reference.fetch(chrom, start, min(start + chunk_size, length))
+                n_count += seq.count('N') + seq.count('n')
+            territory[chrom] = length - n_count
+
+    with open(output, 'wt') as writer:
+        yaml.dump(territory, writer, default_flow_style=False)
+
+
+def collect_bam_qc(
+        bamfile, genome_territory, flagstat_metrics, insert_metrics,
+        insert_pdf, wgs_metrics, gc_read_starts, wgs_params,
+        sampling_fraction=None
+):
+    """
+    flagstat, insert size and wgs coverage metrics and the gc window
+    read starts from a single scan of the bam. replaces samtools
+    flagstat and picard CollectInsertSizeMetrics and CollectWgsMetrics.
+    with a sampling_fraction the metrics only use the subsample of
+    read pairs picked by sampling.PairSampler.
+    """
+    sampler = sampling.get_sampler(sampling_fraction)
+
+    with open(genome_territory, 'rt') as reader:
+        territory = yaml.safe_load(reader)
+
+    flagstat = FlagstatCounter()
+    insert_size = InsertSizeCollector()
+    gc_starts = GcReadStarts()
+    wgs = WgsCoverage(
+        bamfile,
+        min_mapping_qual=wgs_params['min_mqual'],
+        min_base_qual=wgs_params['min_bqual'],
+        count_unpaired=wgs_params['count_unpaired'],
+    )
+
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        references = bam.references
+        genome_territory = sum(territory.get(chrom, 0) for chrom in references)
+
+        for read in bam.fetch(until_eof=True):
+            if sampler is not None and not sampler.keep(read):
+                continue
+
+            flagstat.add_read(read)
+            insert_size.add_read(read)
+            gc_starts.add_read(read)
+            wgs.add_read(read)
+
+    flagstat.write(flagstat_metrics)
+    wgs.write(wgs_metrics, genome_territory)
+    gc_starts.write(gc_read_starts, references)
+
+    if not flagstat.properly_paired:
+        with open(insert_metrics, 'w') as f:
+            f.write('## FAILED: No properly paired reads\n')
+        with open(insert_pdf, 'w'):
+            pass
+        return
+
+    insert_size.write(insert_metrics, insert_pdf)
@@ -0,0 +1,181 @@
+import os
+from collections import defaultdict
+
+import numpy as np
+import pysam
+from single_cell.utils.tests import bam_helpers
+from single_cell.workflows.align import bam_qc
+from single_cell.workflows.align import sampling
+from single_cell.workflows.align.scripts import CollectMetrics
+
+CHROM_LENGTH = 20000
+
+
+def write_reference(filepath):
+    with open(filepath, 'wt') as writer:
+        for chrom in ('1', '2'):
+            # 1kb of N at the start of each chromosome
+            writer.write('>{}\n{}\n'.format(chrom, 'N' * 1000 + 'A' * (CHROM_LENGTH - 1000)))
+    pysam.faidx(filepath)
+
+
+LENGTHS = [('1', CHROM_LENGTH), ('2', CHROM_LENGTH)]
+
+SIMULATION = dict(
+    # reads start after the N at the start of the chromosomes
+    start_margin=1000, set_mates=True,
+    flag_rates=[(1024, 0.2), (256, 0.05), (512, 0.05)],
+    cigars=['100M', '50M10I40M', '30M20D70M', '10S90M'], mapping_qualities=[0, 30, 60],
+    random_qualities=True,
+    # fragment and a pair with an unmapped mate
+    extra_reads=[
+        dict(query_name=name, reference_id=0, reference_start=5000, flag=flag)
+        for name, flag in (('frag', 0), ('single', 1 + 8 + 64))
+    ],
+)
+
+
+def naive_depth(reads, min_mqual, min_bqual):
+    covered = defaultdict(set)
+    for read in reads:
+        if read.flag & (4 | 256 | 1024 | 2048) or not read.is_paired:
+            continue
+        if read.mapping_quality < min_mqual:
+            continue
+        quals = read.query_qualities
+        for qpos, rpos in read.get_aligned_pairs(matches_only=True):
+            if quals[qpos] >= min_bqual:
+                covered[read.query_name].add((read.reference_id, rpos))
+
+    depth = defaultdict(int)
+    for positions in covered.values():
+        for pos in positions:
+            depth[pos] += 1
+    return depth
+
+
+def run_collector(tmpdir):
+    reference = os.path.join(tmpdir, 'ref.fa')
+    bamfile = os.path.join(tmpdir, 'test.bam')
+    write_reference(reference)
+    reads = bam_helpers.simulate_bam(bamfile, LENGTHS, num_pairs=500, **SIMULATION)
+
+    outputs = {
+        key: os.path.join(tmpdir, key) for key in
+        ('territory.yaml', 'flagstat.txt', 'insert.txt', 'insert.pdf', 'wgs.txt', 'gc.npz')
+    }
+
+    bam_qc.get_genome_territory(reference, outputs['territory.yaml'])
+    bam_qc.collect_bam_qc(
+        bamfile, outputs['territory.yaml'], outputs['flagstat.txt'],
+        outputs['insert.txt'], outputs['insert.pdf'], outputs['wgs.txt'],
+        outputs['gc.npz'], {'min_bqual': 20, 'min_mqual': 20, 'count_unpaired': False},
+    )
+
+    collect = CollectMetrics(
+        outputs['wgs.txt'], outputs['insert.txt'], outputs['flagstat.txt'],
+        None, None, 'cell', None
+    )
+    return reads, collect, outputs
+
+
+def test_flagstat(tmpdir):
+    reads, collect, outputs = run_collector(str(tmpdir))
+
+    total, mapped, duplicates, proper = collect.extract_flagstat_metrics()
+
+    passed = [r for r in reads if not r.is_qcfail]
+    assert total == len(passed)
+    assert mapped == len(passed)
+    assert duplicates == len([r for r in passed if r.is_duplicate])
+    assert proper == len([r for r in passed if r.is_proper_pair and not r.is_secondary])
+
+    with open(outputs['flagstat.txt']) as reader:
+        lines = reader.readlines()
+    assert lines[0].startswith('{} + {} in total'.format(len(passed), len(reads) - len(passed)))
+
+
+def test_wgs_metrics(tmpdir):
+    reads, collect, _ = run_collector(str(tmpdir))
+
+    depth = naive_depth(reads, 20, 20)
+    territory = 2 * (CHROM_LENGTH - 1000)
+
+    breadth, mean_depth = collect.extract_wgs_metrics()
+
+    assert abs(breadth - len(depth) / territory) < 1e-9
+    assert abs(mean_depth - sum(depth.values()) / territory) < 1e-6
+
+
+def test_insert_metrics(tmpdir):
+    reads, collect, outputs = run_collector(str(tmpdir))
+
+    inserts = [
+        abs(r.template_length) for r in reads
+        if r.is_read2 and not r.flag & (256 | 1024 | 2048)
+    ]
+
+    median, mean, std = collect.extract_insert_metrics()
+    assert float(median) == np.median(inserts)
+
+    # mean and sd are computed on the histogram trimmed of outliers
+    assert abs(float(mean) - np.mean(inserts)) < 1e-4
+    assert abs(float(std) - np.std(inserts, ddof=1)) < 1e-4
+
+    assert os.path.getsize(outputs['insert.pdf']) > 0
+
+
+def test_get_pair_orientation():
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': '1', 'LN': 1000}]})
+    read = pysam.AlignedSegment(header)
+    read.reference_id = 0
+    read.reference_start = 100
+    read.cigarstring = '100M'
+    read.next_reference_start = 300
+    read.template_length = 300
+
+    read.flag = 1 + 32
+    assert bam_qc.get_pair_orientation(read) == 'FR'
+
+    read.flag = 1 + 16 + 32
+    assert bam_qc.get_pair_orientation(read) == 'TANDEM'
+
+    # reverse read upstream of its forward mate
+    read.flag = 1 + 16
+    assert bam_qc.get_pair_orientation(read) == 'RF'
+
+
+def test_sampled_metrics(tmpdir):
+    tmpdir = str(tmpdir)
+    reference = os.path.join(tmpdir, 'ref.fa')
+    bamfile = os.path.join(tmpdir, 'test.bam')
+    write_reference(reference)
+    reads = bam_helpers.simulate_bam(bamfile, LENGTHS, **SIMULATION)
+
+    outputs = {
+        key: os.path.join(tmpdir, key) for key in
+        ('territory.yaml', 'flagstat.txt', 'insert.txt', 'insert.pdf', 'wgs.txt', 'gc.npz')
+    }
+    bam_qc.get_genome_territory(reference, outputs['territory.yaml'])
+    bam_qc.collect_bam_qc(
+        bamfile, outputs['territory.yaml'], outputs['flagstat.txt'],
+        outputs['insert.txt'], outputs['insert.pdf'], outputs['wgs.txt'],
+        outputs['gc.npz'], {'min_bqual': 20, 'min_mqual': 20, 'count_unpaired': False},
+        sampling_fraction=0.5,
+    )
+
+    collect = CollectMetrics(
+        outputs['wgs.txt'], outputs['insert.txt'], outputs['flagstat.txt'],
+        None, None, 'cell', None, sampling_fraction=0.5
+    )
+    flagstat = collect.extract_flagstat_metrics()
+    (total, mapped, _, _), _, header, intervals = collect.estimate_from_sample(
+        flagstat, collect.extract_wgs_metrics()
+    )
+
+    sampler = sampling.PairSampler(0.5)
+    passed = [r for r in reads if not r.is_qcfail]
+    assert flagstat[0] == len([r for r in passed if sampler.keep(r)])
+
+    assert header[0] == 'qc_sampling_fraction' and intervals[0] == 0.5
+    assert abs(total - len(passed)) <= intervals[1]
@@ -1,8 +1,9 @@
-from collections import defaultdict
+import heapq
 
 import pysam
 import yaml
 from single_cell.utils import csvutils
+from single_cell.workflows.align import sampling
 from single_cell.workflows.align.dtypes import dtypes
 
 
@@ -25,6 +26,7 @@ class CoverageMetrics(object):
         self.min_mapping_qual = min_mapping_qual
         self.min_base_qual = min_base_qual
         self._bam_reader = None
+        self._reset_sweep()
 
     def __enter__(self):
         self._bam_reader = self._get_bam_reader()
@@ -88,100 +90,152 @@ class CoverageMetrics(object):
 
     @staticmethod
     def _merge_overlapping_intervals(coords):
-        coords.sort(key=lambda x: x[0])
+        coords = sorted(coords)
 
-        if len(coords) < 2:
-            return coords
-        elif len(coords) == 2:
-            if coords[1][0] <= coords[0][1]:
-                return [[coords[0][0], max(coords[0][1], coords[1][1])]]
+        merged = []
+        for start, end in coords:
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
             else:
-                return coords
-        else:
-            i = 0
-            while i < len(coords) - 1:
-                if i < len(coords) - 1:
-                    if coords[i + 1][0] <= coords[i][1]:
-                        start = coords[i][0]
-                        end = max(coords[i][1], coords[i + 1][1])
-                        del coords[i + 1]
-                        coords[i] = [start, end]
-                    else:
-                        i += 1
-                else:
-                    i += 1
-            return coords
-
-    def generate_data(self):
-        read_dict = defaultdict(lambda: defaultdict(list))
-        for read in self._bam_reader.fetch():
-            if self._filter_reads(read) is True:
-                continue
-
-            regions = self._get_read_intervals(read)
-            read_dict[read.query_name][read.reference_name].extend(regions)
-        return read_dict
-
-    def get_coverage(self, read_dict):
-        total_length = 0
-        for rname, chromdata in read_dict.items():
-            for chrom, regions in chromdata.items():
-                regions = self._merge_overlapping_intervals(regions)
-                chrom_length = sum([v[1] - v[0] for v in regions])
-
-                total_length += chrom_length
-
-        return float(total_length) / self.genome_length
+                merged.append([start, end])
+
+        return merged
+
+    def _reset_sweep(self):
+        # intervals of reads that may still overlap reads further along
+        # the sweep, keyed on read name as [max_end, intervals]
+        self._pending = {}
+        self._pending_ends = []
+        self._sweep_chrom = None
+        self.covered_length = 0
+
+    def _flush_read(self, read_name):
+        _, intervals = self._pending.pop(read_name)
+        self._add_covered_intervals(self._merge_overlapping_intervals(intervals))
+
+    def _add_covered_intervals(self, intervals):
+        self.covered_length += sum([v[1] - v[0] for v in intervals])
+
+    def _flush_until(self, position):
+        """
+        reads are coordinate sorted, so once the sweep reaches the end of
+        all intervals of a read name nothing that comes later can overlap
+        them and their covered length is final
+        """
+        while self._pending_ends and self._pending_ends[0][0] <= position:
+            end, read_name = heapq.heappop(self._pending_ends)
+            entry = self._pending.get(read_name)
+            if entry is not None and entry[0] == end:
+                self._flush_read(read_name)
+
+    def _flush_all(self):
+        for read_name in list(self._pending):
+            self._flush_read(read_name)
+        self._pending_ends = []
+
+    def add_read(self, read):
+        if self._filter_reads(read) is True:
+            return
+
+        if read.reference_id != self._sweep_chrom:
+            self._flush_all()
+            self._sweep_chrom = read.reference_id
+
+        self._flush_until(read.reference_start)
+
+        regions = self._get_read_intervals(read)
+        if not regions:
+            return
+
+        entry = self._pending.get(read.query_name)
+        if entry is None:
+            entry = self._pending[read.query_name] = [None, []]
+        entry[1].extend(regions)
+
+        max_end = max([v[1] for v in regions])
+        if entry[0] is None or max_end > entry[0]:
+            entry[0] = max_end
+            heapq.heappush(self._pending_ends, (max_end, read.query_name))
+
+    def get_coverage(self, genome_length=None):
+        if genome_length is None:
+            genome_length = self.genome_length
+
+        self._flush_all()
+
+        return float(self.covered_length) / genome_length
 
     def main(self):
         if self._bam_reader is None:
             self._bam_reader = self._get_bam_reader()
 
-        read_data = self.generate_data()
-        coverage = self.get_coverage(read_data)
-        return coverage
+        self._reset_sweep()
 
+        for read in self._bam_reader.fetch():
+            self.add_read(read)
+
+        return self.get_coverage()
+
+
+def get_coverage_data(
+        bamfile, output, cell_id, mapping_qual=10, base_qual=10,
+        sampling_fraction=None
+):
+    """
+    compute the expected and aligned coverage and the coverage
+    breadth under each read filter from a single scan of the bam.
+    with a sampling_fraction only the sampled read pairs are scanned
+    and the full bam values are estimated from them.
+    """
+    sampler = sampling.get_sampler(sampling_fraction)
+
+    filters = [
+        ('overlap_with_dups', {}),
+        ('overlap_without_dups', {'filter_duplicates': True}),
+        ('overlap_with_all_filters', {
+            'filter_duplicates': True, 'filter_secondary': True,
+            'filter_supplementary': True, 'filter_unpaired': True
+        }),
+        ('overlap_with_all_filters_and_qual', {
+            'filter_duplicates': True, 'filter_secondary': True,
+            'filter_supplementary': True, 'filter_unpaired': True,
+            'min_base_qual': base_qual, 'min_mapping_qual': mapping_qual
+        }),
+    ]
+
+    collectors = [(key, CoverageMetrics(bamfile, **kwargs)) for key, kwargs in filters]
 
-def expected_and_aligned_coverage(bamfile):
-    with CoverageMetrics(bamfile) as cov:
-        genome_length = cov.genome_length
-
-    bam = pysam.AlignmentFile(bamfile, 'rb')
     expected_length = 0
     aligned_length = 0
-    for read in bam:
-        expected_length += read.query_length
-        aligned_length += 0 if read.reference_length is None else read.reference_length
-
-    return expected_length / genome_length, aligned_length / genome_length
 
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        genome_length = sum(bam.lengths)
 
-def get_coverage_data(bamfile, output, cell_id, mapping_qual=10, base_qual=10):
-    outdata = {'cell_id': cell_id}
+        for read in bam.fetch(until_eof=True):
+            if sampler is not None and not sampler.keep(read):
+                continue
 
-    expected_cov, aligned_cov = expected_and_aligned_coverage(bamfile)
+            expected_length += read.query_length
+            aligned_length += 0 if read.reference_length is None else read.reference_length
 
-    outdata['expected'] = expected_cov
-    outdata['aligned'] = aligned_cov
+            for _, collector in collectors:
+                collector.add_read(read)
 
-    with CoverageMetrics(bamfile) as cov:
-        outdata['overlap_with_dups'] = cov.main()
+    outdata = {'cell_id': cell_id}
 
-    with CoverageMetrics(bamfile, filter_duplicates=True) as cov:
-        outdata['overlap_without_dups'] = cov.main()
+    outdata['expected'] = expected_length / genome_length
+    outdata['aligned'] = aligned_length / genome_length
 
-    with CoverageMetrics(
-            bamfile, filter_duplicates=True, filter_secondary=True,
-            filter_supplementary=True, filter_unpaired=True
-    ) as cov:
-        outdata['overlap_with_all_filters'] = cov.main()
+    for key, collector in collectors:
+        outdata[key] = collector.get_coverage(genome_length=genome_length)
 
-    with CoverageMetrics(
-            bamfile, filter_duplicates=True, filter_secondary=True,
-            filter_supplementary=True, filter_unpaired=True,
-            min_base_qual=base_qual, min_mapping_qual=mapping_qual
-    ) as cov:
-        outdata['overlap_with_all_filters_and_qual'] = cov.main()
+    # the overlap values are covered bases summed over read names, not a
+    # breadth, so like the expected and aligned coverage they scale
+    # linearly with the number of sampled pairs
+    if sampler is not None:
+        for key in ['expected', 'aligned'] + [key for key, _ in collectors]:
+            outdata[key] /= sampler.fraction
 
     with open(output, 'wt') as writer:
         yaml.dump(outdata, writer)
@@ -0,0 +1,68 @@
+import os
+from collections import defaultdict
+
+import pysam
+import yaml
+from single_cell.utils.tests import bam_helpers
+from single_cell.workflows.align.coverage_metrics import CoverageMetrics
+from single_cell.workflows.align.coverage_metrics import get_coverage_data
+
+
+LENGTHS = [('1', 50000), ('2', 50000)]
+
+# short inserts make the mates overlap
+SIMULATION = dict(
+    flag_rates=[(1024, 0.2)], cigars=['100M', '50M10I40M', '30M20D70M'],
+    mapping_qualities=[0, 30, 60], random_qualities=True,
+)
+
+
+def naive_coverage(bamfile, **kwargs):
+    cov = CoverageMetrics(bamfile, **kwargs)
+
+    intervals = defaultdict(set)
+    with pysam.AlignmentFile(bamfile) as reader:
+        genome_length = sum(reader.lengths)
+        for read in reader.fetch():
+            if cov._filter_reads(read):
+                continue
+            for start, end in cov._get_read_intervals(read):
+                intervals[(read.query_name, read.reference_id)].update(range(start, end))
+
+    return sum(len(v) for v in intervals.values()) / float(genome_length)
+
+
+def test_sweep_matches_naive(tmpdir):
+    bamfile = os.path.join(str(tmpdir), 'test.bam')
+    bam_helpers.simulate_bam(bamfile, LENGTHS, **SIMULATION)
+
+    for kwargs in ({}, {'filter_duplicates': True}, {'min_mapping_qual': 10, 'min_base_qual': 10}):
+        with CoverageMetrics(bamfile, **kwargs) as cov:
+            assert abs(cov.main() - naive_coverage(bamfile, **kwargs)) < 1e-12
+
+
+def test_merge_overlapping_intervals():
+    merged = CoverageMetrics._merge_overlapping_intervals([(10, 20), (0, 5), (5, 8), (15, 30), (40, 50)])
+    assert merged == [[0, 8], [10, 30], [40, 50]]
+
+
+def test_sampled_coverage_data(tmpdir):
+    tmpdir = str(tmpdir)
+    bamfile = os.path.join(tmpdir, 'test.bam')
+    # deep enough that the sampled overlap values exceed 1
+    bam_helpers.simulate_bam(bamfile, LENGTHS, num_pairs=6000, **SIMULATION)
+
+    full_yaml = os.path.join(tmpdir, 'full.yaml')
+    get_coverage_data(bamfile, full_yaml, 'cell')
+    sampled_yaml = os.path.join(tmpdir, 'sampled.yaml')
+    get_coverage_data(bamfile, sampled_yaml, 'cell', sampling_fraction=0.5)
+
+    with open(full_yaml) as reader:
+        full = yaml.safe_load(reader)
+    with open(sampled_yaml) as reader:
+        sampled = yaml.safe_load(reader)
+
+    assert full['overlap_with_dups'] > 1
+    for key in ('expected', 'aligned', 'overlap_with_dups', 'overlap_without_dups',
+                'overlap_with_all_filters', 'overlap_with_all_filters_and_qual'):
+        assert abs(sampled[key] - full[key]) < 0.1 * full[key]
@@ -38,6 +38,13 @@ def dtypes():
         'overlap_with_dups': 'float',
         'overlap_without_dups': 'float',
         'is_control': 'bool',
+        'qc_sampling_fraction': 'float',
+        'total_reads_ci95': 'float',
+        'total_mapped_reads_ci95': 'float',
+        'total_duplicate_reads_ci95': 'float',
+        'total_properly_paired_ci95': 'float',
+        'coverage_depth_ci95': 'float',
+        'mean_insert_size_ci95': 'float',
     }
 
     gc = {str(i): 'float' for i in range(0, 101)}
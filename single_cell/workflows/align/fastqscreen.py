@@ -1,12 +1,12 @@
 import os
 import shutil
+import tarfile
 from collections import defaultdict
 
 import pandas as pd
 import pypeliner
 import single_cell.workflows.align.fastqscreen_utils as utils
 from single_cell.utils import csvutils
-from single_cell.utils import fastqutils
 from single_cell.utils import helpers
 from single_cell.workflows.align.dtypes import fastqscreen_dtypes
 
@@ -50,7 +50,7 @@ def merge_fastq_screen_counts(
     )
 
 
-def run_fastq_screen_paired_end(fastq_r1, fastq_r2, tempdir, params):
+def run_fastq_screen_paired_end(fastq_r1, fastq_r2, tempdir, params, threads=1):
     r1_basename, r1_ext = utils.get_basename(fastq_r1)
     tagged_fastq_r1 = os.path.join(tempdir, '{}.tagged{}'.format(r1_basename, r1_ext))
 
@@ -70,18 +70,12 @@ def run_fastq_screen_paired_end(fastq_r1, fastq_r2, tempdir, params):
         '--aligner', params['aligner'],
         '--conf', config,
         '--outdir', tempdir,
+        '--threads', threads,
         '--tag',
         fastq_r1, fastq_r2,
     )
 
-    if utils.regroup_needed(params):
-        fixed_fastq_r1 = os.path.join(tempdir, '{}.tagged.fixed{}'.format(r1_basename, r1_ext))
-        fixed_fastq_r2 = os.path.join(tempdir, '{}.tagged.fixed{}'.format(r2_basename, r2_ext))
-        utils.regroup_genomes(tagged_fastq_r1, fixed_fastq_r1)
-        utils.regroup_genomes(tagged_fastq_r2, fixed_fastq_r2)
-        return fixed_fastq_r1, fixed_fastq_r2
-    else:
-        return tagged_fastq_r1, tagged_fastq_r2
+    return tagged_fastq_r1, tagged_fastq_r2
 
 
 def write_detailed_counts(counts, outfile, cell_id, fastqscreen_params):
@@ -170,13 +164,134 @@ def organism_filter(
         fastq_r1, fastq_r2, tempdir, params,
     )
 
-    reader = fastqutils.PairedTaggedFastqReader(tagged_fastq_r1, tagged_fastq_r2)
-    counts = reader.gather_counts()
+    # regroup, count and filter in a single pass over the tagged fastqs
+    counts = utils.filter_tag_reads(
+        tagged_fastq_r1, tagged_fastq_r2, filtered_fastq_r1,
+        filtered_fastq_r2, params
+    )
 
     write_detailed_counts(counts, detailed_metrics, cell_id, params)
     write_summary_counts(counts, summary_metrics, cell_id, params)
 
-    utils.filter_tag_reads(
-        tagged_fastq_r1, tagged_fastq_r2, filtered_fastq_r1,
-        filtered_fastq_r2, params
+
+def merge_counts(all_counts):
+    merged = {'R1': defaultdict(int), 'R2': defaultdict(int)}
+    for counts in all_counts:
+        for read_end, read_end_counts in counts.items():
+            for flags, count in read_end_counts.items():
+                merged[read_end][flags] += count
+    return merged
+
+
+def get_screen_batches(keys, batch_size):
+    """
+    splits the cells of the (cell_id, lane) keys into batches of at
+    most batch_size cells, all lanes of a cell are in the same batch
+    """
+    cell_ids = sorted(set(cell_id for cell_id, _ in keys))
+    return {
+        batch: cell_ids[start:start + batch_size]
+        for batch, start in enumerate(range(0, len(cell_ids), batch_size))
+    }
+
+
+def _get_batch_member(cell_id, name):
+    return '{}/{}'.format(cell_id, name)
+
+
+def organism_filter_batch(
+        fastq_r1, fastq_r2, screened_tar, tempdir, batch, screen_batches,
+        params, threads=1
+):
+    """
+    screen the fastqs of one batch of cells with a single fastq_screen
+    run, so the screening indexes are loaded once per batch. reads are
+    prefixed with their cell and lane before screening and split back
+    into per cell and lane filtered fastqs and per cell counts, which
+    are written to screened_tar for demultiplex_screened_batch.
+
+    fastq inputs are keyed on (cell_id, lane).
+    """
+    if os.path.exists(tempdir):
+        shutil.rmtree(tempdir)
+
+    helpers.makedirs(tempdir)
+
+    batch_cells = screen_batches[batch]
+    keys = sorted(key for key in fastq_r1 if key[0] in batch_cells)
+
+    batch_r1 = os.path.join(tempdir, 'batch_R1.fastq.gz')
+    batch_r2 = os.path.join(tempdir, 'batch_R2.fastq.gz')
+
+    utils.write_batch_fastqs(
+        [(fastq_r1[key], fastq_r2[key]) for key in keys], batch_r1, batch_r2
+    )
+
+    tagged_r1, tagged_r2 = run_fastq_screen_paired_end(
+        batch_r1, batch_r2, tempdir, params, threads=threads
     )
+
+    outdir = os.path.join(tempdir, 'screened')
+    members = {}
+
+    def add_member(cell_id, name):
+        member = _get_batch_member(cell_id, name)
+        members[member] = os.path.join(outdir, member)
+        helpers.makedirs(members[member], isfile=True)
+        return members[member]
+
+    outputs = [
+        (add_member(cell_id, '{}_R1.fastq.gz'.format(lane)), add_member(cell_id, '{}_R2.fastq.gz'.format(lane)))
+        for cell_id, lane in keys
+    ]
+
+    if helpers.is_empty(tagged_r1):
+        # no reads in the batch, nothing was screened
+        counts = [{'R1': {}, 'R2': {}} for _ in keys]
+        for output_r1, output_r2 in outputs:
+            shutil.copy(tagged_r1, output_r1)
+            shutil.copy(tagged_r2, output_r2)
+    else:
+        counts = utils.demultiplex_tag_reads(tagged_r1, tagged_r2, outputs, params)
+
+    cell_counts = {cell_id: [] for cell_id in batch_cells}
+    for key, key_counts in zip(keys, counts):
+        cell_counts[key[0]].append(key_counts)
+
+    for cell_id in batch_cells:
+        counts = merge_counts(cell_counts[cell_id])
+
+        write_detailed_counts(counts, add_member(cell_id, 'detailed.csv.gz'), cell_id, params)
+        write_summary_counts(counts, add_member(cell_id, 'summary.csv.gz'), cell_id, params)
+
+    # uncompressed, the members are already gzipped
+    with tarfile.open(screened_tar, 'w') as tar:
+        for member, filepath in members.items():
+            tar.add(filepath, arcname=member)
+
+    shutil.rmtree(tempdir)
+
+
+def demultiplex_screened_batch(
+        screened_tars, filtered_fastq_r1, filtered_fastq_r2,
+        detailed_metrics, summary_metrics, cell_id, screen_batches
+):
+    """
+    extract the filtered fastqs of each lane and the counts of a cell
+    from the output of the organism_filter_batch job of its batch.
+    filtered fastq outputs are keyed on lane.
+    """
+    batch = [k for k, v in screen_batches.items() if cell_id in v][0]
+
+    outputs = {
+        _get_batch_member(cell_id, 'detailed.csv.gz'): detailed_metrics,
+        _get_batch_member(cell_id, 'summary.csv.gz'): summary_metrics,
+    }
+    for lane in filtered_fastq_r1:
+        outputs[_get_batch_member(cell_id, '{}_R1.fastq.gz'.format(lane))] = filtered_fastq_r1[lane]
+        outputs[_get_batch_member(cell_id, '{}_R2.fastq.gz'.format(lane))] = filtered_fastq_r2[lane]
+
+    with tarfile.open(screened_tars[batch], 'r') as tar:
+        for member, output in outputs.items():
+            with tar.extractfile(member) as reader, open(output, 'wb') as writer:
+                shutil.copyfileobj(reader, writer)
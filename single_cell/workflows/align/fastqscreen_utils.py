@@ -1,9 +1,21 @@
 import gzip
 import os
+import resource
+from collections import OrderedDict
+from collections import defaultdict
 
 from single_cell.utils import fastqutils
 from single_cell.utils import helpers
 
+# read name prefix that records which input of a screening batch a read came from
+BATCH_PREFIX_START = 'SCB'
+BATCH_PREFIX_END = '|'
+BATCH_PREFIX = BATCH_PREFIX_START + '{}' + BATCH_PREFIX_END
+
+# file descriptors kept free for the readers and whatever
+# else the process has open
+RESERVED_FILE_HANDLES = 64
+
 
 def get_basename(filepath):
     filepath_base = os.path.basename(filepath)
@@ -50,65 +62,236 @@ def generate_fastqscreen_config(filepath, params):
                 config_writer.write('DATABASE\t{}\t{}\n'.format(genome_name, genome_paths))
 
 
-def update_read_tags(read, newtags):
-    start, tag = read[0].split('#FQST:')
-
-    if len(tag.split(':')) > 1:
-        tag = ':'.join(newtags.keys()) + ':' + ''.join([str(v) for v in newtags.values()])
-    else:
-        tag = ''.join([str(v) for v in newtags.values()])
-
-    read[0] = '{}#FQST:{}\n'.format(start, tag)
-
-    return read
-
-
-def regroup_genomes(input_fastq, output_fastq):
-    reader = fastqutils.TaggedFastqReader(input_fastq)
+def regroup_tags(tags):
+    """
+    collapse the per path flags of genomes with multiple index paths
+    (genome_path0, genome_path1 ...) into a single flag per genome
+    """
+    newtags = {}
+    for tag, val in tags.items():
+
+        if '_path' in tag:
+            tag = tag.split('_path')[0]
+
+        if tag in newtags:
+            newtags[tag] = max(val, newtags[tag])
+        else:
+            newtags[tag] = val
+
+    return newtags
+
+
+class TagResolver(object):
+    """
+    resolves fastq_screen tags into the filter decision, the count key
+    and the genome flags written to the read comment. there are only a
+    handful of distinct tags per file, so each one is resolved once.
+    """
+
+    def __init__(self, reader, params):
+        self.reader = reader
+        self.genomes = [v['name'] for v in params['genomes']]
+        self.filter_tags = set(params['filter_tags']) if params['filter_tags'] else set()
+        self.regroup = regroup_needed(params)
+        self._tag_info = {}
+
+    def get_tag_info(self, fq_tag):
+        info = self._tag_info.get(fq_tag)
+        if info is None:
+            tags = self.reader.parse_raw_read_tag(fq_tag)
+            if self.regroup:
+                tags = regroup_tags(tags)
+            flags = ''.join([str(tags[genome]) for genome in self.genomes])
+            count_key = tuple((key, tags[key]) for key in sorted(tags))
+            info = (flags in self.filter_tags, count_key, tags)
+            self._tag_info[fq_tag] = info
+        return info
+
+    def filter_pair(self, read_1, read_2, raw_counts):
+        """
+        count the raw tags of the pair and return it with the tags
+        moved to the read comments, or None if it is filtered
+        """
+        fq_tag_r1 = self.reader.get_raw_read_tag(read_1)
+        fq_tag_r2 = self.reader.get_raw_read_tag(read_2)
+
+        raw_counts['R1'][fq_tag_r1] += 1
+        raw_counts['R2'][fq_tag_r2] += 1
+
+        skip_r1, _, tags_r1 = self.get_tag_info(fq_tag_r1)
+        skip_r2, _, tags_r2 = self.get_tag_info(fq_tag_r2)
+
+        if skip_r1 or skip_r2:
+            return None
+
+        read_1 = self.reader.add_tag_to_read_comment(read_1, tag=tags_r1)
+        read_2 = self.reader.add_tag_to_read_comment(read_2, tag=tags_r2)
+
+        return read_1, read_2
+
+    def collapse_counts(self, raw_counts):
+        counts = {'R1': defaultdict(int), 'R2': defaultdict(int)}
+        for read_end, read_end_counts in raw_counts.items():
+            for fq_tag, count in read_end_counts.items():
+                counts[read_end][self.get_tag_info(fq_tag)[1]] += count
+        return counts
 
-    assert output_fastq.endswith('gz')
-    output = gzip.open(output_fastq, 'wt')
 
-    for read in reader.get_read_iterator():
-        tags = reader.get_read_tag(read)
-
-        newtags = {}
-        for tag, val in tags.items():
+def filter_tag_reads(
+        input_r1, input_r2, output_r1, output_r2, params
+):
+    """
+    single pass over the fastq_screen tagged fastqs. regroups multi path
+    genomes, counts the tag combinations per read end, drops the pairs
+    matching the filter tags and writes the rest with the tags moved
+    to the read comment.
+
+    returns the tag counts in the same layout as
+    PairedTaggedFastqReader.gather_counts
+    """
+    reader = fastqutils.PairedTaggedFastqReader(input_r1, input_r2)
+    resolver = TagResolver(reader, params)
 
-            if '_path' in tag:
-                tag = tag.split('_path')[0]
+    raw_counts = {'R1': defaultdict(int), 'R2': defaultdict(int)}
 
-            if tag in newtags:
-                newtags[tag] = max(val, newtags[tag])
-            else:
-                newtags[tag] = val
+    with helpers.getFileHandle(output_r1, 'wt') as writer_r1, helpers.getFileHandle(output_r2, 'wt') as writer_r2:
+        for read_1, read_2 in reader.get_read_pair_iterator():
+            pair = resolver.filter_pair(read_1, read_2, raw_counts)
+            if pair is None:
+                continue
 
-        read = update_read_tags(read, newtags)
+            writer_r1.writelines(pair[0])
+            writer_r2.writelines(pair[1])
 
-        for line in read:
-            output.write(line)
+    return resolver.collapse_counts(raw_counts)
 
 
-def filter_tag_reads(
-        input_r1, input_r2, output_r1, output_r2, params
-):
-    genomes = [v['name'] for v in params['genomes']]
+def add_batch_prefix(read, index):
+    read[0] = '@' + BATCH_PREFIX.format(index) + read[0][1:]
+    return read
 
-    if not params['filter_tags']:
-        filter_tags = set()
-    else:
-        filter_tags = set(params['filter_tags'])
 
+def pop_batch_prefix(read):
+    """
+    strip the batch prefix from the read name and return the
+    index of the input the read came from
+    """
+    index, name = read[0][1 + len(BATCH_PREFIX_START):].split(BATCH_PREFIX_END, 1)
+    read[0] = '@' + name
+    return int(index)
+
+
+def write_batch_fastqs(inputs, batch_r1, batch_r2):
+    """
+    concatenate the read pairs of many inputs into one pair of fastqs,
+    the read names are prefixed with the index of their input
+    """
+    num_reads = 0
+    with helpers.getFileHandle(batch_r1, 'wt') as writer_r1, helpers.getFileHandle(batch_r2, 'wt') as writer_r2:
+        for index, (fastq_r1, fastq_r2) in enumerate(inputs):
+            reader = fastqutils.PairedFastqReader(fastq_r1, fastq_r2)
+            for read_1, read_2 in reader.get_read_pair_iterator():
+                writer_r1.writelines(add_batch_prefix(read_1, index))
+                writer_r2.writelines(add_batch_prefix(read_2, index))
+                num_reads += 1
+    return num_reads
+
+
+def get_max_open_writers():
+    """
+    output pairs that can be open at once within the open file limit
+    """
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        soft_limit = 65536
+    return max(1, (soft_limit - RESERVED_FILE_HANDLES) // 2)
+
+
+def _open_output(filepath, mode):
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, mode)
+    return open(filepath, mode)
+
+
+class PairedWriterPool(object):
+    """
+    writers of (output_r1, output_r2) pairs, at most max_open pairs are
+    open at once. the least recently used pair is closed when the pool is
+    full and reopened for appending when it is written again, which adds
+    a gzip member. every output exists once the pool is closed.
+    """
+
+    def __init__(self, outputs, max_open=None):
+        if max_open is None:
+            max_open = get_max_open_writers()
+
+        self.outputs = outputs
+        self.max_open = max(1, max_open)
+
+        self._writers = OrderedDict()
+        self._opened = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_writers(self, index):
+        if index in self._writers:
+            self._writers.move_to_end(index)
+            return self._writers[index]
+
+        if len(self._writers) >= self.max_open:
+            _, writers = self._writers.popitem(last=False)
+            for writer in writers:
+                writer.close()
+
+        mode = 'at' if index in self._opened else 'wt'
+        self._opened.add(index)
+
+        writers = tuple(_open_output(filepath, mode) for filepath in self.outputs[index])
+        self._writers[index] = writers
+        return writers
+
+    def close(self):
+        for writers in self._writers.values():
+            for writer in writers:
+                writer.close()
+        self._writers = OrderedDict()
+
+        for index, filepaths in enumerate(self.outputs):
+            if index not in self._opened:
+                for filepath in filepaths:
+                    _open_output(filepath, 'wt').close()
+                self._opened.add(index)
+
+
+def demultiplex_tag_reads(input_r1, input_r2, outputs, params, max_open_writers=None):
+    """
+    split tagged batch fastqs back into the filtered fastqs of each
+    input. outputs is a list of (output_r1, output_r2) in batch index
+    order, returns the tag counts of each input in the same order.
+    at most max_open_writers output pairs (default: within the open file
+    limit) are open at once. fastq_screen keeps the read order, so the
+    reads of an input come in one run and each output is opened once.
+    """
     reader = fastqutils.PairedTaggedFastqReader(input_r1, input_r2)
+    resolver = TagResolver(reader, params)
 
-    with helpers.getFileHandle(output_r1, 'wt') as writer_r1, helpers.getFileHandle(output_r2, 'wt') as writer_r2:
-        for read_1, read_2 in reader.filter_read_iterator(genomes, filter_tags):
+    raw_counts = [{'R1': defaultdict(int), 'R2': defaultdict(int)} for _ in outputs]
+
+    with PairedWriterPool(outputs, max_open=max_open_writers) as writers:
+        for read_1, read_2 in reader.get_read_pair_iterator():
+            index = pop_batch_prefix(read_1)
+            assert pop_batch_prefix(read_2) == index
 
-            read_1 = reader.add_tag_to_read_comment(read_1)
-            read_2 = reader.add_tag_to_read_comment(read_2)
+            pair = resolver.filter_pair(read_1, read_2, raw_counts[index])
+            if pair is None:
+                continue
 
-            for line in read_1:
-                writer_r1.write(line)
+            writer_r1, writer_r2 = writers.get_writers(index)
+            writer_r1.writelines(pair[0])
+            writer_r2.writelines(pair[1])
 
-            for line in read_2:
-                writer_r2.write(line)
+    return [resolver.collapse_counts(v) for v in raw_counts]
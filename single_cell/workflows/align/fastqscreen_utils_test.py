@@ -0,0 +1,151 @@
+import gzip
+import os
+
+from single_cell.workflows.align.fastqscreen_utils import PairedWriterPool
+from single_cell.workflows.align.fastqscreen_utils import demultiplex_tag_reads
+from single_cell.workflows.align.fastqscreen_utils import filter_tag_reads
+from single_cell.workflows.align.fastqscreen_utils import write_batch_fastqs
+
+
+def simulate_paired_fastq(r1, r2, flags, values, id, header=False):
+    vals = ''.join(map(str, values))
+    tag = ':'.join(flags) + ':' + vals if header else vals
+
+    for read_end, writer in ((1, r1), (2, r2)):
+        writer.write('@HISEQ{}_144:5:1101:6674:43220/{}#FQST:{}\n'.format(id, read_end, tag))
+        writer.write('ACGT' * 30 + '\n')
+        writer.write('+\n')
+        writer.write('GCTT' * 30 + '\n')
+
+
+def read_fastq(filepath):
+    with gzip.open(filepath, 'rt') as reader:
+        return reader.readlines()
+
+
+def test_filter_tag_reads_regroup(tmpdir):
+    tmpdir = str(tmpdir)
+    r1 = os.path.join(tmpdir, 'R1.fastq.gz')
+    r2 = os.path.join(tmpdir, 'R2.fastq.gz')
+    r1_filt = os.path.join(tmpdir, 'R1_filtered.fastq.gz')
+    r2_filt = os.path.join(tmpdir, 'R2_filtered.fastq.gz')
+
+    flags = ['grch37', 'mm10_path0', 'mm10_path1', 'salmon']
+    with gzip.open(r1, 'wt') as r1_out, gzip.open(r2, 'wt') as r2_out:
+        simulate_paired_fastq(r1_out, r2_out, flags, [1, 0, 0, 0], '101', header=True)
+        simulate_paired_fastq(r1_out, r2_out, flags, [1, 0, 1, 0], '102')
+        simulate_paired_fastq(r1_out, r2_out, flags, [0, 1, 1, 0], '103')
+        simulate_paired_fastq(r1_out, r2_out, flags, [0, 0, 0, 1], '104')
+        simulate_paired_fastq(r1_out, r2_out, flags, [1, 0, 0, 0], '105')
+
+    params = {
+        'genomes': [
+            {'name': 'grch37', 'paths': '/refs/grch37.fa'},
+            {'name': 'mm10', 'paths': ['/refs/mm10_a.fa', '/refs/mm10_b.fa']},
+            {'name': 'salmon', 'paths': '/refs/salmon.fa'},
+        ],
+        'filter_tags': ['010', '001'],
+    }
+
+    counts = filter_tag_reads(r1, r2, r1_filt, r2_filt, params)
+
+    expected = {
+        (('grch37', 1), ('mm10', 0), ('salmon', 0)): 2,
+        (('grch37', 1), ('mm10', 1), ('salmon', 0)): 1,
+        (('grch37', 0), ('mm10', 1), ('salmon', 0)): 1,
+        (('grch37', 0), ('mm10', 0), ('salmon', 1)): 1,
+    }
+    assert dict(counts['R1']) == expected
+    assert dict(counts['R2']) == expected
+
+    filtered = read_fastq(r1_filt)
+    assert len(filtered) == 12
+    assert filtered[0] == '@HISEQ101_144:5:1101:6674:43220\tFS:Z:grch37_1,mm10_0,salmon_0\n'
+    assert filtered[4] == '@HISEQ102_144:5:1101:6674:43220\tFS:Z:grch37_1,mm10_1,salmon_0\n'
+    assert filtered[8] == '@HISEQ105_144:5:1101:6674:43220\tFS:Z:grch37_1,mm10_0,salmon_0\n'
+    assert len(read_fastq(r2_filt)) == 12
+
+
+def fake_fastq_screen_tags(input_fastq, output_fastq, tags, flags):
+    # tag each read the way fastq_screen --tag does, the first read carries the header
+    with gzip.open(input_fastq, 'rt') as reader, gzip.open(output_fastq, 'wt') as writer:
+        for i, line in enumerate(reader):
+            if i % 4 == 0:
+                name, read_end = line.split('#FQST:')[0].split('/')
+                tag = tags[name.split('|')[1]]
+                tag = ':'.join(flags) + ':' + tag if i == 0 else tag
+                line = '{}/{}#FQST:{}\n'.format(name, read_end, tag)
+            writer.write(line)
+
+
+def test_batch_and_demultiplex(tmpdir):
+    tmpdir = str(tmpdir)
+    flags = ['grch37', 'mm10']
+    params = {
+        'genomes': [
+            {'name': 'grch37', 'paths': '/refs/grch37.fa'},
+            {'name': 'mm10', 'paths': '/refs/mm10.fa'},
+        ],
+        'filter_tags': ['01'],
+    }
+
+    tags = {}
+    inputs = []
+    for cell, values in (('cell1', ['10', '01', '11']), ('cell2', ['01', '00'])):
+        r1 = os.path.join(tmpdir, cell + '_R1.fastq.gz')
+        r2 = os.path.join(tmpdir, cell + '_R2.fastq.gz')
+        with gzip.open(r1, 'wt') as r1_out, gzip.open(r2, 'wt') as r2_out:
+            for i, value in enumerate(values):
+                read_id = '{}{}'.format(cell, i)
+                simulate_paired_fastq(r1_out, r2_out, [], [], read_id)
+                tags['HISEQ{}_144:5:1101:6674:43220'.format(read_id)] = value
+        inputs.append((r1, r2))
+
+    batch_r1 = os.path.join(tmpdir, 'batch_R1.fastq.gz')
+    batch_r2 = os.path.join(tmpdir, 'batch_R2.fastq.gz')
+    assert write_batch_fastqs(inputs, batch_r1, batch_r2) == 5
+
+    tagged_r1 = os.path.join(tmpdir, 'tagged_R1.fastq.gz')
+    tagged_r2 = os.path.join(tmpdir, 'tagged_R2.fastq.gz')
+    fake_fastq_screen_tags(batch_r1, tagged_r1, tags, flags)
+    fake_fastq_screen_tags(batch_r2, tagged_r2, tags, flags)
+
+    outputs = [
+        (os.path.join(tmpdir, 'out{}_R1.fastq.gz'.format(i)), os.path.join(tmpdir, 'out{}_R2.fastq.gz'.format(i)))
+        for i in range(2)
+    ]
+    counts = demultiplex_tag_reads(tagged_r1, tagged_r2, outputs, params)
+
+    assert dict(counts[0]['R1']) == {
+        (('grch37', 1), ('mm10', 0)): 1, (('grch37', 0), ('mm10', 1)): 1, (('grch37', 1), ('mm10', 1)): 1,
+    }
+    assert dict(counts[1]['R2']) == {(('grch37', 0), ('mm10', 1)): 1, (('grch37', 0), ('mm10', 0)): 1}
+
+    cell1 = read_fastq(outputs[0][0])
+    assert [v for v in cell1 if v.startswith('@')] == [
+        '@HISEQcell10_144:5:1101:6674:43220\tFS:Z:grch37_1,mm10_0\n',
+        '@HISEQcell12_144:5:1101:6674:43220\tFS:Z:grch37_1,mm10_1\n',
+    ]
+    cell2 = read_fastq(outputs[1][1])
+    assert [v for v in cell2 if v.startswith('@')] == [
+        '@HISEQcell21_144:5:1101:6674:43220\tFS:Z:grch37_0,mm10_0\n',
+    ]
+
+
+def test_paired_writer_pool(tmpdir):
+    tmpdir = str(tmpdir)
+    outputs = [
+        (os.path.join(tmpdir, 'out{}_R1.fastq.gz'.format(i)), os.path.join(tmpdir, 'out{}_R2.fastq.gz'.format(i)))
+        for i in range(3)
+    ]
+
+    # a single open pair, the first output is closed and appended to
+    with PairedWriterPool(outputs, max_open=1) as pool:
+        for index, line in ((0, 'a\n'), (1, 'b\n'), (0, 'c\n')):
+            for writer in pool.get_writers(index):
+                writer.write(line)
+
+    assert read_fastq(outputs[0][0]) == ['a\n', 'c\n']
+    assert read_fastq(outputs[1][1]) == ['b\n']
+    # outputs without reads are still written
+    assert read_fastq(outputs[2][0]) == []
@@ -0,0 +1,187 @@
+'''
+GC bias metrics against precomputed reference windows. The GC content
+of each window of the reference is computed once and cached with the
+reference metadata, each cell then only contributes the window of each
+of its reads. Follows picard CollectGcBiasMetrics, with non overlapping
+windows rather than a window at every reference position.
+'''
+from __future__ import division
+
+import functools
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pysam
+from single_cell.utils import csvutils
+from single_cell.utils import refgenome
+from single_cell.workflows.align.dtypes import dtypes
+
+WINDOW_SIZE = 100
+
+# windows with more Ns than this have no gc value
+MAX_WINDOW_N_BASES = 4
+
+GC_BINS = 101
+
+DETAIL_METRICS_COLUMNS = [
+    'GC', 'WINDOWS', 'READ_STARTS', 'NORMALIZED_COVERAGE', 'ERROR_BAR_WIDTH'
+]
+
+
+def get_window_gc(seq, window_size=WINDOW_SIZE):
+    """
+    gc percentage of each consecutive window of window_size bases in seq,
+    -1 for windows with too many Ns. a partial window at the end of seq
+    is ignored
+    """
+    num_windows = len(seq) // window_size
+    bases = np.frombuffer(seq[:num_windows * window_size].upper().encode(), dtype=np.uint8)
+    bases = bases.reshape(num_windows, window_size)
+
+    gc_count = ((bases == ord('G')) | (bases == ord('C'))).sum(axis=1)
+    at_count = ((bases == ord('A')) | (bases == ord('T'))).sum(axis=1)
+    n_count = window_size - gc_count - at_count
+
+    gc = np.round(100 * gc_count / np.maximum(gc_count + at_count, 1))
+    gc[n_count > MAX_WINDOW_N_BASES] = -1
+
+    return gc.astype(np.int8)
+
+
+def write_reference_gc(ref_genome, output, window_size=WINDOW_SIZE, chunk_size=10000000):
+    """
+    writes the gc of the windows of each chromosome as an int8 array
+    per chromosome to an npz file
+    """
+    # chunks hold whole windows
+    chunk_size = max(chunk_size // window_size, 1) * window_size
+
+    gc = {}
+    with pysam.FastaFile(ref_genome) as reference:
+        for chrom, length in zip(reference.references, reference.lengths):
+            chrom_gc = [np.zeros(0, dtype=np.int8)]
+            for start in range(0, length, chunk_size):
+                seq = reference.fetch(chrom, start, min(start + chunk_size, length))
+                chrom_gc.append(get_window_gc(seq, window_size=window_size))
+            gc[chrom] = np.concatenate(chrom_gc)
+
+    with open(output, 'wb') as writer:
+        np.savez(writer, **gc)
+
+
+def get_reference_gc(ref_genome, window_size=WINDOW_SIZE):
+    """
+    path of the cached window gc of the reference, computed on first use
+    """
+    return refgenome.get_cached_file(
+        ref_genome, 'gc_windows_{}.npz'.format(window_size),
+        functools.partial(write_reference_gc, window_size=window_size)
+    )
+
+
+class GcReadStarts(object):
+    """
+    position of the 5' end of each aligned read: the read start
+    for forward reads, the last aligned base for reverse reads
+    """
+
+    def __init__(self):
+        self.starts = defaultdict(list)
+
+    def add_read(self, read):
+        if read.is_unmapped or read.is_secondary or read.is_supplementary:
+            return
+
+        if read.is_reverse:
+            start = read.reference_end - 1
+        else:
+            start = read.reference_start
+
+        self.starts[read.reference_id].append(start)
+
+    def write(self, output, references):
+        starts = {
+            references[tid]: np.array(positions, dtype=np.int64)
+            for tid, positions in self.starts.items()
+        }
+        with open(output, 'wb') as writer:
+            np.savez(writer, **starts)
+
+
+def get_normalized_coverage(reads_by_gc, windows_by_gc):
+    """
+    reads per window at each gc relative to the mean reads per window
+    """
+    mean_reads = reads_by_gc.sum() / windows_by_gc.sum() if windows_by_gc.sum() else 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = reads_by_gc / windows_by_gc / mean_reads
+        error_bar = np.sqrt(reads_by_gc) / windows_by_gc / mean_reads
+
+    normalized[~np.isfinite(normalized)] = 0
+    error_bar[~np.isfinite(error_bar)] = 0
+
+    return normalized, error_bar
+
+
+def write_detail_metrics(output, reads_by_gc, windows_by_gc, normalized, error_bar):
+    with open(output, 'wt') as writer:
+        writer.write('## htsjdk.samtools.metrics.StringHeader\n')
+        writer.write('# single_cell in-process CollectGcBiasMetrics\n')
+        writer.write('\n')
+        writer.write('## METRICS CLASS\tpicard.analysis.GcBiasDetailMetrics\n')
+        writer.write('\t'.join(DETAIL_METRICS_COLUMNS) + '\n')
+        for gc in range(GC_BINS):
+            row = [
+                gc, windows_by_gc[gc], reads_by_gc[gc],
+                round(normalized[gc], 6), round(error_bar[gc], 6)
+            ]
+            writer.write('\t'.join(map(str, row)) + '\n')
+        writer.write('\n')
+
+
+def get_gcbias_matrix(ref_genome, read_starts, output, detail_metrics, window_size=WINDOW_SIZE):
+    """
+    bin the reads of every cell by the gc of the window of their 5' end
+    and write the gcbias matrix for the library. the reference gc, an
+    int8 per window, is loaded once and each cell's read starts once.
+    """
+    cell_ids = sorted(read_starts)
+    reads_by_gc = {cell_id: np.zeros(GC_BINS, dtype=np.int64) for cell_id in cell_ids}
+    windows_by_gc = np.zeros(GC_BINS, dtype=np.float64)
+
+    with np.load(get_reference_gc(ref_genome, window_size=window_size)) as reference_gc:
+        reference_gc = {chrom: reference_gc[chrom] for chrom in reference_gc.files}
+
+    for chrom_gc in reference_gc.values():
+        windows_by_gc += np.bincount(chrom_gc[chrom_gc >= 0], minlength=GC_BINS)
+
+    for cell_id in cell_ids:
+        with np.load(read_starts[cell_id]) as starts:
+            for chrom in starts.files:
+                if chrom not in reference_gc:
+                    continue
+                chrom_gc = reference_gc[chrom]
+                windows = starts[chrom] // window_size
+
+                gc = chrom_gc[windows[windows < len(chrom_gc)]]
+                reads_by_gc[cell_id] += np.bincount(gc[gc >= 0], minlength=GC_BINS)
+
+    matrix = []
+    for cell_id in cell_ids:
+        normalized, error_bar = get_normalized_coverage(reads_by_gc[cell_id], windows_by_gc)
+
+        write_detail_metrics(
+            detail_metrics[cell_id], reads_by_gc[cell_id],
+            windows_by_gc.astype(np.int64), normalized, error_bar
+        )
+
+        row = {str(gc): normalized[gc] for gc in range(GC_BINS)}
+        row['cell_id'] = cell_id
+        matrix.append(row)
+
+    columns = [str(gc) for gc in range(GC_BINS)] + ['cell_id']
+    matrix = pd.DataFrame(matrix, columns=columns)
+
+    csvutils.write_dataframe_to_csv_and_yaml(matrix, output, dtypes()['gc'])
@@ -0,0 +1,115 @@
+import os
+import random
+
+import numpy as np
+import pysam
+from single_cell.utils import csvutils
+from single_cell.workflows.align import gc_bias
+
+CHROMS = {'1': 5050, '2': 3000}
+
+
+def write_reference(filepath, rand):
+    with open(filepath, 'wt') as writer:
+        for chrom, length in CHROMS.items():
+            seq = []
+            while len(seq) < length:
+                # blocks of varying gc content and a few N runs
+                gc_frac = rand.random()
+                block = 'N' * 10 if rand.random() < 0.05 else ''.join(
+                    rand.choice('GC') if rand.random() < gc_frac else rand.choice('AT')
+                    for _ in range(200)
+                )
+                seq.extend(block)
+            writer.write('>{}\n{}\n'.format(chrom, ''.join(seq[:length])))
+    pysam.faidx(filepath)
+
+
+def simulate_reads(rand, num_reads=300):
+    header = pysam.AlignmentHeader.from_dict({
+        'SQ': [{'SN': chrom, 'LN': length} for chrom, length in CHROMS.items()]
+    })
+    reads = []
+    for i in range(num_reads):
+        tid = rand.randint(0, 1)
+        read = pysam.AlignedSegment(header)
+        read.query_name = 'read{}'.format(i)
+        read.flag = rand.choice([0, 16, 256])
+        read.reference_id = tid
+        read.reference_start = rand.randint(0, CHROMS[header.references[tid]] - 150)
+        read.cigarstring = rand.choice(['150M', '100M5D50M'])
+        read.query_sequence = 'A' * 150
+        reads.append(read)
+    return reads
+
+
+def naive_window_gc(seq):
+    seq = seq.upper()
+    gc = seq.count('G') + seq.count('C')
+    at = seq.count('A') + seq.count('T')
+    if len(seq) - gc - at > gc_bias.MAX_WINDOW_N_BASES:
+        return -1
+    return int(np.round(100 * gc / (gc + at)))
+
+
+def test_gcbias_matrix(tmpdir):
+    tmpdir = str(tmpdir)
+    rand = random.Random(0)
+
+    reference = os.path.join(tmpdir, 'ref.fa')
+    write_reference(reference, rand)
+
+    reference_gc = gc_bias.get_reference_gc(reference)
+    assert os.path.dirname(reference_gc).startswith(os.path.join(tmpdir, 'ref.fa.'))
+
+    # chunks that are not a multiple of the window size
+    chunked_gc = os.path.join(tmpdir, 'chunked.npz')
+    gc_bias.write_reference_gc(reference, chunked_gc, chunk_size=750)
+    with np.load(reference_gc) as cached, np.load(chunked_gc) as chunked:
+        for chrom in CHROMS:
+            assert np.array_equal(cached[chrom], chunked[chrom])
+
+    fasta = pysam.FastaFile(reference)
+
+    windows_by_gc = np.zeros(gc_bias.GC_BINS)
+    for chrom, length in CHROMS.items():
+        seq = fasta.fetch(chrom)
+        for start in range(0, length - gc_bias.WINDOW_SIZE + 1, gc_bias.WINDOW_SIZE):
+            gc = naive_window_gc(seq[start:start + gc_bias.WINDOW_SIZE])
+            if gc >= 0:
+                windows_by_gc[gc] += 1
+
+    read_starts = {}
+    expected = {}
+    for cell_id in ('cell1', 'cell2'):
+        reads = simulate_reads(rand)
+
+        collector = gc_bias.GcReadStarts()
+        reads_by_gc = np.zeros(gc_bias.GC_BINS)
+        for read in reads:
+            collector.add_read(read)
+            if read.is_secondary:
+                continue
+            start = read.reference_end - 1 if read.is_reverse else read.reference_start
+            start -= start % gc_bias.WINDOW_SIZE
+            window = fasta.fetch(read.reference_name, start, start + gc_bias.WINDOW_SIZE)
+            gc = naive_window_gc(window) if len(window) == gc_bias.WINDOW_SIZE else -1
+            if gc >= 0:
+                reads_by_gc[gc] += 1
+
+        read_starts[cell_id] = os.path.join(tmpdir, cell_id + '.npz')
+        collector.write(read_starts[cell_id], list(CHROMS))
+
+        mean_reads = reads_by_gc.sum() / windows_by_gc.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected[cell_id] = np.nan_to_num(reads_by_gc / windows_by_gc / mean_reads)
+
+    output = os.path.join(tmpdir, 'gc_metrics.csv.gz')
+    detail = {cell_id: os.path.join(tmpdir, cell_id + '_gc.txt') for cell_id in read_starts}
+    gc_bias.get_gcbias_matrix(reference, read_starts, output, detail)
+
+    matrix = csvutils.read_csv_and_yaml(output).set_index('cell_id')
+    for cell_id, values in expected.items():
+        observed = matrix.loc[cell_id, [str(v) for v in range(gc_bias.GC_BINS)]].values
+        assert np.allclose(observed.astype(float), values)
+        assert os.path.exists(detail[cell_id])
@@ -0,0 +1,531 @@
+'''
+In-process merge of coordinate sorted lane bams with picard
+MarkDuplicates compatible duplicate marking.
+'''
+import heapq
+import math
+import re
+import shutil
+import sys
+from collections import OrderedDict
+from collections import deque
+
+import pysam
+
+UNKNOWN_LIBRARY = 'Unknown Library'
+
+# picard SUM_OF_BASE_QUALITIES scoring strategy
+MIN_SCORING_BASE_QUAL = 15
+MAX_READ_SCORE = 16383
+
+OPTICAL_DUPLICATE_PIXEL_DISTANCE = 100
+
+METRICS_COLUMNS = [
+    'LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED',
+    'SECONDARY_OR_SUPPLEMENTARY_RDS', 'UNMAPPED_READS',
+    'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES',
+    'READ_PAIR_OPTICAL_DUPLICATES', 'PERCENT_DUPLICATION',
+    'ESTIMATED_LIBRARY_SIZE'
+]
+
+# counts that must agree with picard MarkDuplicates in validation mode.
+# optical duplicates are left out, the pairwise distance check of the
+# DuplicateMarker is simpler than picard's clustering and can count
+# chained clusters differently
+VALIDATED_COLUMNS = [
+    'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'UNMAPPED_READS',
+    'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES',
+]
+
+UNMAPPED_TID = sys.maxsize
+
+CIGAR_OPS = 'MIDNSHP=X'
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+# M, D, N, = and X
+REFERENCE_OPS = (0, 2, 3, 7, 8)
+
+
+def _merge_key(read):
+    if read.reference_id < 0:
+        return UNMAPPED_TID, 0
+    return read.reference_id, read.reference_start
+
+
+def merge_headers(headers):
+    """
+    merge the headers of the lane bams. all lanes must be aligned
+    to the same reference, read groups and programs are combined.
+    """
+    merged = headers[0].to_dict()
+
+    merged['HD'] = dict(merged.get('HD', {'VN': '1.6'}))
+    merged['HD']['SO'] = 'coordinate'
+
+    for tag in ('RG', 'PG', 'CO'):
+        merged[tag] = list(merged.get(tag, []))
+
+    for header in headers[1:]:
+        header = header.to_dict()
+
+        if header.get('SQ') != merged.get('SQ'):
+            raise Exception('lane bams were aligned to different references')
+
+        for tag in ('RG', 'PG'):
+            seen = set(v['ID'] for v in merged[tag])
+            for value in header.get(tag, []):
+                if value['ID'] not in seen:
+                    merged[tag].append(value)
+                    seen.add(value['ID'])
+
+        for comment in header.get('CO', []):
+            if comment not in merged['CO']:
+                merged['CO'].append(comment)
+
+    return {k: v for k, v in merged.items() if v}
+
+
+def iter_merged_reads(bamfiles):
+    """
+    k-way merge of coordinate sorted bams. reads with equal
+    positions are returned in the order of the input files.
+    """
+    iterators = [bam.fetch(until_eof=True) for bam in bamfiles]
+    return heapq.merge(*iterators, key=_merge_key)
+
+
+def parse_cigar(cigarstring):
+    return [(CIGAR_OPS.index(op), int(length)) for length, op in CIGAR_RE.findall(cigarstring)]
+
+
+def get_five_prime(reference_start, cigar, is_reverse):
+    """
+    unclipped 5' position of an alignment from its start and cigar tuples
+    """
+    if is_reverse:
+        pos = reference_start - 1
+        pos += sum(length for op, length in cigar if op in REFERENCE_OPS)
+        for op, length in reversed(cigar):
+            if op not in (4, 5):
+                break
+            pos += length
+    else:
+        pos = reference_start
+        for op, length in cigar:
+            if op not in (4, 5):
+                break
+            pos -= length
+
+    return pos
+
+
+def unclipped_five_prime(read):
+    return get_five_prime(read.reference_start, read.cigartuples, read.is_reverse)
+
+
+def mate_unclipped_five_prime(read):
+    """
+    unclipped 5' position of the mate, from the mate cigar in the MC tag
+    """
+    if not read.has_tag('MC'):
+        raise Exception(
+            'read {} has no MC tag, duplicate marking needs the mate cigar'.format(read.query_name)
+        )
+    cigar = parse_cigar(read.get_tag('MC'))
+    return get_five_prime(read.next_reference_start, cigar, read.mate_is_reverse)
+
+
+def read_score(read):
+    quals = read.query_qualities
+    if quals is None:
+        return 0
+    score = sum(qual for qual in quals if qual >= MIN_SCORING_BASE_QUAL)
+    return min(score, MAX_READ_SCORE)
+
+
+def get_physical_location(read_name):
+    """
+    tile, x and y from illumina read names, following the picard
+    default read name regex (5 or 7 colon separated fields)
+    """
+    fields = read_name.split(':')
+    if len(fields) not in (5, 7):
+        return None
+    try:
+        return int(fields[-3]), int(fields[-2]), int(fields[-1])
+    except ValueError:
+        return None
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    """
+    picard's Lander-Waterman library size estimate
+    """
+
+    def f(x, c, n):
+        return c / x - 1 + math.exp(-n / x)
+
+    read_pair_duplicates = read_pairs - unique_read_pairs
+
+    if read_pairs <= 0 or read_pair_duplicates <= 0:
+        return None
+
+    lower = 1.0
+    upper = 100.0
+
+    if unique_read_pairs >= read_pairs or f(lower * unique_read_pairs, unique_read_pairs, read_pairs) < 0:
+        return None
+
+    while f(upper * unique_read_pairs, unique_read_pairs, read_pairs) > 0:
+        upper *= 10.0
+
+    for _ in range(40):
+        ratio = (lower + upper) / 2.0
+        value = f(ratio * unique_read_pairs, unique_read_pairs, read_pairs)
+        if value == 0:
+            break
+        elif value > 0:
+            lower = ratio
+        else:
+            upper = ratio
+
+    return int(unique_read_pairs * (lower + upper) / 2.0)
+
+
+class DuplicateMarker(object):
+    """
+    marks picard style duplicates in a single pass over a coordinate
+    sorted stream of reads.
+
+    pair ends are keyed on library, the unclipped 5' position and
+    strand of both mates, the mate's end is taken from its position and
+    the MC tag as in picard MarkDuplicatesWithMateCigar, so a pair is
+    decided from the read seen first and its mate is marked the same way
+    when it arrives. fragment ends are keyed on library, unclipped 5'
+    position and strand of the read. reads clipped at the 5' end start
+    after their unclipped position, so a duplicate set is resolved once
+    the sweep is past its leftmost end by the lookahead, twice the length
+    of the first read. reads are held until their set is resolved and
+    returned in the input order, only the names of pairs decided before
+    their second read are kept for longer.
+    """
+
+    def __init__(self, header, lookahead=None):
+        self.libraries = {
+            rg['ID']: rg.get('LB', UNKNOWN_LIBRARY) for rg in header.to_dict().get('RG', [])
+        }
+
+        self.metrics = OrderedDict()
+        self.lookahead = lookahead
+
+        # [read, is_duplicate], is_duplicate is None until decided
+        self._buffer = deque()
+        # entries of the pairs in open sets and decisions of pairs
+        # whose second read has not been seen yet, by read name
+        self._open_pairs = {}
+        self._mate_decisions = {}
+        self._pair_groups = {}
+        self._frag_groups = {}
+        # heap of (tid, pos, is_pair, key) of the end each open set is resolved at
+        self._group_ends = []
+        self._order = 0
+
+    def _get_library(self, read):
+        if read.has_tag('RG'):
+            return self.libraries.get(read.get_tag('RG'), UNKNOWN_LIBRARY)
+        return UNKNOWN_LIBRARY
+
+    def _get_metrics(self, library):
+        if library not in self.metrics:
+            self.metrics[library] = OrderedDict(
+                (col, 0) for col in METRICS_COLUMNS if col != 'LIBRARY'
+            )
+        return self.metrics[library]
+
+    def _get_fragment_group(self, library, end):
+        key = (library, end)
+        if key not in self._frag_groups:
+            self._frag_groups[key] = [False, []]
+            heapq.heappush(self._group_ends, (end[0], end[1], False, key))
+        return self._frag_groups[key]
+
+    def _get_pair_group(self, library, ends):
+        key = (library,) + ends
+        if key not in self._pair_groups:
+            self._pair_groups[key] = []
+            # the first read of every pair in the set arrives by the leftmost end
+            heapq.heappush(self._group_ends, (ends[0][0], ends[0][1], True, key))
+        return self._pair_groups[key]
+
+    def add_read(self, read):
+        tid = UNMAPPED_TID if read.reference_id < 0 else read.reference_id
+        self._resolve_groups(tid, read.reference_start)
+
+        library = self._get_library(read)
+        metrics = self._get_metrics(library)
+
+        entry = [read, None]
+        self._buffer.append(entry)
+
+        if read.is_secondary or read.is_supplementary:
+            metrics['SECONDARY_OR_SUPPLEMENTARY_RDS'] += 1
+            entry[1] = False
+            return
+
+        if read.is_unmapped:
+            metrics['UNMAPPED_READS'] += 1
+            entry[1] = False
+            return
+
+        if self.lookahead is None:
+            self.lookahead = 2 * read.infer_read_length()
+
+        self._order += 1
+        end = (read.reference_id, unclipped_five_prime(read), read.is_reverse)
+        score = read_score(read)
+
+        if not read.is_paired or read.mate_is_unmapped:
+            metrics['UNPAIRED_READS_EXAMINED'] += 1
+            self._get_fragment_group(library, end)[1].append(
+                (score, -self._order, read.query_name, entry)
+            )
+            return
+
+        # any mapped pair at this position makes the fragments here duplicates
+        self._get_fragment_group(library, end)[0] = True
+
+        name = read.query_name
+
+        # second read of a pair, marked like its mate
+        if name in self._mate_decisions:
+            entry[1] = self._mate_decisions.pop(name)
+            return
+        if name in self._open_pairs:
+            self._open_pairs.pop(name).append(entry)
+            return
+
+        mate_end = (read.next_reference_id, mate_unclipped_five_prime(read), read.mate_is_reverse)
+        ends = tuple(sorted([end, mate_end]))
+
+        # picard only adds the mate's score when samtools fixmate stored it
+        if read.has_tag('ms'):
+            score += read.get_tag('ms')
+
+        metrics['READ_PAIRS_EXAMINED'] += 1
+        readgroup = read.get_tag('RG') if read.has_tag('RG') else None
+        entries = [entry]
+        self._open_pairs[name] = entries
+        self._get_pair_group(library, ends).append(
+            (score, -self._order, name, readgroup, entries)
+        )
+
+    def _resolve_groups(self, tid, pos):
+        while self._group_ends:
+            group_tid, group_pos, is_pair, key = self._group_ends[0]
+            if (group_tid, group_pos + self.lookahead) >= (tid, pos):
+                break
+            heapq.heappop(self._group_ends)
+
+            if is_pair:
+                self._resolve_pairs(key[0], self._pair_groups.pop(key))
+            else:
+                has_pairs, fragments = self._frag_groups.pop(key)
+                self._resolve_fragments(key[0], has_pairs, fragments)
+
+    def _resolve_fragments(self, library, has_pairs, fragments):
+        if not fragments:
+            return
+
+        fragments = sorted(fragments, key=lambda v: v[:3], reverse=True)
+        num_kept = 0 if has_pairs else 1
+
+        for i, (_, _, _, entry) in enumerate(fragments):
+            entry[1] = i >= num_kept
+
+        self._get_metrics(library)['UNPAIRED_READ_DUPLICATES'] += len(fragments) - num_kept
+
+    def _resolve_pairs(self, library, pairs):
+        pairs = sorted(pairs, key=lambda v: v[:4], reverse=True)
+
+        for i, (_, _, name, _, entries) in enumerate(pairs):
+            for entry in entries:
+                entry[1] = i > 0
+            if len(entries) == 1:
+                self._mate_decisions[name] = i > 0
+            self._open_pairs.pop(name, None)
+
+        if len(pairs) < 2:
+            return
+
+        metrics = self._get_metrics(library)
+        metrics['READ_PAIR_DUPLICATES'] += len(pairs) - 1
+        metrics['READ_PAIR_OPTICAL_DUPLICATES'] += self._count_optical_duplicates(pairs)
+
+    @staticmethod
+    def _count_optical_duplicates(pairs):
+        # pairs are in picard's order, the best scoring pair first
+        locations = [
+            (readgroup, get_physical_location(name)) for _, _, name, readgroup, _ in pairs
+        ]
+
+        num_optical = 0
+        for i in range(1, len(locations)):
+            readgroup, location = locations[i]
+            if location is None:
+                continue
+            for other_readgroup, other_location in locations[:i]:
+                if other_location is None or other_readgroup != readgroup:
+                    continue
+                if other_location[0] != location[0]:
+                    continue
+                if abs(other_location[1] - location[1]) <= OPTICAL_DUPLICATE_PIXEL_DISTANCE and \
+                        abs(other_location[2] - location[2]) <= OPTICAL_DUPLICATE_PIXEL_DISTANCE:
+                    num_optical += 1
+                    break
+
+        return num_optical
+
+    def pop_marked_reads(self):
+        """
+        yields the reads at the front of the buffer that are decided,
+        in the input order and with the duplicate flag set
+        """
+        while self._buffer and self._buffer[0][1] is not None:
+            read, is_duplicate = self._buffer.popleft()
+            read.is_duplicate = is_duplicate
+            yield read
+
+    def finalize(self):
+        self._resolve_groups(UNMAPPED_TID + 1, 0)
+
+        for metrics in self.metrics.values():
+            read_pairs = metrics['READ_PAIRS_EXAMINED']
+            unpaired = metrics['UNPAIRED_READS_EXAMINED']
+            pair_dups = metrics['READ_PAIR_DUPLICATES']
+            unpaired_dups = metrics['UNPAIRED_READ_DUPLICATES']
+
+            examined = unpaired + read_pairs * 2
+            if examined:
+                metrics['PERCENT_DUPLICATION'] = (unpaired_dups + pair_dups * 2) / float(examined)
+            else:
+                metrics['PERCENT_DUPLICATION'] = 0
+
+            metrics['ESTIMATED_LIBRARY_SIZE'] = estimate_library_size(
+                read_pairs - metrics['READ_PAIR_OPTICAL_DUPLICATES'],
+                read_pairs - pair_dups
+            )
+
+
+def write_duplication_metrics(metrics, output):
+    """
+    write the metrics in the picard metrics file format
+    that CollectMetrics parses
+    """
+    with open(output, 'wt') as writer:
+        writer.write('## htsjdk.samtools.metrics.StringHeader\n')
+        writer.write('# single_cell in-process MarkDuplicates\n')
+        writer.write('\n')
+        writer.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+        writer.write('\t'.join(METRICS_COLUMNS) + '\n')
+
+        if not metrics:
+            metrics = {UNKNOWN_LIBRARY: OrderedDict((col, 0) for col in METRICS_COLUMNS[1:])}
+            metrics[UNKNOWN_LIBRARY]['ESTIMATED_LIBRARY_SIZE'] = None
+
+        for library, values in metrics.items():
+            row = [library]
+            for col in METRICS_COLUMNS[1:]:
+                value = values[col]
+                if value is None:
+                    value = ''
+                elif col == 'PERCENT_DUPLICATION':
+                    value = '{:.6f}'.format(value)
+                row.append(str(value))
+            writer.write('\t'.join(row) + '\n')
+
+        writer.write('\n')
+
+
+def read_duplication_metrics(filepath):
+    """
+    parse a picard DuplicationMetrics file into
+    a dict of metrics per library
+    """
+    metrics = OrderedDict()
+
+    with open(filepath, 'rt') as reader:
+        for line in reader:
+            if line.startswith('## METRICS CLASS'):
+                break
+
+        header = reader.readline().rstrip('\n').split('\t')
+
+        for line in reader:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                break
+            values = OrderedDict(zip(header, line.split('\t')))
+            metrics[values.pop('LIBRARY')] = values
+
+    return metrics
+
+
+def check_duplication_metrics(metrics, validation_metrics, output):
+    """
+    confirm the duplication metrics from the alignment step agree with
+    an independent MarkDuplicates run, then copy them to output
+    """
+    observed = read_duplication_metrics(metrics)
+    expected = read_duplication_metrics(validation_metrics)
+
+    if sorted(observed) != sorted(expected):
+        raise Exception(
+            'duplication metrics libraries differ: {} vs {}'.format(
+                sorted(observed), sorted(expected))
+        )
+
+    mismatches = []
+    for library, values in expected.items():
+        for col in VALIDATED_COLUMNS:
+            if int(observed[library][col] or 0) != int(values[col] or 0):
+                mismatches.append('{} {}: {} != {}'.format(
+                    library, col, observed[library][col], values[col]))
+
+    if mismatches:
+        raise Exception(
+            'duplication metrics do not match MarkDuplicates:\n' + '\n'.join(mismatches)
+        )
+
+    shutil.copyfile(metrics, output)
+
+
+def merge_and_mark_duplicates(inputs, output, metrics_output, threads=1):
+    """
+    k-way merge the coordinate sorted lane bams, mark duplicates
+    and write and index the merged bam in a single pass. replaces
+    picard MergeSamFiles, SortSam and MarkDuplicates.
+    """
+    if isinstance(inputs, dict):
+        inputs = inputs.values()
+    inputs = list(inputs)
+
+    bams = [pysam.AlignmentFile(bamfile, 'rb', check_sq=False) for bamfile in inputs]
+    try:
+        header = pysam.AlignmentHeader.from_dict(merge_headers([bam.header for bam in bams]))
+        marker = DuplicateMarker(header)
+
+        with pysam.AlignmentFile(output, 'wb', header=header, threads=threads) as writer:
+            for read in iter_merged_reads(bams):
+                marker.add_read(read)
+                for marked in marker.pop_marked_reads():
+                    writer.write(marked)
+
+            marker.finalize()
+            for marked in marker.pop_marked_reads():
+                writer.write(marked)
+    finally:
+        for bam in bams:
+            bam.close()
+
+    pysam.index(output, output + '.bai')
+
+    write_duplication_metrics(marker.metrics, metrics_output)
@@ -0,0 +1,235 @@
+import os
+import random
+from collections import OrderedDict
+
+import pysam
+import pytest
+from single_cell.utils.tests.bam_helpers import simulate_bam
+from single_cell.workflows.align import markdups
+from single_cell.workflows.align.scripts import CollectMetrics
+
+
+def get_header(lane):
+    return {
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': '1', 'LN': 1000000}, {'SN': '2', 'LN': 1000000}],
+        'RG': [{'ID': 'lib_cell_{}'.format(lane), 'LB': 'lib_cell', 'SM': 'cell'}],
+    }
+
+
+def make_read(header, name, tid, pos, cigar, qual, lane, flag, mate_tid=-1, mate_pos=-1):
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.flag = flag
+    read.reference_id = tid
+    read.reference_start = pos
+    read.mapping_quality = 60
+    read.cigarstring = cigar
+    read.next_reference_id = mate_tid
+    read.next_reference_start = mate_pos
+    read.query_sequence = 'A' * 100
+    read.query_qualities = pysam.qualitystring_to_array(chr(qual + 33) * 100)
+    read.set_tag('RG', 'lib_cell_{}'.format(lane))
+    return read
+
+
+def add_pair(reads, header, name, pos1, pos2, qual, lane, cigar1='100M', tid2=0):
+    # read1 forward, read2 reverse
+    read1 = make_read(header, name, 0, pos1, cigar1, qual, lane, 1 + 2 + 32 + 64, tid2, pos2)
+    read2 = make_read(header, name, tid2, pos2, '100M', qual, lane, 1 + 2 + 16 + 128, 0, pos1)
+    read1.set_tag('MC', read2.cigarstring)
+    read2.set_tag('MC', read1.cigarstring)
+    reads.extend([read1, read2])
+
+
+def write_bam(filepath, lane, build_reads):
+    header = pysam.AlignmentHeader.from_dict(get_header(lane))
+    reads = []
+    build_reads(reads, header)
+    reads = sorted(reads, key=lambda r: (r.reference_id < 0, r.reference_id, r.reference_start))
+    with pysam.AlignmentFile(filepath, 'wb', header=header) as writer:
+        for read in reads:
+            writer.write(read)
+
+
+def lane_1(reads, header):
+    add_pair(reads, header, 'M1:1:FC:1:1101:1000:1000', 100, 300, 30, 1)
+    # lower base qualities, duplicate of the pair above
+    add_pair(reads, header, 'M1:1:FC:1:1101:1050:1050', 100, 300, 20, 1)
+    # soft clipped start, same unclipped 5' position
+    add_pair(reads, header, 'M1:1:FC:1:2202:1000:1000', 105, 300, 10, 1, cigar1='5S95M')
+    # unpaired read at a position with pairs
+    reads.append(make_read(header, 'frag_at_pair', 0, 100, '100M', 40, 1, 0))
+    reads.append(make_read(header, 'frag_best', 0, 500, '100M', 30, 1, 0))
+    # interchromosomal pair
+    add_pair(reads, header, 'M1:1:FC:1:1101:5000:5000', 700, 50, 30, 1, tid2=1)
+    # unmapped pair
+    reads.append(make_read(header, 'unmapped', -1, -1, None, 30, 1, 1 + 4 + 8 + 64))
+
+
+def lane_2(reads, header):
+    reads.append(make_read(header, 'frag_worse', 0, 500, '100M', 20, 2, 0))
+    add_pair(reads, header, 'M1:1:FC:2:1101:5000:5000', 700, 50, 20, 2, tid2=1)
+    # not a duplicate, different mate position
+    add_pair(reads, header, 'M1:1:FC:2:1101:6000:6000', 100, 400, 30, 2)
+
+
+def test_merge_and_mark_duplicates(tmpdir):
+    tmpdir = str(tmpdir)
+    lane_bams = [os.path.join(tmpdir, 'lane1.bam'), os.path.join(tmpdir, 'lane2.bam')]
+    write_bam(lane_bams[0], 1, lane_1)
+    write_bam(lane_bams[1], 2, lane_2)
+
+    output = os.path.join(tmpdir, 'merged.bam')
+    metrics = os.path.join(tmpdir, 'metrics.txt')
+
+    markdups.merge_and_mark_duplicates(lane_bams, output, metrics)
+
+    assert os.path.exists(output + '.bai')
+
+    with pysam.AlignmentFile(output) as reader:
+        assert len(reader.header.to_dict()['RG']) == 2
+        reads = list(reader.fetch(until_eof=True))
+
+    positions = [(r.reference_id if r.reference_id >= 0 else 99, r.reference_start) for r in reads]
+    assert positions == sorted(positions)
+    assert len(reads) == 16
+
+    duplicates = {r.query_name for r in reads if r.is_duplicate}
+    assert duplicates == {
+        'M1:1:FC:1:1101:1050:1050', 'M1:1:FC:1:2202:1000:1000',
+        'frag_at_pair', 'frag_worse', 'M1:1:FC:2:1101:5000:5000',
+    }
+    assert all(r.is_duplicate for r in reads if r.query_name in duplicates)
+
+    collect = CollectMetrics(None, None, None, metrics, None, 'cell', None)
+    unpaired, pairs, unpaired_dups, pair_dups, unmapped, _, _ = collect.extract_duplication_metrics()
+
+    assert unpaired == 3
+    assert pairs == 6
+    assert unpaired_dups == 2
+    assert pair_dups == 3
+    assert unmapped == '1'
+
+
+def test_duplicate_marker_streams(tmpdir):
+    bamfile = os.path.join(str(tmpdir), 'sim.bam')
+    lengths = [('1', 200000), ('2', 100000)]
+
+    rand = random.Random(0)
+    positions = [(rand.randint(0, 1), rand.randint(0, 99000)) for _ in range(1500)]
+    # every fifth pair is repeated later, with the same ends
+    positions += positions[::5]
+
+    simulate_bam(bamfile, lengths, positions=positions, inserts=(300, 300), set_mates=True)
+
+    with pysam.AlignmentFile(bamfile) as reader:
+        marker = markdups.DuplicateMarker(reader.header)
+
+        marked = []
+        max_buffered = 0
+        for i, read in enumerate(reader.fetch(until_eof=True)):
+            marker.add_read(read)
+            marked.extend(marker.pop_marked_reads())
+            max_buffered = max(max_buffered, i + 1 - len(marked))
+
+        num_streamed = len(marked)
+        marker.finalize()
+        marked.extend(marker.pop_marked_reads())
+
+    # reads are written as soon as the sweep passes their duplicate set
+    assert max_buffered < 100
+    assert num_streamed > len(marked) * 0.95
+    assert len(marked) == len(positions) * 2
+
+    # the first pair at each position is kept
+    first = {}
+    for i, position in enumerate(positions):
+        first.setdefault(position, i)
+    expected = {'read{}'.format(i) for i in range(len(positions))} - {'read{}'.format(i) for i in first.values()}
+
+    assert {r.query_name for r in marked if r.is_duplicate} == expected
+    assert sum(r.is_duplicate for r in marked) == len(expected) * 2
+    assert marker.metrics[markdups.UNKNOWN_LIBRARY]['READ_PAIR_DUPLICATES'] == len(expected)
+
+
+def chimeric_lane(reads, header):
+    rand = random.Random(0)
+    for i, pos in enumerate(rand.sample(range(1000, 500000), 2000)):
+        add_pair(reads, header, 'pair{}'.format(i), pos, pos + 200, 30, 1)
+    # pairs with mates on chromosome 2, the second and third are duplicates
+    for i in range(3):
+        add_pair(reads, header, 'chimera{}'.format(i), 10, 5000, 30 - i, 1, tid2=1)
+
+
+def test_duplicate_marker_chimeric_pairs(tmpdir):
+    bamfile = os.path.join(str(tmpdir), 'chimeric.bam')
+    write_bam(bamfile, 1, chimeric_lane)
+
+    with pysam.AlignmentFile(bamfile) as reader:
+        marker = markdups.DuplicateMarker(reader.header)
+
+        marked = []
+        max_buffered = 0
+        for i, read in enumerate(reader.fetch(until_eof=True)):
+            marker.add_read(read)
+            marked.extend(marker.pop_marked_reads())
+            max_buffered = max(max_buffered, i + 1 - len(marked))
+
+        marker.finalize()
+        marked.extend(marker.pop_marked_reads())
+
+    # pairs are decided from their first read, the mates on
+    # chromosome 2 don't hold back the reads in between
+    assert max_buffered < 100
+    assert len(marked) == 4006
+
+    duplicates = [r for r in marked if r.is_duplicate]
+    assert sorted((r.query_name, r.reference_id) for r in duplicates) == [
+        ('chimera1', 0), ('chimera1', 1), ('chimera2', 0), ('chimera2', 1),
+    ]
+    assert marker.metrics['lib_cell']['READ_PAIRS_EXAMINED'] == 2003
+    assert marker.metrics['lib_cell']['READ_PAIR_DUPLICATES'] == 2
+
+
+def test_estimate_library_size():
+    assert markdups.estimate_library_size(1000, 1000) is None
+    # solves 900 / x = 1 - exp(-1000 / x)
+    assert markdups.estimate_library_size(1000, 900) == 4660
+
+
+def test_unclipped_five_prime():
+    header = pysam.AlignmentHeader.from_dict(get_header(1))
+    fwd = make_read(header, 'r', 0, 105, '5S95M', 30, 1, 0)
+    rev = make_read(header, 'r', 0, 105, '90M10S', 30, 1, 16)
+
+    assert markdups.unclipped_five_prime(fwd) == 100
+    assert markdups.unclipped_five_prime(rev) == 204
+
+
+def test_check_duplication_metrics(tmpdir):
+    tmpdir = str(tmpdir)
+    metrics = {'lib_cell': OrderedDict((col, 0) for col in markdups.METRICS_COLUMNS[1:])}
+    metrics['lib_cell']['READ_PAIRS_EXAMINED'] = 10
+    metrics['lib_cell']['READ_PAIR_DUPLICATES'] = 2
+
+    observed = os.path.join(tmpdir, 'observed.txt')
+    markdups.write_duplication_metrics(metrics, observed)
+
+    validation = os.path.join(tmpdir, 'validation.txt')
+    metrics['lib_cell']['PERCENT_DUPLICATION'] = 0.2
+    markdups.write_duplication_metrics(metrics, validation)
+
+    output = os.path.join(tmpdir, 'output.txt')
+    markdups.check_duplication_metrics(observed, validation, output)
+    assert markdups.read_duplication_metrics(output) == markdups.read_duplication_metrics(observed)
+
+    # optical duplicates are not validated
+    metrics['lib_cell']['READ_PAIR_OPTICAL_DUPLICATES'] = 1
+    markdups.write_duplication_metrics(metrics, validation)
+    markdups.check_duplication_metrics(observed, validation, output)
+
+    metrics['lib_cell']['READ_PAIR_DUPLICATES'] = 3
+    markdups.write_duplication_metrics(metrics, validation)
+    with pytest.raises(Exception, match='READ_PAIR_DUPLICATES'):
+        markdups.check_duplication_metrics(observed, validation, output)
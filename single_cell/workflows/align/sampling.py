@@ -0,0 +1,62 @@
+'''
+Deterministic read pair subsampling for the approximate qc mode,
+and the estimates of full bam metrics from the subsample.
+'''
+from __future__ import division
+
+import hashlib
+import math
+import struct
+
+# two sided 95% normal quantile
+Z_95 = 1.959964
+
+
+class PairSampler(object):
+    """
+    keeps a read if the md5 of its name falls below the sampling
+    fraction of the hash range (crc32 is far from uniform on near
+    identical read names). both mates of a pair hash the same, and
+    the same reads are kept on every run and in every job.
+    """
+
+    def __init__(self, fraction):
+        if not 0 < fraction <= 1:
+            raise ValueError('sampling fraction must be in (0, 1], got {}'.format(fraction))
+        self.fraction = fraction
+        self.threshold = int(fraction * 2 ** 32)
+
+    def keep(self, read):
+        digest = hashlib.md5(read.query_name.encode()).digest()
+        return struct.unpack('<I', digest[:4])[0] < self.threshold
+
+
+def get_sampler(fraction):
+    """
+    sampler for fraction, or None when all reads are used
+    """
+    if fraction is None or fraction >= 1:
+        return None
+    return PairSampler(fraction)
+
+
+def estimate_count(count, fraction, reads_per_unit=2):
+    """
+    full bam count from a count of reads in the sample, with the half
+    width of its 95% confidence interval. pairs are sampled, not
+    reads, so each sampling unit contributes reads_per_unit reads
+    """
+    estimate = count / fraction
+    ci = Z_95 * math.sqrt(reads_per_unit * count * (1 - fraction)) / fraction
+    return estimate, ci
+
+
+def estimate_breadth(breadth, fraction):
+    """
+    full bam coverage breadth from the breadth of the sample. reads
+    are assumed to land as a poisson process, so sampling scales the
+    poisson rate: 1 - b_sample = (1 - b) ** fraction
+    """
+    if breadth >= 1:
+        return 1.0
+    return 1 - (1 - breadth) ** (1 / fraction)
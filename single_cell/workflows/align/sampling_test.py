@@ -0,0 +1,40 @@
+import math
+
+import pysam
+import pytest
+from single_cell.workflows.align import sampling
+
+
+def make_read(name):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    return read
+
+
+def test_pair_sampler():
+    sampler = sampling.PairSampler(0.25)
+    reads = [make_read('M1:1:FC:1:1101:{}:{}'.format(i, i * 7)) for i in range(20000)]
+
+    kept = [sampler.keep(read) for read in reads]
+    assert abs(sum(kept) / float(len(kept)) - 0.25) < 0.02
+
+    # deterministic, and mates share the name so are kept together
+    assert kept == [sampling.PairSampler(0.25).keep(make_read(r.query_name)) for r in reads]
+
+    assert sampling.get_sampler(None) is None
+    assert sampling.get_sampler(1.0) is None
+    with pytest.raises(ValueError):
+        sampling.PairSampler(0)
+
+
+def test_estimates():
+    estimate, ci = sampling.estimate_count(100, 0.1, reads_per_unit=1)
+    assert estimate == 1000
+    assert abs(ci - sampling.Z_95 * math.sqrt(90) / 0.1) < 1e-9
+
+    # no uncertainty when every read is used
+    assert sampling.estimate_count(100, 1.0) == (100, 0)
+
+    rate = 0.3
+    sampled = 1 - math.exp(-rate * 0.2)
+    assert abs(sampling.estimate_breadth(sampled, 0.2) - (1 - math.exp(-rate))) < 1e-12
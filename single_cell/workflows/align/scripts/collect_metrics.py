@@ -4,17 +4,21 @@ Extract metrics table.
 
 from __future__ import division
 
+import math
 import os
 
 import pandas as pd
 
 from single_cell.utils import csvutils
+from single_cell.workflows.align import sampling
 
 class CollectMetrics(object):
     def __init__(
             self, wgs_metrics, insert_metrics, flagstat_metrics,
-            markdups_metrics, output, sample_id, dtypes
+            markdups_metrics, output, sample_id, dtypes,
+            sampling_fraction=None
     ):
+        self.sampling_fraction = sampling_fraction
         self.wgs_metrics = wgs_metrics
         self.flagstat_metrics = flagstat_metrics
         self.insert_metrics = insert_metrics
@@ -78,7 +82,7 @@ class CollectMetrics(object):
 
         df = pd.read_csv(
             self.flagstat_metrics,
-            sep=r'\s\+\s0\s',
+            sep=r'\s\+\s\d+\s',
             header=None,
             names=['value', 'type'],
             engine='python'
@@ -148,17 +152,19 @@ class CollectMetrics(object):
         outdata = tuple([0 if val == '' else val for val in outdata])
         return outdata
 
-    def extract_insert_metrics(self):
-        ''' Extract median and mean insert size '''
-
+    def read_insert_metrics(self):
+        """
+        first row of the insert metrics, keyed on lower case column
+        name. None if picard didn't produce any metrics
+        """
         # picardtools insertmetrics completes with code 0 and doesn't generate metrics file
         # if inputs don't have sufficient read count
         if not os.path.isfile(self.insert_metrics):
-            return 0, 0, 0
+            return None
 
         # if the insert metrics fails due to low coverage
         if open(self.insert_metrics).readline().startswith("## FAILED"):
-            return 0, 0, 0
+            return None
 
         mfile = open(self.insert_metrics)
 
@@ -178,11 +184,19 @@ class CollectMetrics(object):
         header, data = targetlines
 
         header = [v.lower() for v in header]
-        header = {v: i for i, v in enumerate(header)}
 
-        median_ins_size = data[header['median_insert_size']]
-        mean_ins_size = data[header['mean_insert_size']]
-        std_dev_ins_size = data[header['standard_deviation']]
+        return dict(zip(header, data))
+
+    def extract_insert_metrics(self):
+        ''' Extract median and mean insert size '''
+
+        data = self.read_insert_metrics()
+        if data is None:
+            return 0, 0, 0
+
+        median_ins_size = data['median_insert_size']
+        mean_ins_size = data['mean_insert_size']
+        std_dev_ins_size = data['standard_deviation']
 
         median_ins_size = 0 if median_ins_size == '?' else median_ins_size
         mean_ins_size = 0 if mean_ins_size == '?' else mean_ins_size
@@ -190,6 +204,43 @@ class CollectMetrics(object):
 
         return median_ins_size, mean_ins_size, std_dev_ins_size
 
+    def estimate_from_sample(self, flagstat_metrics, wgs_metrics):
+        """
+        scale the metrics computed on a subsample of read pairs up to
+        the full bam, with the half widths of their 95% confidence
+        intervals. the duplication metrics come from the full bam.
+        """
+        fraction = self.sampling_fraction
+
+        flagstat_estimates = []
+        cis = []
+        for value in flagstat_metrics:
+            estimate, ci = sampling.estimate_count(int(value), fraction)
+            flagstat_estimates.append(int(round(estimate)))
+            cis.append(ci)
+
+        # mean depth scales with the number of mapped reads
+        cov_breadth, cov_depth = wgs_metrics
+        mapped = int(flagstat_metrics[1])
+        cov_depth = cov_depth / fraction
+        cov_depth_ci = cov_depth * cis[1] / flagstat_estimates[1] if mapped else 0
+        cov_breadth = sampling.estimate_breadth(cov_breadth, fraction)
+
+        mean_ins_size_ci = 0
+        insert_data = self.read_insert_metrics() if self.insert_metrics else None
+        if insert_data is not None and insert_data['standard_deviation'] != '?':
+            mean_ins_size_ci = sampling.Z_95 * float(insert_data['standard_deviation']) / \
+                               math.sqrt(int(insert_data['read_pairs']))
+
+        header = [
+            'qc_sampling_fraction', 'total_reads_ci95', 'total_mapped_reads_ci95',
+            'total_duplicate_reads_ci95', 'total_properly_paired_ci95',
+            'coverage_depth_ci95', 'mean_insert_size_ci95',
+        ]
+        intervals = (fraction,) + tuple(cis) + (cov_depth_ci, mean_ins_size_ci)
+
+        return tuple(flagstat_estimates), (cov_breadth, cov_depth), header, intervals
+
     def write_data(self, header, data):
         """
         write to the output
@@ -227,6 +278,10 @@ class CollectMetrics(object):
             'coverage_breadth', 'coverage_depth',
         ]
 
+        if self.sampling_fraction is not None:
+            flagstat_metrics, wgs_metrics, sampling_header, sampling_data = \
+                self.estimate_from_sample(flagstat_metrics, wgs_metrics)
+
         output = (self.sample_id,) + duplication_metrics + flagstat_metrics + wgs_metrics
 
         if self.insert_metrics:
@@ -236,4 +291,8 @@ class CollectMetrics(object):
                        'mean_insert_size',
                        'standard_deviation_insert_size']
 
+        if self.sampling_fraction is not None:
+            output += sampling_data
+            header += sampling_header
+
         self.write_data(header, output)
@@ -2,15 +2,14 @@ from __future__ import division
 
 import os
 
-from single_cell.utils import bamutils
 from single_cell.utils import csvutils
 from single_cell.utils import helpers
 from single_cell.utils import picardutils
 from single_cell.utils.singlecell_copynumber_plot_utils import PlotMetrics
+from single_cell.workflows.align import markdups
 from single_cell.workflows.align.dtypes import dtypes
 
 from .scripts import CollectMetrics
-from .scripts import GenerateCNMatrix
 from .scripts import SummaryMetrics
 
 
@@ -27,25 +26,8 @@ def get_summary_metrics(infile, output):
     summ.main()
 
 
-def collect_gc(infiles, outfile, tempdir):
-    helpers.makedirs(tempdir)
-
-    tempouts = []
-    for cell_id, infile in infiles.items():
-        tempout = os.path.join(
-            tempdir,
-            "{}.parsed.csv.gz".format(cell_id))
-        tempouts.append(tempout)
-        gen_gc = GenerateCNMatrix(infile, tempout, ',',
-                                  'NORMALIZED_COVERAGE', cell_id,
-                                  'gcbias', dtypes()['gc'])
-        gen_gc.main()
-
-    csvutils.concatenate_csv(tempouts, outfile)
-
-
 def collect_metrics(flagstat_metrics, markdups_metrics, insert_metrics,
-                    wgs_metrics, tempdir, merged_metrics):
+                    wgs_metrics, tempdir, merged_metrics, sampling_fraction=None):
     helpers.makedirs(tempdir)
     sample_outputs = []
 
@@ -58,69 +40,31 @@ def collect_metrics(flagstat_metrics, markdups_metrics, insert_metrics,
         sample_outputs.append(outfile)
 
         collmet = CollectMetrics(wgs, insrt, flgstat,
-                                 mkdup, outfile, sample, dtypes()['metrics'])
+                                 mkdup, outfile, sample, dtypes()['metrics'],
+                                 sampling_fraction=sampling_fraction)
         collmet.main()
 
     csvutils.concatenate_csv(sample_outputs, merged_metrics)
 
 
-def picard_wgs_dup(
-        input_bam, markdups_bam, markdups_metrics, tempdir,
-        ref_genome, wgs_metrics, picard_wgs_params,
+def validate_duplication_metrics(input_bam, markdups_metrics, output, tempdir):
+    """
+    re-run picard MarkDuplicates on the duplicate marked bam and
+    check its metrics against the ones from the alignment step
+    """
+    helpers.makedirs(tempdir)
 
-):
-    tempdir_markdups = os.path.join(tempdir, 'markdups')
-    helpers.makedirs(tempdir_markdups)
+    picard_bam = os.path.join(tempdir, 'markdups.bam')
+    picard_metrics = os.path.join(tempdir, 'markdups_metrics.txt')
 
     picardutils.bam_markdups(
         input_bam,
-        markdups_bam,
-        markdups_metrics,
-        tempdir_markdups,
-    )
-
-    tempdir_wgs = os.path.join(tempdir, 'wgs')
-    helpers.makedirs(tempdir_wgs)
-
-    picardutils.bam_collect_wgs_metrics(
-        input_bam,
-        ref_genome,
-        wgs_metrics,
-        picard_wgs_params,
-        tempdir_wgs,
+        picard_bam,
+        picard_metrics,
+        tempdir,
     )
 
-
-def picard_insert_gc_flagstat(
-        input_bam, ref_genome, gc_metrics, gc_metrics_summary, gc_metrics_pdf,
-        tempdir, flagstat_metrics, insert_metrics, insert_pdf,
-):
-    bamutils.bam_flagstat(
-        input_bam,
-        flagstat_metrics,
-    )
-
-    gc_tempdir = os.path.join(tempdir, 'gc')
-    helpers.makedirs(gc_tempdir)
-
-    picardutils.bam_collect_gc_metrics(
-        input_bam,
-        ref_genome,
-        gc_metrics,
-        gc_metrics_summary,
-        gc_metrics_pdf,
-        gc_tempdir,
-    )
-
-    insert_tempdir = os.path.join(tempdir, 'insert')
-    helpers.makedirs(insert_tempdir)
-    picardutils.bam_collect_insert_metrics(
-        input_bam,
-        flagstat_metrics,
-        insert_metrics,
-        insert_pdf,
-        insert_tempdir,
-    )
+    markdups.check_duplication_metrics(markdups_metrics, picard_metrics, output)
 
 
 def tar_align_data(infiles, tar_output, tempdir):
@@ -0,0 +1,104 @@
+'''
+Window mappability of variants. The variants of a chromosome are sorted
+and grouped into dense blocks, the signal of each block is read from the
+bigwig once as an array and the mean of every window in the block is
+computed from cumulative sums, rather than querying the bigwig once per
+variant.
+'''
+import numpy as np
+
+# the window spans coord - 100 to coord + 100
+WINDOW_SIZE = 100
+
+# variants further apart than this start a new block
+MAX_BLOCK_GAP = 100000
+
+MAX_BLOCK_SIZE = 10000000
+
+
+def get_windows(coords, window_size=None):
+    """
+    0-based half open windows around the coords, clipped at the start
+    of the chromosome
+    """
+    if window_size is None:
+        window_size = WINDOW_SIZE
+
+    coords = np.asarray(coords, dtype=np.int64)
+    return np.maximum(coords - window_size, 0), coords + window_size
+
+
+def iter_blocks(begs, ends, max_gap=None, max_size=None):
+    """
+    yields (start, stop) index ranges of sorted windows that are read
+    together. a block ends at a gap of more than max_gap between windows
+    or when it would span more than max_size bases
+    """
+    if max_gap is None:
+        max_gap = MAX_BLOCK_GAP
+    if max_size is None:
+        max_size = MAX_BLOCK_SIZE
+
+    breaks = np.flatnonzero(begs[1:] - ends[:-1] > max_gap) + 1
+    segments = zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(begs)]]))
+
+    for start, stop in segments:
+        while start < stop:
+            end = start + np.searchsorted(ends[start:stop], begs[start] + max_size, side='right')
+            end = max(end, start + 1)
+            yield int(start), int(end)
+            start = end
+
+
+def get_window_means(signal, begs, ends):
+    """
+    mean of the signal over each window, ignoring bases without data
+    (nan). windows without any data have a mean of 0. begs and ends
+    are offsets into the signal
+    """
+    valid = ~np.isnan(signal)
+
+    sums = np.concatenate([[0], np.cumsum(np.where(valid, signal, 0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+
+    # windows past the end of the signal are clipped to it
+    begs = np.minimum(begs, len(signal))
+    ends = np.minimum(ends, len(signal))
+
+    window_sums = sums[ends] - sums[begs]
+    window_counts = counts[ends] - counts[begs]
+
+    means = np.zeros(len(begs))
+    covered = window_counts > 0
+    means[covered] = window_sums[covered] / window_counts[covered]
+
+    return means
+
+
+def get_mappability(get_signal, chrom, coords, window_size=None):
+    """
+    window mappability of the coords of a chromosome, in the order of
+    coords. get_signal(chrom, start, end) returns the signal of the
+    region as an array with nan where there is no data, or None if the
+    chromosome has no data
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+
+    order = np.argsort(coords, kind='stable')
+    begs, ends = get_windows(coords[order], window_size=window_size)
+
+    means = np.zeros(len(coords))
+
+    for start, stop in iter_blocks(begs, ends):
+        block_beg = begs[start]
+        block_end = ends[start:stop].max()
+
+        signal = get_signal(chrom, int(block_beg), int(block_end))
+        if signal is None:
+            continue
+
+        means[order[start:stop]] = get_window_means(
+            np.asarray(signal, dtype=float), begs[start:stop] - block_beg, ends[start:stop] - block_beg
+        )
+
+    return means
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from single_cell.workflows.mappability_annotation import _mappability
+
+
+def simulate_signal(rand, length):
+    signal = rand.uniform(0, 1, length)
+    # stretches without data
+    for beg in rand.randint(0, length, 20):
+        signal[beg:beg + rand.randint(1, 500)] = np.nan
+    return signal
+
+
+def naive_mappability(signal, coord):
+    # the summary of the previous per variant bigwig query
+    window = signal[max(coord - 100, 0):coord + 100]
+    window = window[~np.isnan(window)]
+    return window.mean() if len(window) else 0
+
+
+@pytest.mark.parametrize('max_gap,max_size', [(None, None), (500, 2000), (0, 1)])
+def test_get_mappability(monkeypatch, max_gap, max_size):
+    rand = np.random.RandomState(0)
+    signals = {'chr1': simulate_signal(rand, 50000), 'chr2': simulate_signal(rand, 20000)}
+
+    if max_gap is not None:
+        monkeypatch.setattr(_mappability, 'MAX_BLOCK_GAP', max_gap)
+        monkeypatch.setattr(_mappability, 'MAX_BLOCK_SIZE', max_size)
+
+    reads = []
+
+    def get_signal(chrom, beg, end):
+        reads.append((chrom, beg, end))
+        if chrom not in signals:
+            return None
+        # nan past the end of the chromosome, as the bigwig arrays
+        signal = np.full(end - beg, np.nan)
+        data = signals[chrom][beg:end]
+        signal[:len(data)] = data
+        return signal
+
+    for chrom, signal in signals.items():
+        # unsorted, with duplicates and windows overlapping the chromosome ends
+        coords = np.concatenate([rand.randint(1, len(signal), 1000), [1, 50, len(signal) - 10, 1]])
+
+        reads[:] = []
+        mappability = _mappability.get_mappability(get_signal, chrom, coords)
+
+        expected = [naive_mappability(signal, coord) for coord in coords]
+        assert mappability == pytest.approx(expected)
+
+        if max_gap is None:
+            # dense variants are read as a single block
+            assert len(reads) == 1
+
+    assert list(_mappability.get_mappability(get_signal, 'chr3', [10, 20])) == [0, 0]
+
+
+def test_iter_blocks():
+    begs, ends = _mappability.get_windows([50, 150, 300, 100000, 100100])
+
+    blocks = list(_mappability.iter_blocks(begs, ends, max_gap=1000, max_size=300))
+    assert blocks == [(0, 2), (2, 3), (3, 5)]
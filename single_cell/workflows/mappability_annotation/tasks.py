@@ -1,11 +1,14 @@
 from collections import OrderedDict
 
 import pandas as pd
+import pysam
 import vcf
 from bx.bbi.bigwig_file import BigWigFile
 from single_cell.utils import csvutils
 from single_cell.workflows.mappability_annotation.dtypes import dtypes
 
+from . import _mappability
+
 
 def parse_region_for_vcf(region):
     if ':' not in region:
@@ -24,52 +27,58 @@ def parse_region_for_vcf(region):
     return chrom, beg, end
 
 
-def get_mappability(
-        mappability_file,
-        vcf_file,
-        out_file,
-        region=None,
-        append_chr=True):
-    map_reader = BigWigFile(open(mappability_file, 'rb'))
-
-    vcf_reader = vcf.Reader(filename=vcf_file)
+def iter_vcf_positions(vcf_file, region=None):
+    """
+    yields the chrom and coord of the records of vcf_file, in region
+    """
+    vcf_reader = pysam.VariantFile(vcf_file)
 
     if region is not None:
         chrom, beg, end = parse_region_for_vcf(region)
         try:
-            vcf_reader = vcf_reader.fetch(chrom, start=beg, end=end)
+            records = vcf_reader.fetch(chrom, beg, end)
         except ValueError:
             print("no data for region {} in vcf".format(region))
-            vcf_reader = []
-
-    data = []
-
-    for record in vcf_reader:
-        if append_chr:
-            chrom = 'chr{0}'.format(record.CHROM)
-
-        else:
-            chrom = record.CHROM
+            records = []
+    else:
+        records = vcf_reader
 
-        coord = record.POS
+    for record in records:
+        yield record.chrom, record.pos
 
-        beg = coord - 100
+    vcf_reader.close()
 
-        beg = max(beg, 0)
 
-        end = coord + 100
+def get_mappability(
+        mappability_file,
+        vcf_file,
+        out_file,
+        region=None,
+        append_chr=True):
+    map_reader = BigWigFile(open(mappability_file, 'rb'))
 
-        result = map_reader.query(chrom, beg, end, 1)
+    positions = pd.DataFrame(
+        list(iter_vcf_positions(vcf_file, region=region)), columns=['chrom', 'coord']
+    )
 
-        if result is None:
-            mappability = 0
+    data = []
 
+    for chrom, chrom_positions in positions.groupby('chrom', sort=False):
+        if append_chr:
+            bigwig_chrom = 'chr{0}'.format(chrom)
         else:
-            mappability = result[0]['mean']
+            bigwig_chrom = chrom
 
-        data.append({'chrom': record.CHROM, 'coord': record.POS, 'mappability': mappability})
+        chrom_positions = chrom_positions.copy()
+        chrom_positions['mappability'] = _mappability.get_mappability(
+            map_reader.get_as_array, bigwig_chrom, chrom_positions['coord'].values
+        )
+        data.append(chrom_positions)
 
-    data = pd.DataFrame(data)
+    if data:
+        data = pd.concat(data).sort_index()
+    else:
+        data = pd.DataFrame(columns=['chrom', 'coord', 'mappability'])
 
     csvutils.write_dataframe_to_csv_and_yaml(data, out_file, dtypes())
 
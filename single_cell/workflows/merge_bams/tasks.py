@@ -3,10 +3,19 @@ Created on Jul 24, 2017
 
 @author: dgrewal
 '''
+import heapq
 import os
+import resource
+from contextlib import ExitStack
 
+import pysam
 from single_cell.utils import bamutils
 from single_cell.utils import helpers
+from single_cell.utils import pysamutils
+
+# file descriptors kept free for the region writers, their
+# indexes and whatever else the process has open
+RESERVED_FILE_HANDLES = 64
 
 
 def cell_region_merge_bams(cell_bams, region_bam, region):
@@ -22,22 +31,134 @@ def cell_region_merge_bams(cell_bams, region_bam, region):
     )
 
 
-def merge_bams(bams, outputs, regions, tempdir, ncores=None):
-    merge_tempdir = os.path.join(tempdir, "merge")
-    commands = []
-    for region in regions:
-        output = outputs[region]
-        region = '{}:{}-{}'.format(*region.split('-'))
-        cmd = list(['samtools', 'merge', '-f', '-R', region])
-        cmd.append(output)
-        cmd.extend(bams.values())
-        commands.append(cmd)
-    helpers.run_in_gnu_parallel(commands, merge_tempdir, ncores=ncores)
-
-    index_tempdir = os.path.join(tempdir, "index")
-    commands = []
-    for region in regions:
-        output = outputs[region]
-        commands.append(['samtools', 'index', output, output + ".bai"])
-
-    helpers.run_in_gnu_parallel(commands, index_tempdir, ncores=ncores)
+def get_max_open_files():
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        soft_limit = 65536
+    return max(2, soft_limit - RESERVED_FILE_HANDLES)
+
+
+def merge_headers(headers):
+    """
+    header of the merged bam: the first header with the read groups,
+    programs and comments of all inputs, same as samtools merge
+    """
+    references = headers[0].references
+    for header in headers[1:]:
+        if header.references != references:
+            raise ValueError('cannot merge bams aligned to different references')
+
+    headers = [header.to_dict() for header in headers]
+    merged = headers[0]
+
+    for key in ('RG', 'PG'):
+        records = []
+        seen = set()
+        for header in headers:
+            for record in header.get(key, []):
+                if record['ID'] not in seen:
+                    seen.add(record['ID'])
+                    records.append(record)
+        if records:
+            merged[key] = records
+
+    comments = []
+    for header in headers:
+        for comment in header.get('CO', []):
+            if comment not in comments:
+                comments.append(comment)
+    if comments:
+        merged['CO'] = comments
+
+    return pysam.AlignmentHeader.from_dict(merged)
+
+
+def merge_chromosome_reads(readers, chrom, start, end):
+    """
+    k-way merge of the reads overlapping chrom:start-end from
+    all readers in coordinate order, ties in input order
+    """
+    iterators = [reader.fetch(chrom, start, end) for reader in readers]
+    return heapq.merge(*iterators, key=lambda read: read.reference_start)
+
+
+def get_chromosome_span(regions):
+    return min(v[0] for v in regions), max(v[1] for v in regions)
+
+
+def merge_to_regions(bams, outputs, regions_by_chrom, threads=1):
+    """
+    merge the bams and write the reads of each region to its output.
+    every bam is opened once and each chromosome is read once.
+    """
+    regions_by_chrom = dict(regions_by_chrom)
+
+    with ExitStack() as stack:
+        readers = [stack.enter_context(pysam.AlignmentFile(bam, 'rb')) for bam in bams]
+        header = merge_headers([reader.header for reader in readers])
+
+        for chrom in header.references:
+            if chrom not in regions_by_chrom:
+                continue
+            chrom_regions = regions_by_chrom.pop(chrom)
+            start, end = get_chromosome_span(chrom_regions)
+            pysamutils.write_reads_by_region(
+                merge_chromosome_reads(readers, chrom, start, end),
+                chrom_regions, outputs, header, threads=threads
+            )
+
+    for chrom_regions in regions_by_chrom.values():
+        for _, _, region in chrom_regions:
+            pysamutils.write_empty_bam(outputs[region], header)
+
+
+def merge_to_bam(bams, output, regions_by_chrom, threads=1):
+    """
+    merge the reads of the bams that overlap any region into one indexed bam
+    """
+    with ExitStack() as stack:
+        readers = [stack.enter_context(pysam.AlignmentFile(bam, 'rb')) for bam in bams]
+        header = merge_headers([reader.header for reader in readers])
+
+        writer = pysamutils.open_bam_writer(output, header, threads=threads)
+        for chrom in header.references:
+            if chrom not in regions_by_chrom:
+                continue
+            start, end = get_chromosome_span(regions_by_chrom[chrom])
+            for read in merge_chromosome_reads(readers, chrom, start, end):
+                writer.write(read)
+        pysamutils.close_bam_writer(writer, output)
+
+
+def merge_bams(bams, outputs, regions, tempdir, ncores=None, max_open_files=None):
+    """
+    merge the cell bams into region bams in a single pass over the
+    cells. with more cells than max_open_files (default: the open file
+    limit) the cells are first merged in groups into intermediate bams,
+    so the number of open inputs stays bounded.
+    """
+    threads = max(1, ncores or 1)
+
+    if max_open_files is None:
+        max_open_files = get_max_open_files()
+    max_open_files = max(2, max_open_files)
+
+    regions_by_chrom = pysamutils.get_regions_by_chrom(regions)
+
+    bams = [bams[cell_id] for cell_id in sorted(bams)]
+
+    level = 0
+    while len(bams) > max_open_files:
+        level_tempdir = os.path.join(tempdir, 'merge_level_{}'.format(level))
+        helpers.makedirs(level_tempdir)
+
+        merged = []
+        for i in range(0, len(bams), max_open_files):
+            output = os.path.join(level_tempdir, 'group_{}.bam'.format(len(merged)))
+            merge_to_bam(bams[i:i + max_open_files], output, regions_by_chrom, threads=threads)
+            merged.append(output)
+
+        bams = merged
+        level += 1
+
+    merge_to_regions(bams, outputs, regions_by_chrom, threads=threads)
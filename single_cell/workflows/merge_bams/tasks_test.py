@@ -0,0 +1,93 @@
+import os
+import random
+
+import pysam
+from single_cell.utils import pysamutils
+from single_cell.workflows.merge_bams import tasks
+
+CHROM_LENGTHS = {'1': 40000, '2': 20000}
+
+
+def simulate_cell_bam(filepath, cell_id, num_reads=300, seed=0):
+    rand = random.Random(seed)
+    header = pysam.AlignmentHeader.from_dict({
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': chrom, 'LN': length} for chrom, length in sorted(CHROM_LENGTHS.items())],
+        'RG': [{'ID': cell_id, 'SM': cell_id}],
+        'PG': [{'ID': 'bwa', 'PN': 'bwa'}],
+    })
+
+    reads = []
+    for i in range(num_reads):
+        tid = rand.randint(0, 1)
+        read = pysam.AlignedSegment(header)
+        read.query_name = '{}_read{}'.format(cell_id, i)
+        read.flag = 0
+        read.reference_id = tid
+        # few distinct positions, so that reads of different cells tie
+        read.reference_start = rand.randrange(0, CHROM_LENGTHS[str(tid + 1)] - 1000, 50)
+        read.mapping_quality = 60
+        read.cigarstring = rand.choice(['100M', '50M500D50M'])
+        read.query_sequence = 'A' * 100
+        read.query_qualities = [30] * 100
+        read.set_tag('RG', cell_id)
+        reads.append(read)
+
+    reads.sort(key=lambda r: (r.reference_id, r.reference_start))
+    with pysam.AlignmentFile(filepath, 'wb', header=header) as writer:
+        for read in reads:
+            writer.write(read)
+    pysam.index(filepath)
+
+    return reads
+
+
+def naive_merge(cell_reads, region):
+    # samtools merge -R region: overlapping reads, coordinate order, ties in input order
+    chrom, start, end = pysamutils.parse_region(region)
+    reads = [
+        (read.reference_start, i, j, read.to_string())
+        for i, cell in enumerate(cell_reads)
+        for j, read in enumerate(cell)
+        if read.reference_name == chrom and
+           read.reference_start < end and pysamutils.get_read_span(read)[1] > start
+    ]
+    return [v[-1] for v in sorted(reads)]
+
+
+def run_merge(tmpdir, max_open_files):
+    cell_ids = ['cell{}'.format(i) for i in range(7)]
+    bams = {}
+    cell_reads = []
+    for i, cell_id in enumerate(cell_ids):
+        bams[cell_id] = os.path.join(tmpdir, cell_id + '.bam')
+        cell_reads.append(simulate_cell_bam(bams[cell_id], cell_id, seed=i))
+
+    regions = ['1-1-15000', '1-15001-30000', '1-30001-40000', '2-1-20000']
+    outputs = {region: os.path.join(tmpdir, region + '.merged.bam') for region in regions}
+
+    tasks.merge_bams(
+        bams, outputs, regions, os.path.join(tmpdir, 'temp'),
+        ncores=2, max_open_files=max_open_files
+    )
+    return cell_reads, regions, outputs
+
+
+def check_merge(cell_reads, regions, outputs):
+    for region in regions:
+        with pysam.AlignmentFile(outputs[region], 'rb') as reader:
+            merged = [read.to_string() for read in reader.fetch(until_eof=True)]
+            header = reader.header.to_dict()
+        assert merged == naive_merge(cell_reads, region)
+        assert len(header['RG']) == len(cell_reads)
+        assert len(header['PG']) == 1
+        assert os.path.exists(outputs[region] + '.bai')
+
+
+def test_merge_bams(tmpdir):
+    check_merge(*run_merge(str(tmpdir), None))
+
+
+def test_merge_bams_bounded_handles(tmpdir):
+    # 7 cells with 2 open inputs at a time takes three levels of intermediate merges
+    check_merge(*run_merge(str(tmpdir), 2))
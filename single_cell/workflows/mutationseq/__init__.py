@@ -9,7 +9,7 @@ from single_cell.workflows.mutationseq.dtypes import dtypes
 
 
 def museq_callback(record):
-    return record.INFO['PR']
+    return record.info['PR']
 
 
 def create_museq_workflow(
@@ -24,6 +24,18 @@ def create_museq_workflow(
         value=list(normal_bam.keys()),
     )
 
+    workflow.transform(
+        name='get_empty_regions',
+        ctx=dict(mem=config["memory"]['low']),
+        func='single_cell.utils.regionutils.get_empty_regions',
+        ret=mgd.TempOutputObj('empty_regions'),
+        args=(
+            mgd.InputFile('normal.split.bam', 'region', fnames=normal_bam, extensions=['.bai']),
+            mgd.InputFile('merged_bam', 'region', fnames=tumour_bam, extensions=['.bai']),
+        ),
+        kwargs={'reference': config['ref_genome']},
+    )
+
     workflow.transform(
         name='subsample_tumour',
         ctx=dict(mem=config["memory"]['med']),
@@ -33,6 +45,10 @@ def create_museq_workflow(
             mgd.InputFile('merged_bam', 'region', fnames=tumour_bam, extensions=['.bai']),
             mgd.TempOutputFile("tumour_subsample.bam", "region", extensions=['.bai'])
         ),
+        kwargs={
+            'region': mgd.InputInstance('region'),
+            'empty_regions': mgd.TempInputObj('empty_regions'),
+        },
     )
 
     workflow.transform(
@@ -44,6 +60,10 @@ def create_museq_workflow(
             mgd.InputFile('normal.split.bam', 'region', fnames=normal_bam, extensions=['.bai']),
             mgd.TempOutputFile("normal_subsample.bam", "region", extensions=['.bai'])
         ),
+        kwargs={
+            'region': mgd.InputInstance('region'),
+            'empty_regions': mgd.TempInputObj('empty_regions'),
+        },
     )
 
     workflow.transform(
@@ -59,63 +79,34 @@ def create_museq_workflow(
             mgd.InputInstance('region'),
             config,
         ),
-    )
-
-    workflow.transform(
-        name='finalise_region_vcfs',
-        axes=('region',),
-        ctx=dict(mem=config["memory"]['med']),
-        func='biowrappers.components.io.vcf.tasks.finalise_vcf',
-        args=(
-            mgd.TempInputFile('museq.vcf', 'region'),
-            mgd.TempOutputFile('museq.vcf.gz', 'region', extensions=['.tbi', '.csi']),
-        ),
+        kwargs={'empty_regions': mgd.TempInputObj('empty_regions')},
     )
 
     workflow.transform(
         name='merge_snvs',
         ctx=dict(mem=config["memory"]['med']),
-        func='biowrappers.components.io.vcf.tasks.concatenate_vcf',
+        func='single_cell.utils.vcfsortutils.concatenate_vcf',
         args=(
-            mgd.TempInputFile('museq.vcf.gz', 'region', extensions=['.tbi', '.csi']),
-            mgd.TempOutputFile('museq.vcf.gz', extensions=['.tbi', '.csi']),
+            mgd.TempInputFile('museq.vcf', 'region'),
+            mgd.OutputFile(snv_vcf, extensions=['.tbi', '.csi']),
         ),
         kwargs={
-            'allow_overlap': True,
+            'tempdir': mgd.TempSpace('merge_snvs_temp'),
         },
     )
 
-    workflow.transform(
-        name='finalise_vcf',
-        func='biowrappers.components.io.vcf.tasks.finalise_vcf',
-        ctx=dict(mem=config["memory"]['med']),
-        args=(
-            mgd.TempInputFile('museq.vcf.gz', extensions=['.tbi', '.csi']),
-            mgd.OutputFile(snv_vcf, extensions=['.tbi', '.csi']),
-        ),
-    )
-
     workflow.transform(
         name='convert_museq_to_csv',
-        func="biowrappers.components.io.vcf.tasks.convert_vcf_to_csv",
+        func="single_cell.utils.vcftableutils.convert_vcf_to_csv",
         ctx=ctx,
         args=(
             mgd.InputFile(snv_vcf),
-            mgd.TempOutputFile('museq.csv'),
+            mgd.OutputFile(museq_csv, extensions=['.yaml']),
+            dtypes()['snv_museq'],
         ),
         kwargs={
             'score_callback': museq_callback,
         }
     )
 
-    workflow.transform(
-        name='prep_museq_csv',
-        func='single_cell.utils.csvutils.rewrite_csv_file',
-        args=(
-            mgd.TempInputFile('museq.csv'),
-            mgd.OutputFile(museq_csv, extensions=['.yaml'])
-        ),
-        kwargs={'dtypes': dtypes()['snv_museq']}
-    )
-
     return workflow
@@ -4,10 +4,18 @@ Created on Jul 24, 2017
 @author: dgrewal
 '''
 import pypeliner
+import pysam
+from single_cell.utils import pysamutils
+from single_cell.utils import vcfsortutils
 from single_cell.utils import vcfutils
 
 
-def subsample(input_bam, output_bam, max_coverage=10000):
+def subsample(input_bam, output_bam, max_coverage=10000, region=None, empty_regions=None):
+    if empty_regions and region in empty_regions:
+        with pysam.AlignmentFile(input_bam, 'rb') as reader:
+            pysamutils.write_empty_bam(output_bam, reader.header)
+        return
+
     cmd = ['variant', input_bam, '-m', max_coverage, '-v', '-b', '-o', output_bam]
     pypeliner.commandline.execute(*cmd)
 
@@ -15,7 +23,7 @@ def subsample(input_bam, output_bam, max_coverage=10000):
     pypeliner.commandline.execute(*cmd)
 
 
-def run_museq(tumour, normal, out, log, region, config):
+def run_museq(tumour, normal, out, log, region, config, empty_regions=None):
     '''
     Run museq script for each chromosome
 
@@ -25,8 +33,16 @@ def run_museq(tumour, normal, out, log, region, config):
     :param log: path to the log file
     :param config: path to the config YAML file
     :param chrom: chromosome number
+    :param empty_regions: regions without reads in the tumour or normal,
+    an empty VCF is written for these instead of running museq
     '''
 
+    if empty_regions and region in empty_regions:
+        vcfsortutils.write_empty_vcf(out, bam=tumour)
+        with open(log, 'wt') as writer:
+            writer.write('no reads in tumour or normal for region {}, museq not run\n'.format(region))
+        return
+
     reference = config['ref_genome']
 
     region = '{}:{}-{}'.format(*region.split('-'))
@@ -35,7 +35,7 @@ def create_snv_annotate_workflow(
 
     workflow.transform(
         name='finalise_snvs',
-        func="biowrappers.components.io.vcf.tasks.finalise_vcf",
+        func="single_cell.utils.vcfsortutils.finalise_vcf",
         ctx=ctx,
         args=(
             mgd.TempInputFile('all.snv.vcf'),
@@ -41,6 +41,7 @@ def create_split_workflow(
                 mgd.TempSpace("bam_split_by_reads"),
                 regions,
             ),
+            kwargs={"ncores": config["max_cores"]}
         )
 
     elif one_split_job:
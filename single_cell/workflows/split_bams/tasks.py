@@ -3,30 +3,34 @@ Created on Nov 21, 2017
 
 @author: dgrewal
 '''
-import gzip
-import os
+import hashlib
+import struct
 
+import pysam
 from single_cell.utils import bamutils
-from single_cell.utils import helpers
-
-import pypeliner
+from single_cell.utils import pysamutils
 
 
 def split_bam_file_one_job(bam, outbam, regions, tempdir, ncores=None):
-    commands = []
-    for region in regions:
-        output = outbam[region]
-        region = '{}:{}-{}'.format(*region.split('-'))
-        commands.append(['samtools', 'view', '-b', bam, '-o', output, region])
+    """
+    split the bam into regions in a single pass, every read is written
+    to all regions it overlaps (same as samtools view bam region)
+    """
+    threads = max(1, ncores or 1)
 
-    helpers.run_in_gnu_parallel(commands, tempdir, ncores=ncores)
+    regions_by_chrom = pysamutils.get_regions_by_chrom(regions)
 
-    commands = []
-    for region in regions:
-        output = outbam[region]
-        commands.append(['samtools', 'index', output, output + ".bai"])
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as reader:
+        for chrom in reader.references:
+            if chrom in regions_by_chrom:
+                pysamutils.write_reads_by_region(
+                    reader.fetch(chrom), regions_by_chrom.pop(chrom),
+                    outbam, reader.header, threads=threads
+                )
 
-    helpers.run_in_gnu_parallel(commands, tempdir, ncores=ncores)
+        for chrom_regions in regions_by_chrom.values():
+            for _, _, region in chrom_regions:
+                pysamutils.write_empty_bam(outbam[region], reader.header)
 
 
 def split_bam_file(bam, outbam, interval):
@@ -36,107 +40,28 @@ def split_bam_file(bam, outbam, interval):
     bamutils.bam_index(outbam, outbai)
 
 
-def split_bam_file_by_reads(bam, outbams, tempspace, intervals):
-    # sort bam by reads and convert to sam
-
-    helpers.makedirs(tempspace)
-
-    headerfile = os.path.join(tempspace, "bam_header.sam")
-
-    cmd = ['samtools', 'view', '-H', bam, '-o', headerfile]
-    pypeliner.commandline.execute(*cmd)
-
-    collate_prefix = os.path.join(
-        tempspace, os.path.basename(bam) + "_collate_temp"
-    )
-    collated_bam = os.path.join(tempspace, "bam_file_collated_sam_format.sam")
-
-    cmd = [
-        'samtools', 'collate', '-u', '-O', bam, collate_prefix, '|',
-        'samtools', 'view', '-', '-o', collated_bam
-    ]
-
-    pypeliner.commandline.execute(*cmd)
-
-    tempoutputs = [
-        os.path.join(tempspace, os.path.basename(outbams[interval]) + ".split.temp")
-        for interval in intervals
-    ]
-
-    split(collated_bam, tempoutputs, headerfile=headerfile)
-
-    for inputsam, interval in zip(tempoutputs, intervals):
-        outputbam = outbams[interval]
-
-        cmd = ['samtools', 'view', '-Sb', inputsam, '-o', outputbam]
-
-        pypeliner.commandline.execute(*cmd)
-
-
-def get_file_handle(filename, mode="r"):
-    if os.path.splitext(filename)[-1] == ".gz":
-        return gzip.open(filename, mode + "b")
-    else:
-        return open(filename, mode)
-
-
-def get_file_linecount(infile):
-    def blocks(files, size=65536):
-        while True:
-            b = files.read(size)
-            if not b:
-                break
-            yield b
-
-    with get_file_handle(infile, mode="r") as inputdata:
-        numlines = sum(bl.count("\n") for bl in blocks(inputdata))
-
-    return numlines
-
-
-def split(infile, outfiles, headerfile=None):
-    if headerfile:
-        with open(headerfile) as headerdata:
-            header = headerdata.readlines()
-
-    with get_file_handle(infile, mode="r") as inputdata:
-
-        lines_per_file = get_file_linecount(infile) / len(outfiles)
-
-        file_number = 0
-        line_number = 0
-
-        outputfilehandle = get_file_handle(outfiles[file_number], mode='w')
-        if headerfile:
-            outputfilehandle.writelines(header)
-
-        while True:
-            line = inputdata.readline()
-            line_number += 1
-            if not line:
-                break
-
-            outputfilehandle.write(line)
-
-            if line_number > ((file_number + 1) * lines_per_file):
-                # if next line has the same readname as last line in file
-                # then write to the same file else write to next
-                line2 = inputdata.readline()
-                line_number += 1
-                readname2 = line2.split()[0]
-                readname = line.split()[0]
+def get_read_chunk(read, num_chunks):
+    digest = hashlib.md5(read.query_name.encode()).digest()
+    return struct.unpack('<I', digest[:4])[0] % num_chunks
 
-                if readname2 == readname:
-                    outputfilehandle.write(line2)
 
-                outputfilehandle.close()
-                outputfilehandle = open(outfiles[file_number], 'w')
-                if headerfile:
-                    outputfilehandle.writelines(header)
+def split_bam_file_by_reads(bam, outbams, tempspace, intervals, ncores=None):
+    """
+    split the bam into one chunk per interval in a single pass, the
+    reads are assigned to chunks on a hash of the read name so both
+    mates and all alignments of a read end up in the same chunk. the
+    chunks keep the input order and are indexed.
+    """
+    threads = max(1, (ncores or 1) // max(1, len(intervals)))
 
-                if not readname2 == readname:
-                    outputfilehandle.write(line2)
+    with pysam.AlignmentFile(bam, 'rb', threads=max(1, ncores or 1)) as reader:
+        writers = [
+            pysamutils.open_bam_writer(outbams[interval], reader.header, threads=threads)
+            for interval in intervals
+        ]
 
-                file_number += 1
+        for read in reader.fetch(until_eof=True):
+            writers[get_read_chunk(read, len(writers))].write(read)
 
-        outputfilehandle.close()
+    for writer, interval in zip(writers, intervals):
+        pysamutils.close_bam_writer(writer, outbams[interval])
@@ -0,0 +1,78 @@
+import os
+from collections import Counter
+
+import pysam
+from single_cell.utils import pysamutils
+from single_cell.utils.tests import bam_helpers
+from single_cell.workflows.split_bams import tasks
+
+CHROM_LENGTHS = {'1': 50000, '2': 30000, '3': 10000}
+
+
+SIMULATION = dict(
+    # nothing on chromosome 3
+    reference_ids=[0, 1], inserts=(400, 400),
+    # a few long deletions so that reads span region boundaries
+    cigars=['100M', '100M', '50M500D50M'],
+    # unmapped read placed at its mate and an unplaced unmapped read
+    extra_reads=[
+        dict(query_name=name, reference_id=tid, reference_start=pos, flag=4)
+        for name, tid, pos in (('placed', 0, 9999), ('unplaced', -1, -1))
+    ],
+)
+
+
+def read_bam(filepath):
+    with pysam.AlignmentFile(filepath, 'rb') as reader:
+        return [read.to_string() for read in reader.fetch(until_eof=True)]
+
+
+def test_split_bam_file_one_job(tmpdir):
+    tmpdir = str(tmpdir)
+    bamfile = os.path.join(tmpdir, 'input.bam')
+    reads = bam_helpers.simulate_bam(bamfile, sorted(CHROM_LENGTHS.items()), **SIMULATION)
+
+    regions = [
+        '{}-{}-{}'.format(chrom, start, min(start + 9999, length))
+        for chrom, length in CHROM_LENGTHS.items()
+        for start in range(1, length + 1, 10000)
+    ]
+    outbams = {region: os.path.join(tmpdir, region + '.bam') for region in regions}
+
+    tasks.split_bam_file_one_job(bamfile, outbams, regions, tmpdir, ncores=2)
+
+    for region in regions:
+        chrom, start, end = pysamutils.parse_region(region)
+        expected = [
+            read.to_string() for read in reads
+            if read.reference_name == chrom and
+               read.reference_start < end and pysamutils.get_read_span(read)[1] > start
+        ]
+        assert read_bam(outbams[region]) == expected
+        assert os.path.exists(outbams[region] + '.bai')
+
+    assert read_bam(outbams['3-1-10000']) == []
+
+
+def test_split_bam_file_by_reads(tmpdir):
+    tmpdir = str(tmpdir)
+    bamfile = os.path.join(tmpdir, 'input.bam')
+    reads = bam_helpers.simulate_bam(bamfile, sorted(CHROM_LENGTHS.items()), **SIMULATION)
+
+    intervals = ['chunk{}'.format(i) for i in range(4)]
+    outbams = {interval: os.path.join(tmpdir, interval + '.bam') for interval in intervals}
+
+    tasks.split_bam_file_by_reads(bamfile, outbams, tmpdir, intervals, ncores=2)
+
+    names = Counter()
+    all_reads = []
+    for interval in intervals:
+        chunk = read_bam(outbams[interval])
+        all_reads.extend(chunk)
+        assert os.path.exists(outbams[interval] + '.bai')
+        for name in set(read.split('\t')[0] for read in chunk):
+            names[name] += 1
+
+    # every read name is in exactly one chunk
+    assert set(names.values()) == {1}
+    assert sorted(all_reads) == sorted(read.to_string() for read in reads)
@@ -8,7 +8,7 @@ default_chromosomes = [str(x) for x in range(1, 23)] + ['X', 'Y']
 
 
 def strelka_snv_callback(record):
-    return record.INFO['QSS']
+    return record.info['QSS']
 
 
 def create_strelka_workflow(
@@ -40,24 +40,27 @@ def create_strelka_workflow(
     )
 
     workflow.transform(
-        name='count_fasta_bases',
+        name="get_chrom_sizes",
         ctx=dict(mem=2),
-        func="single_cell.workflows.strelka.tasks.count_fasta_bases",
+        func="single_cell.utils.refgenome.get_known_chromosome_sizes",
+        ret=pypeliner.managed.TempOutputObj('known_sizes'),
         args=(
             ref_genome_fasta_file,
-            pypeliner.managed.TempOutputFile('ref_base_counts.tsv'),
+            chromosomes
         )
     )
 
+    # only regions without normal reads are skipped, the normal coverage
+    # in the strelka stats of the others sets the depth filter threshold
     workflow.transform(
-        name="get_chrom_sizes",
+        name='get_empty_regions',
         ctx=dict(mem=2),
-        func="single_cell.workflows.strelka.tasks.get_known_chromosome_sizes",
-        ret=pypeliner.managed.TempOutputObj('known_sizes'),
+        func="single_cell.utils.regionutils.get_empty_regions",
+        ret=pypeliner.managed.TempOutputObj('empty_regions'),
         args=(
-            pypeliner.managed.TempInputFile('ref_base_counts.tsv'),
-            chromosomes
-        )
+            pypeliner.managed.InputFile("normal.split.bam", "region", fnames=normal_bam_file, extensions=['.bai']),
+        ),
+        kwargs={'reference': ref_genome_fasta_file}
     )
 
     workflow.transform(
@@ -76,6 +79,7 @@ def create_strelka_workflow(
             pypeliner.managed.TempOutputFile('strelka.stats', 'region'),
             pypeliner.managed.InputInstance("region"),
         ),
+        kwargs={'empty_regions': pypeliner.managed.TempInputObj('empty_regions')},
     )
 
     workflow.transform(
@@ -87,12 +91,12 @@ def create_strelka_workflow(
             pypeliner.managed.TempInputFile('somatic.indels.unfiltered.vcf', 'region'),
             pypeliner.managed.TempInputFile('strelka.stats', 'region'),
             pypeliner.managed.TempInputFile('somatic.indels.unfiltered.vcf.window', 'region'),
-            pypeliner.managed.TempOutputFile('somatic.indels.filtered.vcf', 'chrom'),
+            pypeliner.managed.TempOutputFile('somatic.indels.filtered.vcf.gz', 'chrom'),
             pypeliner.managed.InputInstance("chrom"),
             pypeliner.managed.TempInputObj('known_sizes'),
             regions
         ),
-        kwargs={'use_depth_filter': use_depth_thresholds}
+        kwargs={'use_depth_filter': use_depth_thresholds, 'passed_only': True}
     )
 
     workflow.transform(
@@ -103,12 +107,12 @@ def create_strelka_workflow(
         args=(
             pypeliner.managed.TempInputFile('somatic.snvs.unfiltered.vcf', 'region'),
             pypeliner.managed.TempInputFile('strelka.stats', 'region'),
-            pypeliner.managed.TempOutputFile('somatic.snvs.filtered.vcf', 'chrom'),
+            pypeliner.managed.TempOutputFile('somatic.snvs.filtered.vcf.gz', 'chrom'),
             pypeliner.managed.InputInstance("chrom"),
             pypeliner.managed.TempInputObj('known_sizes'),
             regions,
         ),
-        kwargs={'use_depth_filter': use_depth_thresholds}
+        kwargs={'use_depth_filter': use_depth_thresholds, 'passed_only': True}
     )
 
     workflow.transform(
@@ -116,8 +120,8 @@ def create_strelka_workflow(
         ctx=dict(mem=4),
         func="single_cell.workflows.strelka.vcf_tasks.concatenate_vcf",
         args=(
-            pypeliner.managed.TempInputFile('somatic.indels.filtered.vcf', 'chrom'),
-            pypeliner.managed.TempOutputFile('somatic.indels.filtered.vcf.gz'),
+            pypeliner.managed.TempInputFile('somatic.indels.filtered.vcf.gz', 'chrom'),
+            pypeliner.managed.OutputFile(indel_vcf_file, extensions=['.tbi', '.csi']),
             pypeliner.managed.TempSpace("merge_indels_temp"),
         )
     )
@@ -127,74 +131,25 @@ def create_strelka_workflow(
         ctx=dict(mem=4),
         func="single_cell.workflows.strelka.vcf_tasks.concatenate_vcf",
         args=(
-            pypeliner.managed.TempInputFile('somatic.snvs.filtered.vcf', 'chrom'),
-            pypeliner.managed.TempOutputFile('somatic.snvs.filtered.vcf.gz'),
-            pypeliner.managed.TempSpace("merge_snvs_temp"),
-        )
-    )
-
-    workflow.transform(
-        name='filter_indels',
-        ctx=dict(mem=4),
-        func="single_cell.workflows.strelka.vcf_tasks.filter_vcf",
-        args=(
-            pypeliner.managed.TempInputFile('somatic.indels.filtered.vcf.gz'),
-            pypeliner.managed.TempOutputFile('somatic.indels.passed.vcf')
-        )
-    )
-
-    workflow.transform(
-        name='filter_snvs',
-        ctx=dict(mem=4),
-        func="single_cell.workflows.strelka.vcf_tasks.filter_vcf",
-        args=(
-            pypeliner.managed.TempInputFile('somatic.snvs.filtered.vcf.gz'),
-            pypeliner.managed.TempOutputFile('somatic.snvs.passed.vcf')
-        )
-    )
-
-    workflow.transform(
-        name='finalise_indels',
-        ctx=dict(mem=4),
-        func="single_cell.workflows.strelka.vcf_tasks.finalise_vcf",
-        args=(
-            pypeliner.managed.TempInputFile('somatic.indels.passed.vcf'),
-            pypeliner.managed.OutputFile(indel_vcf_file, extensions=['.tbi', '.csi']),
-        )
-    )
-
-    workflow.transform(
-        name='finalise_snvs',
-        ctx=dict(mem=2),
-        func="single_cell.workflows.strelka.vcf_tasks.finalise_vcf",
-        args=(
-            pypeliner.managed.TempInputFile('somatic.snvs.passed.vcf'),
+            pypeliner.managed.TempInputFile('somatic.snvs.filtered.vcf.gz', 'chrom'),
             pypeliner.managed.OutputFile(snv_vcf_file, extensions=['.tbi', '.csi']),
+            pypeliner.managed.TempSpace("merge_snvs_temp"),
         )
     )
 
     workflow.transform(
         name='convert_strelka_to_csv',
-        func="biowrappers.components.io.vcf.tasks.convert_vcf_to_csv",
+        func="single_cell.utils.vcftableutils.convert_vcf_to_csv",
         ctx=ctx,
         args=(
             pypeliner.managed.InputFile(snv_vcf_file),
-            pypeliner.managed.TempOutputFile('strelka_snv.csv'),
+            pypeliner.managed.OutputFile(snv_csv_file, extensions=['.yaml']),
+            dtypes()['snv_strelka'],
         ),
         kwargs={
             'score_callback': strelka_snv_callback,
         }
     )
 
-    workflow.transform(
-        name='prep_strelka_csv',
-        func='single_cell.utils.csvutils.rewrite_csv_file',
-        args=(
-            pypeliner.managed.TempInputFile('strelka_snv.csv'),
-            pypeliner.managed.OutputFile(snv_csv_file, extensions=['.yaml'])
-        ),
-        kwargs={'dtypes': dtypes()['snv_strelka']}
-    )
-
 
     return workflow
@@ -0,0 +1,479 @@
+'''
+Batched filtering of strelka vcfs. Records are read in batches into
+columns, the strelka filters are computed as numpy masks over each
+batch and the records are written back out with their FILTER column
+(and for indels the window FORMAT fields) updated, bgzipped when the
+output ends in .gz.
+'''
+from __future__ import division
+
+import csv
+import gzip
+import math
+import re
+
+import numpy as np
+import pandas as pd
+import pysam
+
+FILTER_ID_BASE = 'BCNoise'
+FILTER_ID_DEPTH = 'DP'
+FILTER_ID_INDEL_HPOL = 'iHpol'
+FILTER_ID_QSI = 'QSI_ref'
+FILTER_ID_QSS = 'QSS_ref'
+FILTER_ID_REPEAT = 'Repeat'
+FILTER_ID_SPANNING_DELETION = 'SpanDel'
+
+VCF_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+
+WINDOW_COLUMNS = [
+    'chrom',
+    'coord',
+    'normal_window_used',
+    'normal_window_filtered',
+    'normal_window_submap',
+    'tumour_window_used',
+    'tumour_window_filtered',
+    'tumour_window_submap'
+]
+
+BATCH_SIZE = 100000
+
+MEAN_MATCHER = re.compile(r'mean:\s(.*?)\s')
+
+SAMPLE_SIZE_MATCHER = re.compile(r'sample_size:\s(.*?)\s')
+
+
+def get_normal_coverage(stats_files):
+    total_coverage = 0
+
+    for file_name in stats_files:
+        with open(file_name) as fh:
+            for line in fh:
+                if not line.startswith('NORMAL_NO_REF_N_COVERAGE '):
+                    continue
+
+                mean = float(MEAN_MATCHER.search(line).group(1))
+
+                sample_size = float(SAMPLE_SIZE_MATCHER.search(line).group(1))
+
+                if math.isnan(mean) or math.isnan(sample_size):
+                    continue
+
+                total_coverage += mean * sample_size
+
+    return total_coverage
+
+
+def get_max_normal_coverage(depth_filter_multiple, known_chrom_size, stats_files):
+    normal_coverage = get_normal_coverage(stats_files)
+
+    normal_mean_coverage = normal_coverage / known_chrom_size
+
+    return normal_mean_coverage * depth_filter_multiple
+
+
+def _open_vcf(filepath):
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rt')
+    return open(filepath, 'rt')
+
+
+def read_header(filepath):
+    header = []
+    with _open_vcf(filepath) as reader:
+        for line in reader:
+            if not line.startswith('#'):
+                break
+            header.append(line.rstrip('\n'))
+    return header
+
+
+def get_header_index(vcf_files):
+    """
+    index of the first vcf with records, or of the first vcf. the output
+    header comes from it rather than from the bare header of an empty vcf
+    """
+    for i, vcf_file in enumerate(vcf_files):
+        with _open_vcf(vcf_file) as reader:
+            if any(not line.startswith('#') for line in reader):
+                return i
+    return 0
+
+
+def iter_record_batches(filepath, num_header_lines, columns, batch_size=None):
+    """
+    yields the records of the vcf as dataframes of string columns
+    """
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+
+    try:
+        batches = pd.read_csv(
+            filepath, sep='\t', header=None, names=columns, dtype=str,
+            skiprows=num_header_lines, chunksize=batch_size,
+            na_filter=False, quoting=csv.QUOTE_NONE
+        )
+    except pd.errors.EmptyDataError:
+        return
+
+    for batch in batches:
+        yield batch
+
+
+def _get_header_id(line):
+    match = re.match(r'##(\w+)=<ID=([^,>]*)', line)
+    return match.groups() if match else None
+
+
+def add_header_lines(header, lines):
+    """
+    adds ##FILTER/##FORMAT lines before the #CHROM line, replacing
+    lines of the same type and ID
+    """
+    new_ids = set(_get_header_id(line) for line in lines)
+
+    header = [line for line in header if _get_header_id(line) not in new_ids]
+
+    return header[:-1] + list(lines) + header[-1:]
+
+
+def filter_header_line(filter_id, desc):
+    return '##FILTER=<ID={},Description="{}">'.format(filter_id, desc)
+
+
+def format_header_line(format_id, value_type, desc):
+    return '##FORMAT=<ID={},Number=1,Type={},Description="{}">'.format(format_id, value_type, desc)
+
+
+def get_info_values(batch, key):
+    """
+    numeric values of an INFO key, nan where the key is missing
+    """
+    values = batch['INFO'].str.extract(r'(?:^|;){}=([^;]*)'.format(key), expand=False)
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+
+
+def get_info_strings(batch, key):
+    values = batch['INFO'].str.extract(r'(?:^|;){}=([^;]*)'.format(key), expand=False)
+    return values.fillna('').to_numpy(dtype=object)
+
+
+def get_sample_values(batch, sample, keys):
+    """
+    numeric values of the FORMAT keys for the sample, as a dict of
+    arrays. missing or '.' values are nan
+    """
+    values = {key: np.full(len(batch), np.nan) for key in keys}
+
+    for fmt in batch['FORMAT'].unique():
+        mask = (batch['FORMAT'] == fmt).to_numpy()
+        fmt = fmt.split(':')
+
+        fields = batch.loc[mask, sample].str.split(':', expand=True)
+
+        for key in keys:
+            if key not in fmt or fmt.index(key) >= fields.shape[1]:
+                continue
+            column = fields[fmt.index(key)]
+            values[key][mask] = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+
+    return values
+
+
+def safe_fraction(numerator, denominator):
+    frac = np.zeros(len(numerator))
+    nonzero = denominator > 0
+    frac[nonzero] = numerator[nonzero] / denominator[nonzero]
+    return frac
+
+
+def set_filters(batch, filter_masks):
+    """
+    appends the ids of the filters with a true mask to the FILTER column.
+    records without failing filters keep their FILTER value. returns the
+    mask of records that pass, ie no filters set before or after.
+    """
+    original = batch['FILTER'].to_numpy(dtype=object)
+    unfiltered = (original == '.') | (original == 'PASS')
+
+    filters = np.where(unfiltered, '', original).astype(object)
+
+    for filter_id, mask in filter_masks:
+        filters[mask] = np.where(filters[mask] == '', filter_id, filters[mask] + ';' + filter_id)
+
+    failed = filters != ''
+    batch['FILTER'] = np.where(failed, filters, original)
+
+    return ~failed
+
+
+def write_batch(writer, batch, columns):
+    if len(batch) == 0:
+        return
+    lines = batch[columns[0]].str.cat(batch[columns[1:]], sep='\t')
+    writer.write('\n'.join(lines) + '\n')
+
+
+class VcfWriter(object):
+    """
+    text writer for plain or bgzipped vcf files
+    """
+
+    def __init__(self, filepath):
+        self.compressed = filepath.endswith('.gz')
+        if self.compressed:
+            self.writer = pysam.BGZFile(filepath, 'wb')
+        else:
+            self.writer = open(filepath, 'wt')
+
+    def write(self, data):
+        if self.compressed:
+            data = data.encode()
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def filter_snv_vcfs(
+        in_files,
+        out_file,
+        max_normal_coverage,
+        depth_filter_multiple=3.0,
+        max_filtered_basecall_frac=0.4,
+        max_spanning_deletion_frac=0.75,
+        quality_lower_bound=15,
+        use_depth_filter=True,
+        passed_only=False):
+    """
+    filters the strelka snv vcfs in order into out_file, the header is
+    taken from the first vcf with records. with passed_only only records
+    without filters are written.
+    """
+    header_index = get_header_index(in_files)
+
+    with VcfWriter(out_file) as writer:
+        for i, in_file in enumerate(in_files):
+            header = read_header(in_file)
+            columns = VCF_COLUMNS + header[-1].split('\t')[len(VCF_COLUMNS):]
+
+            if i == header_index:
+                new_filters = []
+                if use_depth_filter:
+                    new_filters.append(filter_header_line(
+                        FILTER_ID_DEPTH,
+                        'Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
+                    ))
+                new_filters.append(filter_header_line(
+                    FILTER_ID_BASE,
+                    'Fraction of basecalls filtered at this site in either sample is at or above {0}'.format(
+                        max_filtered_basecall_frac)
+                ))
+                new_filters.append(filter_header_line(
+                    FILTER_ID_SPANNING_DELETION,
+                    'Fraction of reads crossing site with spanning deletions in either sample exceeeds {0}'.format(
+                        max_spanning_deletion_frac)
+                ))
+                new_filters.append(filter_header_line(
+                    FILTER_ID_QSS,
+                    'Normal sample is not homozygous ref or ssnv Q-score < {0}, ie calls with NT!=ref or QSS_NT < {0}'.format(
+                        quality_lower_bound)
+                ))
+                writer.write('\n'.join(add_header_lines(header, new_filters)) + '\n')
+
+            for batch in iter_record_batches(in_file, len(header), columns):
+                normal = get_sample_values(batch, 'NORMAL', ['DP', 'FDP', 'SDP'])
+                tumour = get_sample_values(batch, 'TUMOR', ['DP', 'FDP', 'SDP'])
+
+                masks = []
+
+                if use_depth_filter:
+                    masks.append((FILTER_ID_DEPTH, normal['DP'] > max_normal_coverage))
+
+                masks.append((
+                    FILTER_ID_BASE,
+                    (safe_fraction(normal['FDP'], normal['DP']) >= max_filtered_basecall_frac) |
+                    (safe_fraction(tumour['FDP'], tumour['DP']) >= max_filtered_basecall_frac)
+                ))
+
+                masks.append((
+                    FILTER_ID_SPANNING_DELETION,
+                    (safe_fraction(normal['SDP'], normal['DP'] + normal['SDP']) > max_spanning_deletion_frac) |
+                    (safe_fraction(tumour['SDP'], tumour['DP'] + tumour['SDP']) > max_spanning_deletion_frac)
+                ))
+
+                masks.append((
+                    FILTER_ID_QSS,
+                    (get_info_strings(batch, 'NT') != 'ref') |
+                    (get_info_values(batch, 'QSS_NT') < quality_lower_bound)
+                ))
+
+                passed = set_filters(batch, masks)
+
+                if passed_only:
+                    batch = batch[passed]
+
+                write_batch(writer, batch, columns)
+
+
+def load_window(window_file):
+    window = pd.read_csv(
+        window_file,
+        comment='#',
+        converters={'chrom': str},
+        header=None,
+        names=WINDOW_COLUMNS,
+        sep='\t')
+
+    # the first row of a position is used
+    window = window.drop_duplicates(['chrom', 'coord'])
+
+    return window.set_index(['chrom', 'coord'])
+
+
+def format_values(values):
+    return pd.Series(values.tolist(), dtype=object).map(str).to_numpy(dtype=object)
+
+
+def add_window_format(batch, window):
+    """
+    adds the window depths of strelka to the FORMAT of the records,
+    returns the DP50 and FDP50 arrays of normal and tumour
+    """
+    keys = pd.MultiIndex.from_arrays([batch['CHROM'], batch['POS'].astype(int)])
+    missing = ~keys.isin(window.index)
+    if missing.any():
+        raise ValueError('no window data for {}:{}'.format(*keys[missing][0]))
+
+    rows = window.loc[keys]
+
+    values = {}
+    for prefix, sample in (('normal', 'NORMAL'), ('tumour', 'TUMOR')):
+        used = rows['{}_window_used'.format(prefix)].to_numpy()
+        filtered = rows['{}_window_filtered'.format(prefix)].to_numpy()
+        submap = rows['{}_window_submap'.format(prefix)].to_numpy()
+
+        dp50 = used + filtered
+
+        batch[sample] = (
+                batch[sample].to_numpy(dtype=object) + ':' + format_values(dp50) + ':' +
+                format_values(filtered) + ':' + format_values(submap)
+        )
+
+        values[sample] = (dp50.astype(float), filtered.astype(float))
+
+    batch['FORMAT'] = batch['FORMAT'].to_numpy(dtype=object) + ':DP50:FDP50:SUBDP50'
+
+    return values
+
+
+def filter_indel_vcfs(
+        vcf_files,
+        window_files,
+        out_file,
+        max_normal_coverage,
+        depth_filter_multiple=3.0,
+        max_int_hpol_length=14,
+        max_ref_repeat=8,
+        max_window_filtered_basecall_frac=0.3,
+        quality_lower_bound=30,
+        use_depth_filter=True,
+        passed_only=False):
+    """
+    filters the strelka indel vcfs in order into out_file, adding the
+    window depths of the matching window files to the records. the header
+    is taken from the first vcf with records. with passed_only only records
+    without filters are written.
+    """
+    header_index = get_header_index(vcf_files)
+
+    with VcfWriter(out_file) as writer:
+        for i, (vcf_file, window_file) in enumerate(zip(vcf_files, window_files)):
+            header = read_header(vcf_file)
+            columns = VCF_COLUMNS + header[-1].split('\t')[len(VCF_COLUMNS):]
+
+            if i == header_index:
+                new_lines = [
+                    format_header_line('DP50', 'Float', 'Average tier1 read depth within 50 bases'),
+                    format_header_line(
+                        'FDP50', 'Float',
+                        'Average tier1 number of basecalls filtered from original read depth within 50 bases'
+                    ),
+                    format_header_line(
+                        'SUBDP50', 'Float',
+                        'Average number of reads below tier1 mapping quality threshold aligned across sites within 50 bases'
+                    ),
+                ]
+                if use_depth_filter:
+                    new_lines.append(filter_header_line(
+                        FILTER_ID_DEPTH,
+                        'Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
+                    ))
+                new_lines.append(filter_header_line(
+                    FILTER_ID_REPEAT,
+                    'Sequence repeat of more than {0}x in the reference sequence'.format(max_ref_repeat)
+                ))
+                new_lines.append(filter_header_line(
+                    FILTER_ID_INDEL_HPOL,
+                    'Indel overlaps an interrupted homopolymer longer than {0}x in the reference sequence'.format(
+                        max_int_hpol_length)
+                ))
+                new_lines.append(filter_header_line(
+                    FILTER_ID_BASE,
+                    'Average fraction of filtered basecalls within 50 bases of the indel exceeds {0}'.format(
+                        max_window_filtered_basecall_frac)
+                ))
+                new_lines.append(filter_header_line(
+                    FILTER_ID_QSI,
+                    'Normal sample is not homozygous ref or sindel Q-score < {0}, ie calls with NT!=ref or QSI_NT < {0}'.format(
+                        quality_lower_bound)
+                ))
+                writer.write('\n'.join(add_header_lines(header, new_lines)) + '\n')
+
+            window = None
+
+            for batch in iter_record_batches(vcf_file, len(header), columns):
+                if window is None:
+                    window = load_window(window_file)
+
+                window_values = add_window_format(batch, window)
+
+                normal = get_sample_values(batch, 'NORMAL', ['DP'])
+
+                masks = []
+
+                if use_depth_filter:
+                    masks.append((FILTER_ID_DEPTH, normal['DP'] > max_normal_coverage))
+
+                # nan comparisons are false, so records without RC or IHP pass
+                masks.append((FILTER_ID_REPEAT, get_info_values(batch, 'RC') > max_ref_repeat))
+
+                masks.append((FILTER_ID_INDEL_HPOL, get_info_values(batch, 'IHP') > max_int_hpol_length))
+
+                normal_dp50, normal_fdp50 = window_values['NORMAL']
+                tumour_dp50, tumour_fdp50 = window_values['TUMOR']
+                masks.append((
+                    FILTER_ID_BASE,
+                    (safe_fraction(normal_fdp50, normal_dp50) >= max_window_filtered_basecall_frac) |
+                    (safe_fraction(tumour_fdp50, tumour_dp50) >= max_window_filtered_basecall_frac)
+                ))
+
+                masks.append((
+                    FILTER_ID_QSI,
+                    (get_info_strings(batch, 'NT') != 'ref') |
+                    (get_info_values(batch, 'QSI_NT') < quality_lower_bound)
+                ))
+
+                passed = set_filters(batch, masks)
+
+                if passed_only:
+                    batch = batch[passed]
+
+                write_batch(writer, batch, columns)
@@ -0,0 +1,216 @@
+import gzip
+import os
+import random
+
+import pytest
+from single_cell.workflows.strelka import _filter
+
+SNV_HEADER = [
+    '##fileformat=VCFv4.1',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">',
+    '##FORMAT=<ID=FDP,Number=1,Type=Integer,Description="Filtered basecalls">',
+    '##FORMAT=<ID=SDP,Number=1,Type=Integer,Description="Spanning deletions">',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR',
+]
+
+INDEL_HEADER = [
+    '##fileformat=VCFv4.1',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR',
+]
+
+
+def write_lines(filepath, lines):
+    with open(filepath, 'wt') as writer:
+        for line in lines:
+            writer.write(line + '\n')
+    return filepath
+
+
+def read_records(filepath):
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt') as reader:
+        lines = [line.rstrip('\n') for line in reader]
+    return [line for line in lines if line.startswith('#')], [line for line in lines if not line.startswith('#')]
+
+
+def simulate_snvs(rand, chrom, start, num_records):
+    records = []
+    for pos in range(start, start + num_records):
+        info = 'NT={};QSS_NT={}'.format(rand.choice(['ref', 'ref', 'ref', 'het']), rand.randint(0, 40))
+        samples = []
+        for _ in range(2):
+            dp = rand.choice([0, rand.randint(1, 150)])
+            samples.append('{}:{}:{}:{}'.format(dp, rand.randint(0, max(dp, 1)), rand.randint(0, 10), rand.randint(0, 5)))
+        records.append('\t'.join([
+            chrom, str(pos), '.', 'A', 'C', '.', rand.choice(['PASS', '.', 'LowQ']), info, 'DP:FDP:SDP:TIR'
+        ] + samples))
+    return records
+
+
+def simulate_indels(rand, chrom, start, num_records):
+    records = []
+    windows = []
+    for pos in range(start, start + num_records * 3, 3):
+        info = ['NT={}'.format(rand.choice(['ref', 'ref', 'het'])), 'QSI_NT={}'.format(rand.randint(0, 60))]
+        if rand.random() < 0.7:
+            info.append('RC={}'.format(rand.randint(0, 12)))
+        if rand.random() < 0.7:
+            info.append('IHP={}'.format(rand.randint(0, 20)))
+        records.append('\t'.join([
+            chrom, str(pos), '.', 'AT', 'A', '.', rand.choice(['PASS', '.']), ';'.join(info), 'DP',
+            str(rand.randint(0, 150)), str(rand.randint(0, 150))
+        ]))
+        window = [rand.choice([0, rand.randint(1, 100)]) + 0.5 for _ in range(6)]
+        windows.append('\t'.join([chrom, str(pos)] + [str(v) for v in window]))
+    return records, windows
+
+
+def naive_filter_snv(record, max_normal_coverage, use_depth_filter=True):
+    # the per record filters of the previous pyvcf implementation
+    fields = record.split('\t')
+    info = dict(v.split('=') for v in fields[7].split(';'))
+    fmt = fields[8].split(':')
+    normal = dict(zip(fmt, map(int, fields[9].split(':'))))
+    tumour = dict(zip(fmt, map(int, fields[10].split(':'))))
+
+    filters = [] if fields[6] in ('.', 'PASS') else fields[6].split(';')
+
+    if use_depth_filter and normal['DP'] > max_normal_coverage:
+        filters.append('DP')
+
+    def fdp_frac(data):
+        return data['FDP'] / data['DP'] if data['DP'] > 0 else 0
+
+    def sdp_frac(data):
+        total = data['DP'] + data['SDP']
+        return data['SDP'] / total if total > 0 else 0
+
+    if fdp_frac(normal) >= 0.4 or fdp_frac(tumour) >= 0.4:
+        filters.append('BCNoise')
+    if sdp_frac(normal) > 0.75 or sdp_frac(tumour) > 0.75:
+        filters.append('SpanDel')
+    if info['NT'] != 'ref' or int(info['QSS_NT']) < 15:
+        filters.append('QSS_ref')
+
+    if filters:
+        fields[6] = ';'.join(filters)
+    return '\t'.join(fields), not filters
+
+
+def naive_filter_indel(record, window, max_normal_coverage):
+    fields = record.split('\t')
+    info = dict(v.split('=') for v in fields[7].split(';'))
+    window = [float(v) for v in window.split('\t')[2:]]
+
+    normal_dp50, normal_fdp50 = window[0] + window[1], window[1]
+    tumour_dp50, tumour_fdp50 = window[3] + window[4], window[4]
+
+    fields[8] += ':DP50:FDP50:SUBDP50'
+    fields[9] += ':{}:{}:{}'.format(normal_dp50, window[1], window[2])
+    fields[10] += ':{}:{}:{}'.format(tumour_dp50, window[4], window[5])
+
+    filters = [] if fields[6] in ('.', 'PASS') else fields[6].split(';')
+
+    if int(fields[9].split(':')[0]) > max_normal_coverage:
+        filters.append('DP')
+    if 'RC' in info and int(info['RC']) > 8:
+        filters.append('Repeat')
+    if 'IHP' in info and int(info['IHP']) > 14:
+        filters.append('iHpol')
+    if (normal_dp50 > 0 and normal_fdp50 / normal_dp50 >= 0.3) or \
+            (tumour_dp50 > 0 and tumour_fdp50 / tumour_dp50 >= 0.3):
+        filters.append('BCNoise')
+    if info['NT'] != 'ref' or int(info['QSI_NT']) < 30:
+        filters.append('QSI_ref')
+
+    if filters:
+        fields[6] = ';'.join(filters)
+    return '\t'.join(fields), not filters
+
+
+@pytest.mark.parametrize('out_name', ['filtered.vcf', 'filtered.vcf.gz'])
+def test_filter_snv_vcfs(tmpdir, out_name):
+    tmpdir = str(tmpdir)
+    rand = random.Random(0)
+
+    records = [simulate_snvs(rand, '1', start, 500) for start in (1, 10001)]
+    in_files = [
+        write_lines(os.path.join(tmpdir, 'in{}.vcf'.format(i)), SNV_HEADER + v)
+        for i, v in enumerate(records)
+    ]
+
+    out_file = os.path.join(tmpdir, out_name)
+    _filter.filter_snv_vcfs(in_files, out_file, 100)
+
+    header, filtered = read_records(out_file)
+    expected = [naive_filter_snv(v, 100)[0] for v in records[0] + records[1]]
+
+    assert filtered == expected
+    assert header[-1] == SNV_HEADER[-1]
+    assert '##FILTER=<ID=QSS_ref,' in '\n'.join(header)
+
+
+def test_filter_snv_vcfs_passed_only(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    rand = random.Random(1)
+
+    records = simulate_snvs(rand, 'X', 1, 2000)
+    in_file = write_lines(os.path.join(tmpdir, 'in.vcf'), SNV_HEADER + records)
+
+    out_file = os.path.join(tmpdir, 'passed.vcf.gz')
+    # small batches, so that the filters are applied across several of them
+    monkeypatch.setattr(_filter, 'BATCH_SIZE', 300)
+    _filter.filter_snv_vcfs([in_file], out_file, 50, use_depth_filter=False, passed_only=True)
+
+    _, passed = read_records(out_file)
+    expected = [v for v, ok in (naive_filter_snv(r, 50, use_depth_filter=False) for r in records) if ok]
+
+    assert passed and passed == expected
+
+
+def test_filter_indel_vcfs(tmpdir):
+    tmpdir = str(tmpdir)
+    rand = random.Random(2)
+
+    records, windows = simulate_indels(rand, '2', 1, 1000)
+    vcf_file = write_lines(os.path.join(tmpdir, 'in.vcf'), INDEL_HEADER + records)
+    # duplicated rows of a position use the first
+    window_file = write_lines(os.path.join(tmpdir, 'in.window'), ['# window'] + windows + windows[:5])
+
+    out_file = os.path.join(tmpdir, 'filtered.vcf')
+    _filter.filter_indel_vcfs([vcf_file], [window_file], out_file, 100)
+
+    header, filtered = read_records(out_file)
+    expected = [naive_filter_indel(r, w, 100)[0] for r, w in zip(records, windows)]
+
+    assert filtered == expected
+    assert '##FORMAT=<ID=DP50,' in '\n'.join(header)
+
+
+def test_filter_empty_vcf(tmpdir):
+    tmpdir = str(tmpdir)
+    in_file = write_lines(os.path.join(tmpdir, 'in.vcf'), SNV_HEADER)
+
+    out_file = os.path.join(tmpdir, 'filtered.vcf.gz')
+    _filter.filter_snv_vcfs([in_file], out_file, 100)
+
+    header, records = read_records(out_file)
+    assert header[-1] == SNV_HEADER[-1]
+    assert records == []
+
+
+def test_get_normal_coverage(tmpdir):
+    tmpdir = str(tmpdir)
+    stats = [
+        write_lines(os.path.join(tmpdir, 'stats1'), [
+            'TUMOR_NO_REF_N_COVERAGE sample_size: 10 mean: 5 ',
+            'NORMAL_NO_REF_N_COVERAGE sample_size: 100 mean: 20.5 max: 30',
+        ]),
+        write_lines(os.path.join(tmpdir, 'stats2'), [
+            'NORMAL_NO_REF_N_COVERAGE sample_size: 0 mean: nan max: nan',
+        ]),
+    ]
+
+    assert _filter.get_normal_coverage(stats) == 2050
+    assert _filter.get_max_normal_coverage(3.0, 1000, stats) == pytest.approx(6.15)
@@ -6,7 +6,6 @@ Created on Nov 1, 2015
 from __future__ import division
 
 import csv
-import math
 import re
 from collections import OrderedDict
 
@@ -15,14 +14,9 @@ import pandas as pd
 import vcf
 
 import pypeliner
+from single_cell.utils import vcfsortutils
 
-FILTER_ID_BASE = 'BCNoise'
-FILTER_ID_DEPTH = 'DP'
-FILTER_ID_INDEL_HPOL = 'iHpol'
-FILTER_ID_QSI = 'QSI_ref'
-FILTER_ID_QSS = 'QSS_ref'
-FILTER_ID_REPEAT = 'Repeat'
-FILTER_ID_SPANNING_DELETION = 'SpanDel'
+from . import _filter
 
 
 def _get_files_for_chrom(infiles, intervals, chrom):
@@ -40,32 +34,6 @@ def _get_files_for_chrom(infiles, intervals, chrom):
     return outfiles
 
 
-def get_known_chromosome_sizes(size_file, chromosomes):
-    sizes = {}
-
-    with open(size_file, 'r') as fh:
-        reader = csv.DictReader(fh, ['path', 'chrom', 'known_size', 'size'], delimiter='\t')
-
-        for row in reader:
-            if row['chrom'] not in chromosomes:
-                continue
-
-            sizes[row['chrom']] = int(row['known_size'])
-
-    return sizes
-
-
-def count_fasta_bases(ref_genome_fasta_file, out_file):
-    cmd = [
-        'countFastaBases',
-        ref_genome_fasta_file,
-        '>',
-        out_file
-    ]
-
-    pypeliner.commandline.execute(*cmd)
-
-
 def call_somatic_variants(
         normal_bam_file,
         tumour_bam_file,
@@ -83,7 +51,12 @@ def call_somatic_variants(
         sindel_prior=0.000001,
         ssnv_noise=0.0000005,
         ssnv_noise_strand_bias_frac=0.5,
-        ssnv_prior=0.000001):
+        ssnv_prior=0.000001,
+        empty_regions=None):
+    if empty_regions and region in empty_regions:
+        _write_empty_region_outputs(tumour_bam_file, indel_file, indel_window_file, snv_file, stats_file)
+        return
+
     chrom, beg, end = re.split("-", region)
 
     genome_size = sum(known_sizes.values())
@@ -140,6 +113,19 @@ def call_somatic_variants(
     pypeliner.commandline.execute(*cmd)
 
 
+def _write_empty_region_outputs(bam_file, indel_file, indel_window_file, snv_file, stats_file):
+    """
+    outputs of a region without reads in the normal, which strelka is
+    not run for. the empty stats file adds no normal coverage, as strelka
+    would report none for the region
+    """
+    vcfsortutils.write_empty_vcf(indel_file, bam=bam_file, samples=['NORMAL', 'TUMOR'])
+    vcfsortutils.write_empty_vcf(snv_file, bam=bam_file, samples=['NORMAL', 'TUMOR'])
+
+    for filepath in (indel_window_file, stats_file):
+        open(filepath, 'w').close()
+
+
 # =======================================================================================================================
 # SNV filtering
 # =======================================================================================================================
@@ -156,135 +142,28 @@ def filter_snv_file_list(
         max_filtered_basecall_frac=0.4,
         max_spanning_deletion_frac=0.75,
         quality_lower_bound=15,
-        use_depth_filter=True):
+        use_depth_filter=True,
+        passed_only=False):
     known_chrom_size = known_chrom_size[chrom]
 
     in_files = _get_files_for_chrom(in_files, intervals, chrom)
     stats_files = _get_files_for_chrom(stats_files, intervals, chrom)
 
-    max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files)
-
-    writer = None
-
-    with open(out_file, 'wt') as out_fh:
-        for key in sorted(in_files):
-            reader = vcf.Reader(filename=in_files[key])
-
-            if writer is None:
-                # Add filters to header
-                if use_depth_filter:
-                    reader.filters[FILTER_ID_DEPTH] = vcf.parser._Filter(
-                        id=FILTER_ID_DEPTH,
-                        desc='Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
-                    )
-
-                reader.filters[FILTER_ID_BASE] = vcf.parser._Filter(
-                    id=FILTER_ID_BASE,
-                    desc='Fraction of basecalls filtered at this site in either sample is at or above {0}'.format(
-                        max_filtered_basecall_frac)
-                )
-
-                reader.filters[FILTER_ID_SPANNING_DELETION] = vcf.parser._Filter(
-                    id=FILTER_ID_SPANNING_DELETION,
-                    desc='Fraction of reads crossing site with spanning deletions in either sample exceeeds {0}'.format(
-                        max_spanning_deletion_frac)
-                )
-
-                reader.filters[FILTER_ID_QSS] = vcf.parser._Filter(
-                    id=FILTER_ID_QSS,
-                    desc='Normal sample is not homozygous ref or ssnv Q-score < {0}, ie calls with NT!=ref or QSS_NT < {0}'.format(
-                        quality_lower_bound)
-                )
-
-                writer = vcf.Writer(out_fh, reader)
-
-            for record in reader:
-                normal = record.genotype('NORMAL')
-
-                tumour = record.genotype('TUMOR')
-
-                # Normal depth filter
-                if use_depth_filter and (normal.data.DP > max_normal_coverage):
-                    record.add_filter(FILTER_ID_DEPTH)
-
-                # Filtered basecall fraction
-                normal_filtered_base_call_fraction = _get_filtered_base_call_fraction(normal.data)
-
-                tumour_filtered_base_call_fraction = _get_filtered_base_call_fraction(tumour.data)
-
-                if (normal_filtered_base_call_fraction >= max_filtered_basecall_frac) or \
-                        (tumour_filtered_base_call_fraction >= max_filtered_basecall_frac):
-                    record.add_filter(FILTER_ID_BASE)
-
-                # Spanning deletion fraction
-                normal_spanning_deletion_fraction = _get_spanning_deletion_fraction(normal.data)
-
-                tumour_spanning_deletion_fraction = _get_spanning_deletion_fraction(tumour.data)
-
-                if (normal_spanning_deletion_fraction > max_spanning_deletion_frac) or \
-                        (tumour_spanning_deletion_fraction > max_spanning_deletion_frac):
-                    record.add_filter(FILTER_ID_SPANNING_DELETION)
-
-                # Q-val filter
-                if (record.INFO['NT'] != 'ref') or (record.INFO['QSS_NT'] < quality_lower_bound):
-                    record.add_filter(FILTER_ID_QSS)
-
-                writer.write_record(record)
-
-        writer.close()
-
-
-def _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files):
-    normal_coverage = _get_normal_coverage(stats_files.values())
-
-    normal_mean_coverage = normal_coverage / known_chrom_size
-
-    max_normal_coverage = normal_mean_coverage * depth_filter_multiple
-
-    return max_normal_coverage
-
-
-def _get_normal_coverage(stats_files):
-    total_coverage = 0
-
-    for file_name in stats_files:
-        mean_matcher = re.compile('mean:\s(.*?)\s')
-
-        sample_size_matcher = re.compile('sample_size:\s(.*?)\s')
-
-        with open(file_name) as fh:
-            for line in fh:
-                if line.startswith('NORMAL_NO_REF_N_COVERAGE '):
-                    mean = float(mean_matcher.search(line).group(1))
-
-                    sample_size = float(sample_size_matcher.search(line).group(1))
-
-                    if math.isnan(mean) or math.isnan(sample_size):
-                        continue
-
-                    total_coverage += mean * sample_size
-
-    return total_coverage
-
-
-def _get_filtered_base_call_fraction(data):
-    frac = 0
-
-    if data.DP > 0:
-        frac = data.FDP / data.DP
-
-    return frac
-
-
-def _get_spanning_deletion_fraction(data):
-    total = data.DP + data.SDP
-
-    frac = 0
-
-    if total > 0:
-        frac = data.SDP / total
+    max_normal_coverage = _filter.get_max_normal_coverage(
+        depth_filter_multiple, known_chrom_size, stats_files.values()
+    )
 
-    return frac
+    _filter.filter_snv_vcfs(
+        [in_files[key] for key in sorted(in_files)],
+        out_file,
+        max_normal_coverage,
+        depth_filter_multiple=depth_filter_multiple,
+        max_filtered_basecall_frac=max_filtered_basecall_frac,
+        max_spanning_deletion_frac=max_spanning_deletion_frac,
+        quality_lower_bound=quality_lower_bound,
+        use_depth_filter=use_depth_filter,
+        passed_only=passed_only,
+    )
 
 
 # =======================================================================================================================
@@ -305,182 +184,31 @@ def filter_indel_file_list(
         max_ref_repeat=8,
         max_window_filtered_basecall_frac=0.3,
         quality_lower_bound=30,
-        use_depth_filter=True):
-    window_cols = (
-        'chrom',
-        'coord',
-        'normal_window_used',
-        'normal_window_filtered',
-        'normal_window_submap',
-        'tumour_window_used',
-        'tumour_window_filtered',
-        'tumour_window_submap'
-    )
-
+        use_depth_filter=True,
+        passed_only=False):
     known_chrom_size = known_chrom_size[chrom]
 
     vcf_files = _get_files_for_chrom(vcf_files, intervals, chrom)
     stats_files = _get_files_for_chrom(stats_files, intervals, chrom)
     window_files = _get_files_for_chrom(window_files, intervals, chrom)
 
-    max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files)
-
-    writer = None
-
-    with open(out_file, 'wt') as out_fh:
-        for key in sorted(vcf_files):
-            window = pd.read_csv(
-                window_files[key],
-                comment='#',
-                converters={'chrom': str},
-                header=None,
-                names=window_cols,
-                sep='\t')
-
-            reader = vcf.Reader(filename=vcf_files[key])
-
-            if writer is None:
-                # Add format to header
-                reader.formats['DP50'] = vcf.parser._Format(
-                    id='DP50',
-                    num=1,
-                    type='Float',
-                    desc='Average tier1 read depth within 50 bases'
-                )
-
-                reader.formats['FDP50'] = vcf.parser._Format(
-                    id='FDP50',
-                    num=1,
-                    type='Float',
-                    desc='Average tier1 number of basecalls filtered from original read depth within 50 bases'
-                )
-
-                reader.formats['SUBDP50'] = vcf.parser._Format(
-                    id='SUBDP50',
-                    num=1,
-                    type='Float',
-                    desc='Average number of reads below tier1 mapping quality threshold aligned across sites within 50 bases'
-                )
-
-                # Add filters to header
-                if use_depth_filter:
-                    reader.filters[FILTER_ID_DEPTH] = vcf.parser._Filter(
-                        id=FILTER_ID_DEPTH,
-                        desc='Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
-                    )
-
-                reader.filters[FILTER_ID_REPEAT] = vcf.parser._Filter(
-                    id=FILTER_ID_REPEAT,
-                    desc='Sequence repeat of more than {0}x in the reference sequence'.format(max_ref_repeat)
-                )
-
-                reader.filters[FILTER_ID_INDEL_HPOL] = vcf.parser._Filter(
-                    id=FILTER_ID_INDEL_HPOL,
-                    desc='Indel overlaps an interrupted homopolymer longer than {0}x in the reference sequence'.format(
-                        max_int_hpol_length)
-                )
-
-                reader.filters[FILTER_ID_BASE] = vcf.parser._Filter(
-                    id=FILTER_ID_BASE,
-                    desc='Average fraction of filtered basecalls within 50 bases of the indel exceeds {0}'.format(
-                        max_window_filtered_basecall_frac)
-                )
-
-                reader.filters[FILTER_ID_QSI] = vcf.parser._Filter(
-                    id=FILTER_ID_QSI,
-                    desc='Normal sample is not homozygous ref or sindel Q-score < {0}, ie calls with NT!=ref or QSI_NT < {0}'.format(
-                        quality_lower_bound)
-                )
-
-                writer = vcf.Writer(out_fh, reader)
-
-            for record in reader:
-                window_row = window.loc[
-                    (window['chrom'] == str(record.CHROM)) & (window['coord'] == record.POS)].iloc[0]
-
-                normal = record.genotype('NORMAL')
-
-                tumour = record.genotype('TUMOR')
-
-                normal_data = normal.data._asdict()
-
-                tumour_data = tumour.data._asdict()
-
-                # Add window data to vcf record
-                record.add_format('DP50')
-
-                record.add_format('FDP50')
-
-                record.add_format('SUBDP50')
-
-                normal_data['DP50'] = window_row['normal_window_used'] + window_row['normal_window_filtered']
-
-                normal_data['FDP50'] = window_row['normal_window_filtered']
-
-                normal_data['SUBDP50'] = window_row['normal_window_submap']
-
-                tumour_data['DP50'] = window_row['tumour_window_used'] + window_row['tumour_window_filtered']
-
-                tumour_data['FDP50'] = window_row['tumour_window_filtered']
-
-                tumour_data['SUBDP50'] = window_row['tumour_window_submap']
-
-                normal.data = _convert_dict_to_call(normal_data)
-
-                tumour.data = _convert_dict_to_call(tumour_data)
-
-                # Add filters
-
-                # Normal depth filter
-                if use_depth_filter and (normal.data.DP > max_normal_coverage):
-                    record.add_filter(FILTER_ID_DEPTH)
-
-                # Ref repeat
-                if 'RC' in record.INFO:
-                    ref_repeat = record.INFO['RC']
-
-                    if ref_repeat > max_ref_repeat:
-                        record.add_filter(FILTER_ID_REPEAT)
-
-                # Indel homopolymer
-                if 'IHP' in record.INFO:
-                    indel_homopolymer = record.INFO['IHP']
-
-                    if indel_homopolymer > max_int_hpol_length:
-                        record.add_filter(FILTER_ID_INDEL_HPOL)
-
-                # Base filter
-                normal_filtered_base_call_fraction = _get_filtered_base_call_fraction_indel(normal.data)
-
-                tumour_filtered_base_call_fraction = _get_filtered_base_call_fraction_indel(tumour.data)
-
-                if (normal_filtered_base_call_fraction >= max_window_filtered_basecall_frac) or \
-                        (tumour_filtered_base_call_fraction >= max_window_filtered_basecall_frac):
-                    record.add_filter(FILTER_ID_BASE)
-
-                # Q-val filter
-                if (record.INFO['NT'] != 'ref') or (record.INFO['QSI_NT'] < quality_lower_bound):
-                    record.add_filter(FILTER_ID_QSI)
-
-                writer.write_record(record)
-
-        if writer:
-            writer.close()
-
-
-def _convert_dict_to_call(data_dict):
-    call_data_class = vcf.model.make_calldata_tuple(data_dict.keys())
-
-    return call_data_class(**data_dict)
-
-
-def _get_filtered_base_call_fraction_indel(data):
-    frac = 0
-
-    if data.DP50 > 0:
-        frac = data.FDP50 / data.DP50
+    max_normal_coverage = _filter.get_max_normal_coverage(
+        depth_filter_multiple, known_chrom_size, stats_files.values()
+    )
 
-    return frac
+    _filter.filter_indel_vcfs(
+        [vcf_files[key] for key in sorted(vcf_files)],
+        [window_files[key] for key in sorted(vcf_files)],
+        out_file,
+        max_normal_coverage,
+        depth_filter_multiple=depth_filter_multiple,
+        max_int_hpol_length=max_int_hpol_length,
+        max_ref_repeat=max_ref_repeat,
+        max_window_filtered_basecall_frac=max_window_filtered_basecall_frac,
+        quality_lower_bound=quality_lower_bound,
+        use_depth_filter=use_depth_filter,
+        passed_only=passed_only,
+    )
 
 
 # =======================================================================================================================
@@ -7,13 +7,12 @@ import itertools
 import os
 import shutil
 
-import pandas as pd
 import vcf
 from .components_utils import flatten_input
-from single_cell.utils import helpers
+from single_cell.utils import vcfsortutils
+from single_cell.utils import vcftableutils
 
 import pypeliner
-from pandas.api.types import CategoricalDtype
 
 
 def compress_vcf(in_file, out_file):
@@ -81,21 +80,11 @@ def finalise_vcf(in_file, compressed_file):
 
     :param out_file: Path where compressed file will be written. Index file will written to `out_file` + `.tbi` and `out_file` + `.csi` and .
 
-    """
-
-    uncompressed_file = compressed_file + '.uncompressed'
-    pypeliner.commandline.execute(
-        'vcf-sort', in_file, '>', uncompressed_file,
-    )
-
-    pypeliner.commandline.execute(
-        'bgzip', uncompressed_file, '-c', '>', compressed_file,
-    )
+    Input that is already sorted is not sorted again.
 
-    os.remove(uncompressed_file)
+    """
 
-    index_bcf(compressed_file)
-    index_vcf(compressed_file)
+    vcfsortutils.finalise_vcf(in_file, compressed_file)
 
 
 def index_vcf(vcf_file):
@@ -116,31 +105,17 @@ def index_vcf(vcf_file):
 def concatenate_vcf(
         in_files, out_file, tempdir,
         allow_overlap=False):
-    """ Fast concatenation of VCF file using `bcftools`.
+    """ Concatenation of VCF files into a bgzipped and indexed VCF.
 
-    :param in_files: dict with values being files to be concatenated. Files will be concatenated based on sorted order of keys.
+    :param in_files: dict with values being files to be concatenated. Files will be concatenated based on the order of their first records.
 
     :param out_file: path where output file will be written in VCF format.
 
-    """
-    helpers.makedirs(tempdir)
-
-    merged_file = os.path.join(tempdir, 'merged.vcf')
-    if allow_overlap:
-        cmd = ['bcftools', 'concat', '-a', '-O', 'z', '-o', merged_file]
-    else:
-        cmd = ['bcftools', 'concat', '-O', 'z', '-o', merged_file]
+    Files that do not overlap are concatenated without sorting, overlapping files are sorted whether or not
+    `allow_overlap` is set.
 
-    cmd += flatten_input(in_files)
-
-    pypeliner.commandline.execute(*cmd)
-
-    # sort merged vcf file
-    cmd = ['bcftools', 'sort', '-O', 'z', '-o', out_file, merged_file]
-    pypeliner.commandline.execute(*cmd)
-
-    index_vcf(out_file)
-    index_bcf(out_file)
+    """
+    vcfsortutils.concatenate_vcf(in_files, out_file, tempdir=tempdir)
 
 
 def concatenate_bcf(in_files, out_file):
@@ -204,86 +179,15 @@ def split_vcf(in_file, out_file_callback, lines_per_file):
             writer.close()
 
 
-def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None):
-    def line_group(line, line_idx=itertools.count()):
-        return int(next(line_idx) / chunk_size)
-
-    chunk_size = 1000
-
-    # ===================================================================================================================
-    # find all entries in categories
-    # ===================================================================================================================
-    reader = vcf.Reader(filename=in_file)
-
-    chrom_categories = set()
-
-    ref_categories = set()
-
-    alt_categories = set()
+def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None, tempdir=None):
+    """ Convert a VCF to an HDF5 table with a row per alt allele, in a single pass over the VCF.
 
-    for record in reader:
+    :param score_callback: called with the pysam VariantRecord to get the score, QUAL by default.
 
-        chrom_categories.add(str(record.CHROM))
-
-        ref_categories.add(str(record.REF))
-
-        for alt in record.ALT:
-            alt_categories.add(str(alt))
-
-    chrom_categories = sorted(chrom_categories)
-
-    ref_categories = sorted(ref_categories)
-
-    alt_categories = sorted(alt_categories)
-
-    # ===================================================================================================================
-    # convert
-    # ===================================================================================================================
-
-    # reopen reader to restart iter
-    reader = vcf.Reader(filename=in_file)
-
-    hdf_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
-
-    for file_idx, records in itertools.groupby(reader, key=line_group):
-
-        df = []
-
-        for record in records:
-            if score_callback is not None:
-                score = score_callback(record)
-
-            else:
-                score = record.QUAL
-
-            for alt in record.ALT:
-                row = {
-                    'chrom': record.CHROM,
-                    'coord': record.POS,
-                    'ref': str(record.REF),
-                    'alt': str(alt),
-                    'score': score
-                }
-
-                df.append(row)
-
-        beg = file_idx * chunk_size
-
-        end = beg + len(df)
-
-        df = pd.DataFrame(df, index=range(beg, end))
-
-        df['chrom'] = df['chrom'].astype(CategoricalDtype(categories=chrom_categories))
-
-        df['alt'] = df['alt'].astype(CategoricalDtype(categories=alt_categories))
-
-        df['ref'] = df['ref'].astype(CategoricalDtype(categories=ref_categories))
-
-        df = df[['chrom', 'coord', 'ref', 'alt', 'score']]
-
-        hdf_store.append(table_name, df)
-
-    hdf_store.close()
+    """
+    vcftableutils.convert_vcf_to_hdf5(
+        in_file, out_file, table_name, tempdir=tempdir, score_callback=score_callback
+    )
 
 
 def sort_vcf(in_file, out_file):